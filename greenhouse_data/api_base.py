@@ -2,34 +2,141 @@ from django.shortcuts import render
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.authtoken.models import Token
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.permissions import SAFE_METHODS, BasePermission, IsAuthenticated
 from rest_framework import status
+from rest_framework.settings import api_settings
+from django.db.models import Prefetch
 
 from datetime import datetime
+import hashlib
+import uuid
 
+from myapp.authentication import getOwnedGreenhouses
+
+from .device_auth import bodyDigest, checkDeviceRequest
 from .models import *
 from .serializer import *
+from .parsers import MessagePackParser
+from .routers import isPinnedToPrimary, pinToPrimary, replicaReads
+from .snapshot import snapshotCache
+from .topology import topologyCache
+
+
+class ConditionalGetMixin:
+    """
+    Conditional GET support. The ETag is computed from cheap version values before
+    the response is built, so a request with a matching If-None-Match skips the
+    serialization and gets an empty 304. The versions must be read before the data
+    they describe: the response can then be newer than its ETag but never older.
+    """
+
+    def getETag(self, *versionParts):
+        digest = hashlib.sha1(
+            "|".join(str(part) for part in versionParts).encode()).hexdigest()
+        return f'"{digest[:24]}"'
+
+    def isNotModified(self, request, etag: str):
+        ifNoneMatch = request.headers.get("If-None-Match", None)
+        if ifNoneMatch is None:
+            return False
+
+        # If-None-Match uses the weak comparison
+        etags = [tag.strip().removeprefix("W/")
+                 for tag in ifNoneMatch.split(",")]
+        return "*" in etags or etag in etags
+
+    def conditionalResponse(self, request, etag: str, buildResponse):
+        """
+        Return 304 when the client holds `etag`, otherwise the response of
+        `buildResponse()` with the ETag header
+        """
+        if self.isNotModified(request, etag):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
 
+        response = buildResponse()
+        if response.status_code == status.HTTP_200_OK:
+            response["ETag"] = etag
+        return response
 
-class GreenhouseBaseAPI(APIView):
+
+class DeviceSignaturePermission(BasePermission):
     """
-    API for greenhouse. No permission class included
+    Check the device signature of the gh/ requests, see device_auth.py
     """
-    permission_classes = []
+
+    def has_permission(self, request, view):
+        reason = checkDeviceRequest(
+            view.kwargs.get("greenhouseUID", None),
+            request.headers,
+            request.method,
+            request.path,
+            lambda: view.getBodyDigest(request),
+        )
+        if reason is not None:
+            raise AuthenticationFailed(reason)
+        return True
 
 
-class AppBaseAPI(APIView):
+class GreenhouseBaseAPI(ConditionalGetMixin, APIView):
     """
-    API for app, required user permission
+    API for greenhouse. The devices are not users, their requests are checked by
+    signature with the device key of the greenhouse (see device_auth.py). Request
+    bodies can be sent as json or as MessagePack ("Content-Type: application/msgpack").
+    """
+    permission_classes = [DeviceSignaturePermission]
+    parser_classes = api_settings.DEFAULT_PARSER_CLASSES + [MessagePackParser]
+
+    def getBodyDigest(self, request):
+        return bodyDigest(request.body)
+
+
+class AppBaseAPI(ConditionalGetMixin, APIView):
+    """
+    API for app, required user permission. The GET requests read from the read
+    replicas unless the user wrote something in the last seconds (see routers.py).
     """
     permission_classes = [IsAuthenticated]
+    replicaToken = None
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if request.method in SAFE_METHODS and not isPinnedToPrimary(request.user):
+            self.replicaToken = replicaReads.set(True)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        if self.replicaToken is not None:
+            replicaReads.reset(self.replicaToken)
+            self.replicaToken = None
+
+        # the user reads their own writes from the primaries for a while
+        if request.method not in SAFE_METHODS and response.status_code < 400:
+            pinToPrimary(request.user)
+        return super().finalize_response(request, response, *args, **kwargs)
 
     def checkGreenhouseOwner(self, greenhouse, user):
-        print("greenhouse owner", greenhouse.owner)
-        print("user", user)
+        """
+        Raise PermissionError unless `user` owns `greenhouse`, a greenhouse instance or
+        a greenhouse uid. A uid is checked against the cached greenhouses of the user
+        (see myapp/authentication.py), and raises GreenhouseModel.DoesNotExist when no
+        greenhouse has it.
+        """
+        if isinstance(greenhouse, GreenhouseModel):
+            # compare the ids, loading the owner would cost a query
+            if greenhouse.owner_id != user.id:
+                raise PermissionError()
+            return
+
+        try:
+            greenhouseUID = uuid.UUID(str(greenhouse))
+        except ValueError:
+            raise GreenhouseModel.DoesNotExist()
 
-        if greenhouse.owner != user:
-            raise PermissionError()
+        if str(greenhouseUID) in getOwnedGreenhouses(user):
+            return
+        if not GreenhouseModel.objects.filter(greenhouseUID=greenhouseUID).exists():
+            raise GreenhouseModel.DoesNotExist()
+        raise PermissionError()
 
 
 class GetGreenhouseBase(AppBaseAPI):
@@ -37,6 +144,45 @@ class GetGreenhouseBase(AppBaseAPI):
     Base class for app to get greenhouse information
     """
 
+    def getGreenhouseQueryset(self):
+        """
+        Greenhouses with their real sensors, sensors, controllers, current settings and
+        schedules prefetched, so `GreenhouseSerializer` runs a fixed number of queries
+        whatever the number of greenhouses and devices
+        """
+        return GreenhouseModel.objects.prefetch_related(
+            "realSensors__sensors",
+            Prefetch(
+                "controllers",
+                queryset=ControllerModel.objects.prefetch_related("currentSetting__schedules"),
+            ),
+        )
+
+    def getGreenhouseVersions(self, greenhouses):
+        """ Map the uid of each greenhouse of the queryset to its version, in order """
+        return dict(greenhouses.values_list("greenhouseUID", "version"))
+
+    def getGreenhouseSnapshots(self, versions: dict):
+        """
+        Return the app documents of the greenhouses of `getGreenhouseVersions`, in its
+        order. Nothing else is read when the snapshots are cached, the greenhouses
+        whose snapshot is missing or outdated are rebuilt with `getGreenhouseQueryset`.
+        """
+        snapshots = snapshotCache.getMany(versions)
+
+        missingUIDs = [uid for uid in versions if uid not in snapshots]
+        if len(missingUIDs) != 0:
+            for greenhouse in self.getGreenhouseQueryset().filter(greenhouseUID__in=missingUIDs):
+                snapshot = self.parseToAppFormat(
+                    GreenhouseSerializer(greenhouse).data)
+                # the version is read before the devices, so the snapshot is at
+                # least as recent as its version
+                snapshotCache.set(greenhouse.greenhouseUID,
+                                  greenhouse.version, snapshot)
+                snapshots[greenhouse.greenhouseUID] = snapshot
+
+        return [snapshots[uid] for uid in versions if uid in snapshots]
+
     def parseEvalvSchedules(self, controller):
 
         if controller["setting"].setdefault("schedules", None):
@@ -69,10 +215,70 @@ class GetGreenhouseBase(AppBaseAPI):
 
         data["controllers"] = {}
         for c in controllers:
-            c["on"] = c["setting"].pop("on")
-            c["manualControl"] = c["setting"].pop("manualControl")
-            c = self.parseEvalvSchedules(controller=c)
+            c = self.parseControllerToAppFormat(c)
+            data["controllers"].setdefault(c["controllerKey"], []).append(c)
+
+        return data
+
+    def parseControllerToAppFormat(self, controller: dict):
+        controller["on"] = controller["setting"].pop("on")
+        controller["manualControl"] = controller["setting"].pop(
+            "manualControl")
+        return self.parseEvalvSchedules(controller=controller)
+
+    def getGreenhouseDelta(self, greenhouseUID, since: int):
+        """
+        Return the devices of a greenhouse changed after version `since`, in the
+        format of `parseToAppFormat`. Return None when the client must reload the
+        whole document: a device was created or deleted, the greenhouse itself was
+        updated, or `since` is not a version of this greenhouse.
+
+        #### Return data format
+        ```
+        {
+            "version": 1290,
+            "full": False,
+            "realSensors": {"AirSensor_1": {...}},
+            "sensors": {"airTemp": [{"sensorKey": "airTemp", "realSensorID": "AirSensor_1", ...}]},
+            "controllers": {"fan": [{...}]},
+        }
+        ```
+        """
+        version, structureVersion = GreenhouseModel.objects.filter(
+            greenhouseUID=greenhouseUID).values_list("version", "structureVersion").get()
+
+        if since < structureVersion or since > version:
+            return None
+
+        data = {
+            "version": version,
+            "full": False,
+            "realSensors": {},
+            "sensors": {},
+            "controllers": {},
+        }
+        if since == version:
+            return data
+
+        realSensors = RealSensorModel.objects.filter(
+            greenhouse=greenhouseUID, changeVersion__gt=since).order_by("realSensorID").prefetch_related("sensors")
+        for realSensor in realSensors:
+            rS = RealSensorSerializer(realSensor).data
+            rS.pop("sensors")
+            rS["changeVersion"] = realSensor.changeVersion
+            data["realSensors"][rS["realSensorID"]] = rS
+
+        sensors = SensorModel.objects.filter(
+            realSensor__greenhouse=greenhouseUID, changeVersion__gt=since).select_related("realSensor").order_by("realSensor__realSensorID")
+        for sensor in sensors:
+            s = SensorSerializer(sensor).data
+            data["sensors"].setdefault(s["sensorKey"], []).append(s)
 
+        controllers = ControllerModel.objects.filter(
+            greenhouse=greenhouseUID, changeVersion__gt=since).prefetch_related("currentSetting__schedules").order_by("controllerID")
+        for controller in controllers:
+            c = self.parseControllerToAppFormat(
+                ControllerSerializer(controller).data)
             data["controllers"].setdefault(c["controllerKey"], []).append(c)
 
         return data
@@ -134,7 +340,11 @@ class AppControllerBaseAPI(AppBaseAPI):
 
 
 class RealSensorBaseAPI(GreenhouseBaseAPI):
-    def parseSensorFormat(self, sensorData: dict, realSensor=None):
+    def parseSensorFormat(self, sensorData: dict, greenhouseUID=None, realSensorID=None):
+        """
+        Parse the sensor map of a real sensor. When `realSensorID` is given, the id of
+        each sensor is resolved through the topology cache.
+        """
         parsedSensor = {}
 
         # extract timestamp
@@ -151,21 +361,18 @@ class RealSensorBaseAPI(GreenhouseBaseAPI):
 
         # parse sensor map format
         for sensorKey, value in sensorData.items():
-            try:
-
-                parsedSensor[sensorKey] = {
-                    "value": value,
-                    "timestamp": timestamp,
-                }
-
-                if realSensor:
-                    sensor = SensorModel.objects.get(
-                        realSensor=realSensor, sensorKey=sensorKey).id
-                    parsedSensor[sensorKey]['sensor'] = sensor
+            parsedSensor[sensorKey] = {
+                "value": value,
+                "timestamp": timestamp,
+            }
 
-            except SensorModel.DoesNotExist as e:
-                raise ValidationError(detail={
-                                      f"senosr with sensor key {sensorKey} not found in {realSensor.realSensorID}"})
+            if realSensorID:
+                sensor = topologyCache.getSensorID(
+                    greenhouseUID, realSensorID, sensorKey)
+                if sensor is None:
+                    raise ValidationError(detail={
+                                          f"senosr with sensor key {sensorKey} not found in {realSensorID}"})
+                parsedSensor[sensorKey]['sensor'] = sensor
 
         return parsedSensor
 
@@ -181,12 +388,9 @@ class RealSensorBaseAPI(GreenhouseBaseAPI):
                 address = rData.pop("address")
 
                 # get real sensor
-                try:
-                    realSensor = RealSensorModel.objects.get(
-                        greenhouse=greenhouseUID, realSensorID=rID)
-                except RealSensorModel.DoesNotExist:
+                realSensor = topologyCache.getRealSensorID(greenhouseUID, rID)
+                if realSensor is None:
                     print("realSensor not exist, default to create mode")
-                    realSensor = None
 
                 rData["greenhouse"] = greenhouseUID
                 rData["realSensorID"] = rID
@@ -195,7 +399,7 @@ class RealSensorBaseAPI(GreenhouseBaseAPI):
                 rData["lng"] = address["lng"]
 
                 rData["sensors"] = self.parseSensorFormat(
-                    rData["sensors"], realSensor)
+                    rData["sensors"], greenhouseUID, rID if realSensor else None)
 
                 rSensorList.append(rData)
 
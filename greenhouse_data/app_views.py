@@ -1,11 +1,20 @@
 from rest_framework.response import Response
 from rest_framework import status
+from rest_framework.permissions import IsAdminUser
+from django.conf import settings
 from django.core import exceptions
-from statistics import fmean
+from django.db import transaction
+
+from myapp.authentication import ownerCache, tokenCache
 
 from .models import *
 from .serializer import *
 from .api_base import *
+from .buffer import sensorWriteBuffer
+from .device_auth import deviceKeyCache, generateDeviceKey
+from .history import RollupHistoryEngine, SensorHistoryEngine
+from .pubsub import broker
+from .snapshot import snapshotCache
 
 
 class Greenhouse(GetGreenhouseBase):
@@ -179,19 +188,15 @@ class Greenhouse(GetGreenhouseBase):
         }
         """
         user = request.user  # instance ?
-        greenhouses = list(GreenhouseModel.objects.filter(owner=user))
-
-        resultList = []
+        versions = self.getGreenhouseVersions(
+            GreenhouseModel.objects.filter(owner=user))
 
-        for g in greenhouses:
-            gSer = GreenhouseSerializer(g)
-            retData = self.parseToAppFormat(gSer.data)
-            resultList.append(retData)
-
-        return Response(
-            resultList,
+        etag = self.getETag("greenhouses", user.id, *
+                            (f"{uid}:{version}" for uid, version in versions.items()))
+        return self.conditionalResponse(request, etag, lambda: Response(
+            self.getGreenhouseSnapshots(versions),
             status=status.HTTP_200_OK
-        )
+        ))
 
 
 class GreenhouseDetail(GetGreenhouseBase):
@@ -247,18 +252,144 @@ class GreenhouseDetail(GetGreenhouseBase):
     def get(self, req, greenhouseUID):
         """
         Get information for one specific greenhouse
+
+        #### Parameters
+        - since (optional): the "version" of the document held by the app. Only the
+          real sensors, sensors and controllers changed after it are returned, see
+          `getGreenhouseDelta`. The whole document is returned with "full": true when
+          the delta can not be computed.
         """
-        try:
-            greenhouse = GreenhouseModel.objects.get(
-                greenhouseUID=greenhouseUID)
+        since = req.query_params.get("since", None)
+        if since is not None:
+            try:
+                since = int(since)
+            except ValueError:
+                return Response({"error": "since should be an integer version"}, status=status.HTTP_400_BAD_REQUEST)
+
+        versions = self.getGreenhouseVersions(
+            GreenhouseModel.objects.filter(greenhouseUID=greenhouseUID))
+        if len(versions) == 0:
+            return Response({"error": "greenhouse does not exist"}, status=status.HTTP_404_NOT_FOUND)
 
-            ser = GreenhouseSerializer(greenhouse)
-            greenhouseData = self.parseToAppFormat(ser.data)
-            return Response(greenhouseData, status=status.HTTP_200_OK)
+        etag = self.getETag("greenhouse", greenhouseUID,
+                            *versions.values(), since)
+        return self.conditionalResponse(req, etag, lambda: self.getGreenhouseResponse(greenhouseUID, versions, since))
 
-        except GreenhouseModel.DoesNotExist:
+    def getGreenhouseResponse(self, greenhouseUID, versions: dict, since):
+        if since is not None:
+            try:
+                delta = self.getGreenhouseDelta(greenhouseUID, since)
+            except GreenhouseModel.DoesNotExist:
+                return Response({"error": "greenhouse does not exist"}, status=status.HTTP_404_NOT_FOUND)
+
+            if delta is not None:
+                return Response(delta, status=status.HTTP_200_OK)
+
+        snapshots = self.getGreenhouseSnapshots(versions)
+
+        if len(snapshots) == 0:
             return Response({"error": "greenhouse does not exist"}, status=status.HTTP_404_NOT_FOUND)
 
+        if since is not None:
+            return Response({**snapshots[0], "full": True}, status=status.HTTP_200_OK)
+        return Response(snapshots[0], status=status.HTTP_200_OK)
+
+
+class DeviceKey(AppBaseAPI):
+    """
+    API to provision, rotate or revoke the key signing the requests of the devices
+    of a greenhouse, see device_auth.py
+    """
+
+    def getGreenhouse(self, request, greenhouseUID):
+        greenhouse = GreenhouseModel.objects.get(greenhouseUID=greenhouseUID)
+        self.checkGreenhouseOwner(greenhouse, request.user)
+        return greenhouse
+
+    def get(self, request, greenhouseUID):
+        """
+        Return whether the greenhouse has a device key, and whether it was revoked.
+        The key itself is only returned when it is created.
+
+        #### Return data format
+        ```
+        {"provisioned": True, "revoked": False, "rotatedAt": "2024-05-01T00:00:00Z"}
+        ```
+        """
+        try:
+            greenhouse = self.getGreenhouse(request, greenhouseUID)
+            deviceKey = DeviceKeyModel.objects.filter(
+                greenhouse=greenhouse).first()
+            return Response(
+                {
+                    "provisioned": deviceKey is not None and deviceKey.key is not None,
+                    "revoked": deviceKey is not None and deviceKey.key is None,
+                    "rotatedAt": None if deviceKey is None else deviceKey.rotatedAt,
+                },
+                status=status.HTTP_200_OK,
+            )
+
+        except (GreenhouseModel.DoesNotExist, exceptions.ValidationError):
+            return Response({"message": "greenhouse not found"}, status=status.HTTP_404_NOT_FOUND)
+        except PermissionError:
+            return Response({"error": "not permitted to get greenhouse"}, status=status.HTTP_403_FORBIDDEN)
+
+    def post(self, request, greenhouseUID):
+        """
+        Create the device key of the greenhouse, or rotate it. After a rotation the
+        previous key is still accepted for GREENHOUSE_DEVICE_AUTH["ROTATION_GRACE"]
+        seconds, so the devices can be updated. From then on, the unsigned requests
+        of the greenhouse are rejected.
+
+        - method: POST
+        - authentication: "Authorization"" "Token <token>"
+
+        #### Return data format
+        ```
+        {"deviceKey": "5f0c...", "rotatedAt": "2024-05-01T00:00:00Z"}
+        ```
+        """
+        try:
+            greenhouse = self.getGreenhouse(request, greenhouseUID)
+            with transaction.atomic():
+                deviceKey = DeviceKeyModel.objects.select_for_update().filter(
+                    greenhouse=greenhouse).first()
+                if deviceKey is None:
+                    deviceKey = DeviceKeyModel(greenhouse=greenhouse)
+                else:
+                    deviceKey.previousKey = deviceKey.key
+                deviceKey.key = generateDeviceKey()
+                deviceKey.save()
+
+            return Response(
+                {"deviceKey": deviceKey.key, "rotatedAt": deviceKey.rotatedAt},
+                status=status.HTTP_201_CREATED,
+            )
+
+        except (GreenhouseModel.DoesNotExist, exceptions.ValidationError):
+            return Response({"message": "greenhouse not found"}, status=status.HTTP_404_NOT_FOUND)
+        except PermissionError:
+            return Response({"error": "not permitted to get greenhouse"}, status=status.HTTP_403_FORBIDDEN)
+
+    def delete(self, request, greenhouseUID):
+        """
+        Revoke the device key. Every request of the greenhouse, signed or not, is
+        rejected afterwards, until a new key is created.
+        """
+        try:
+            greenhouse = self.getGreenhouse(request, greenhouseUID)
+            # saved one by one, so the signals invalidate the cached keys
+            for deviceKey in DeviceKeyModel.objects.filter(greenhouse=greenhouse):
+                deviceKey.key = None
+                deviceKey.previousKey = None
+                deviceKey.save()
+            return Response({"message": "device key is revoked"}, status=status.HTTP_200_OK)
+
+        except (GreenhouseModel.DoesNotExist, exceptions.ValidationError):
+            return Response({"message": "greenhouse not found"}, status=status.HTTP_404_NOT_FOUND)
+        except PermissionError:
+            return Response({"error": "not permitted to get greenhouse"}, status=status.HTTP_403_FORBIDDEN)
+
 
 class Controller(AppControllerBaseAPI):
     """
@@ -274,16 +405,9 @@ class Controller(AppControllerBaseAPI):
 
             self.checkGreenhouseOwner(greenhouse, user)
 
-            ret = {}
-            controllers = list(
-                ControllerModel.objects.filter(greenhouse=greenhouse))
-
-            for controller in controllers:
-                controllerSer = ControllerSerializer(controller)
-                controllerID = controllerSer.data["controllerID"]
-                ret[controllerID] = controllerSer.data["setting"]
-
-            return Response(ret, status=status.HTTP_200_OK)
+            etag = self.getETag("app-controllers",
+                                greenhouseUID, greenhouse.version)
+            return self.conditionalResponse(request, etag, lambda: self.getControllersResponse(greenhouse))
 
         except GreenhouseModel.DoesNotExist:
             print("greenhouse does not exist")
@@ -292,6 +416,17 @@ class Controller(AppControllerBaseAPI):
             print("not permitted to get greenhouse")
             return Response({"error": "not permitted to get greenhouse"}, status=status.HTTP_403_FORBIDDEN)
 
+    def getControllersResponse(self, greenhouse):
+        ret = {}
+        controllers = list(ControllerModel.objects.filter(greenhouse=greenhouse).prefetch_related("currentSetting__schedules"))
+
+        for controller in controllers:
+            controllerSer = ControllerSerializer(controller)
+            controllerID = controllerSer.data["controllerID"]
+            ret[controllerID] = controllerSer.data["setting"]
+
+        return Response(ret, status=status.HTTP_200_OK)
+
     def put(self, req, greenhouseUID):
         """
         Update the corresponding controller setting
@@ -496,7 +631,6 @@ class RealSensorAPI(AppBaseAPI):
 
     def delete(self, request, greenhouseUID, realSensorID):
         user = request.user
-        payload = request.data
 
         try:
             greenhouse = GreenhouseModel.objects.get(
@@ -548,47 +682,21 @@ class SensorAPI(AppBaseAPI):
 
         return unitScale
 
-    def hourly(self, startTime: datetime, endTime: datetime, delta=datetime.timedelta(hours=1)):
-        currentTime = startTime
-        while currentTime <= endTime and currentTime < datetime.datetime.now():
-            yield currentTime
-            currentTime += delta
-
-    def findHourlyData(self, historyInstances, startTime: datetime, endTime: datetime):
-        hourlyData = []
-        lastData = None
-        broken = False
+    def getHistoryResponse(self, historyEngine, startTime: datetime.datetime, endTime: datetime.datetime, unitScale: int):
+        historyDatas = historyEngine.getHistoryDatas(
+            startTime, endTime, unitScale)
 
-        for t in self.hourly(startTime=startTime, endTime=endTime):
-            timeInstance = list(historyInstances.filter(
-                timestamp__range=[
-                    t-datetime.timedelta(minutes=15),
-                    t+datetime.timedelta(minutes=15),
-                ]
-            ))
+        if len(historyDatas) == 0:
+            return Response({"message": "no history found"}, status=status.HTTP_204_NO_CONTENT)
 
-            if len(timeInstance) > 0:
-                hourlyData.append(timeInstance[0].value)
-                lastData = hourlyData[-1]
-                continue
-
-            if lastData:
-                hourlyData.append(lastData)
-                lastData = hourlyData[-1]
-                continue
-
-            broken = True
-            break
-
-        if broken:
-            t = t+datetime.timedelta(hours=1)
-            nextDatas = self.findHourlyData(historyInstances, t, endTime)
-            hourlyData += [nextDatas[0]]
-            hourlyData += nextDatas
-
-        return hourlyData
-
-    # UNDONE: not fully implemented
+        return Response(
+            {
+                "historyDatas": historyDatas,
+                "initialTime": startTime.isoformat(),
+                "unitScale": unitScale,
+            },
+            status=status.HTTP_200_OK,
+        )
 
     def get(self, request, greenhouseUID, realSensorID, sensorKey):
         """
@@ -598,6 +706,11 @@ class SensorAPI(AppBaseAPI):
         - authentication: "Authorization": "Token <token>"
         - return: list of history values, start date, unitScale, datelength
 
+        With the default GREENHOUSE_HISTORY_SOURCE = "raw", each value is the mean of
+        one sample per hour, the first reading within 15 minutes of the hour. With
+        "rollup", it is the mean of every reading of its unitScale bucket, read from
+        the hourly or daily rollups.
+
         #### Parameters
         - startTime: "YYYY-MM-DD HH:mm:ss"
         - endTime: "YYYY-MM-DD HH:mm:ss" 
@@ -624,54 +737,26 @@ class SensorAPI(AppBaseAPI):
             startTime = datetime.datetime.fromisoformat(startTime)
             endTime = datetime.datetime.fromisoformat(endTime)
 
-            # get history instances
-            greenhouse = GreenhouseModel.objects.get(
-                greenhouseUID=greenhouseUID)
-            self.checkGreenhouseOwner(greenhouse, user)
+            # get history instances, the owner check is served by the cache
+            self.checkGreenhouseOwner(greenhouseUID, user)
             realSensor = RealSensorModel.objects.get(
-                greenhouse=greenhouse,
+                greenhouse=greenhouseUID,
                 realSensorID=realSensorID,
             )
             sensor = SensorModel.objects.get(
                 realSensor=realSensor, sensorKey=sensorKey)
-            historyInstances = SensorValueHistoryModel.objects.filter(
-                sensor=sensor,
-                timestamp__range=[startTime, endTime],
-            )
 
-            if len(historyInstances) == 0:
-                return Response({"message": "no history found"}, status=status.HTTP_204_NO_CONTENT)
-
-            """
-            TODO: design an algorithm to acheive following goals
-            - find suitable unitScale for the timerange
-            - check if data exist in each hour
-            - replace missing data with the last element value in the list
-            - if we cannot find the existing data until the start of the list, try getting the next data instead
-            - if we still cannot find any existing data until the end of the list, return no_value respond 
-            """
-            historyDatas = []
+            # sample the raw history of each hour and average the hours, or average
+            # the rollups into unitScale buckets with the "rollup" history source
             unitScale = self.findUnitScale(startTime, endTime)
-            hourlyData = self.findHourlyData(
-                historyInstances, startTime, endTime)
-
-            i = 0
-            while i < len(hourlyData):
-                if (i + unitScale) <= len(hourlyData):
-                    historyDatas.append(fmean(hourlyData[i:i+unitScale]))
-                    i += unitScale
-                else:
-                    historyDatas.append(fmean(hourlyData[i:]))
-                    break
+            historyEngine = RollupHistoryEngine if settings.GREENHOUSE_HISTORY_SOURCE == "rollup" else SensorHistoryEngine
+            historyEngine = historyEngine(sensor)
 
-            return Response(
-                {
-                    "historyDatas": historyDatas,
-                    "initialTime": startTime.isoformat(),
-                    "unitScale": unitScale,
-                },
-                status=status.HTTP_200_OK,
-            )
+            etag = self.getETag(
+                "sensor", sensor.id, historyEngine.__class__.__name__, startTime, endTime, unitScale,
+                *historyEngine.getHistoryVersion(startTime, endTime, unitScale))
+            return self.conditionalResponse(request, etag, lambda: self.getHistoryResponse(
+                historyEngine, startTime, endTime, unitScale))
 
         except GreenhouseModel.DoesNotExist:
             print(f"greenhouse {greenhouseUID} not found")
@@ -685,3 +770,78 @@ class SensorAPI(AppBaseAPI):
         except PermissionError:
             print("not permitted to get greenhouse")
             return Response({"error": "not permitted to get greenhouse"}, status=status.HTTP_403_FORBIDDEN)
+
+
+class Metrics(AppBaseAPI):
+    """
+    API for administrators to monitor the in-process caches of the server
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        """
+        #### Return data format
+        ```
+        {
+            "topologyCache": {
+                "size": 120,
+                "maxSize": 4096,
+                "hits": 35120,
+                "misses": 120,
+                "evictions": 0
+            },
+            "snapshotCache": {
+                "size": 35,
+                "maxSize": 1024,
+                "hits": 8120,
+                "misses": 70,
+                "evictions": 0
+            },
+            "pubsub": {
+                "backend": "LocalBroker",
+                "channels": 24,
+                "subscriptions": 40,
+                "published": 52000,
+                "delivered": 61000
+            },
+            "writeBuffer": {
+                "queued": 0,
+                "maxQueue": 10000,
+                "flushSize": 500,
+                "flushInterval": 1000,
+                "enqueued": 52000,
+                "flushed": 52000,
+                "batches": 180,
+                "overflows": 0,
+                "failed": 0, # failed batch writes, retried
+                "retried": 0, # readings written again after a failure
+                "dropped": 0, # readings given up after MAX_RETRIES retries
+                "lastError": None,
+                "lastFlushDuration": 0.021
+            },
+            "tokenCache": {
+                "size": 80,
+                "maxSize": 4096,
+                "hits": 23000,
+                "misses": 95,
+                "evictions": 0,
+                "ttl": 300,
+                "expirations": 15
+            },
+            "ownerCache": {...}, # same format as tokenCache
+            "deviceKeyCache": {...} # same format as tokenCache
+        }
+        ```
+        """
+        return Response(
+            {
+                "topologyCache": topologyCache.stats(),
+                "snapshotCache": snapshotCache.stats(),
+                "pubsub": broker.stats(),
+                "writeBuffer": sensorWriteBuffer.stats(),
+                "tokenCache": tokenCache.stats(),
+                "ownerCache": ownerCache.stats(),
+                "deviceKeyCache": deviceKeyCache.stats(),
+            },
+            status=status.HTTP_200_OK,
+        )
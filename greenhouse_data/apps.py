@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class GreenhouseDataConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'greenhouse_data'
+
+    def ready(self):
+        from . import signals, sqlite
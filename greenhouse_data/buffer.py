@@ -0,0 +1,191 @@
+"""
+Write-behind buffer for sensor readings. When `GREENHOUSE_INGEST_MODE` is
+"buffered", gh/real-sensor PUT appends its validated readings here and returns
+right away. A background thread writes the queued readings in batches with
+`bulkCreateSensorValues`, so many requests share one transaction.
+
+A batch whose write fails is retried `maxRetries` times, `retryDelay` milliseconds
+apart, before its readings are dropped. The failed writes and the dropped readings
+are counted in `stats()`, see app/metrics.
+"""
+import atexit
+import logging
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+
+from .ingest import bulkCreateSensorValues
+
+logger = logging.getLogger(__name__)
+
+
+class SensorWriteBuffer:
+    """
+    Bounded queue of validated sensor readings flushed by a background thread every
+    `flushInterval` milliseconds or as soon as `flushSize` readings are queued.
+    `stop()` drains the queue before returning and is registered with `atexit`.
+    """
+
+    def __init__(self, flushSize: int = 500, flushInterval: int = 1000, maxQueue: int = 10000, maxRetries: int = 3, retryDelay: int = 1000):
+        self.flushSize = flushSize
+        self.flushInterval = flushInterval
+        self.maxQueue = maxQueue
+        self.maxRetries = maxRetries
+        self.retryDelay = retryDelay
+
+        self.enqueued = 0
+        self.flushed = 0
+        self.batches = 0
+        self.overflows = 0
+        self.failed = 0
+        self.retried = 0
+        self.dropped = 0
+        self.lastError = None
+        self.lastFlushDuration = None
+
+        self._queue = deque()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopping = False
+
+    def start(self):
+        with self._condition:
+            if self._thread is not None and self._thread.is_alive():
+                return
+
+            self._stopping = False
+            self._thread = threading.Thread(
+                target=self._run, name="SensorWriteBuffer", daemon=True)
+            self._thread.start()
+
+    def append(self, sensorValues: list):
+        """
+        Queue the readings of one request. Return False without queueing anything
+        when they do not fit in the queue, so the caller can write them directly.
+        """
+        self.start()
+
+        with self._condition:
+            if len(self._queue) + len(sensorValues) > self.maxQueue:
+                self.overflows += 1
+                return False
+
+            self._queue.extend(sensorValues)
+            self.enqueued += len(sensorValues)
+            if len(self._queue) >= self.flushSize:
+                self._condition.notify()
+
+        return True
+
+    def stop(self):
+        """ Stop the flusher thread after writing everything still queued """
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+            thread = self._thread
+
+        if thread is not None:
+            thread.join()
+
+    def _takeBatch(self):
+        with self._condition:
+            deadline = time.monotonic() + self.flushInterval / 1000
+            while not self._stopping and len(self._queue) < self.flushSize:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+
+            size = min(len(self._queue), self.flushSize)
+            return [self._queue.popleft() for _ in range(size)]
+
+    def _write(self, batch: list):
+        """ Write one batch, return False when it failed """
+        startTime = time.monotonic()
+        try:
+            close_old_connections()
+            bulkCreateSensorValues(batch)
+            self.flushed += len(batch)
+            return True
+        except Exception as e:
+            logger.warning("failed to flush %d sensor readings: %s", len(batch), e)
+            self.failed += 1
+            self.lastError = str(e)
+            return False
+        finally:
+            self.batches += 1
+            self.lastFlushDuration = time.monotonic() - startTime
+
+    def _waitBeforeRetry(self):
+        """ Wait `retryDelay` milliseconds, or less when the buffer is stopping """
+        deadline = time.monotonic() + self.retryDelay / 1000
+        with self._condition:
+            # woken up as well by the requests filling the queue
+            while not self._stopping:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+
+    def _writeWithRetries(self, batch: list):
+        for attempt in range(self.maxRetries + 1):
+            if attempt != 0:
+                self._waitBeforeRetry()
+                self.retried += len(batch)
+                # the connection may be broken, get a new one
+                connection.close()
+
+            if self._write(batch):
+                return
+
+        logger.error("dropped %d sensor readings after %d retries: %s",
+                     len(batch), self.maxRetries, self.lastError)
+        self.dropped += len(batch)
+
+    def _run(self):
+        try:
+            while True:
+                batch = self._takeBatch()
+                if batch:
+                    self._writeWithRetries(batch)
+                    continue
+
+                with self._condition:
+                    if self._stopping and len(self._queue) == 0:
+                        return
+        finally:
+            connection.close()
+
+    def stats(self):
+        with self._condition:
+            queued = len(self._queue)
+
+        return {
+            "queued": queued,
+            "maxQueue": self.maxQueue,
+            "flushSize": self.flushSize,
+            "flushInterval": self.flushInterval,
+            "enqueued": self.enqueued,
+            "flushed": self.flushed,
+            "batches": self.batches,
+            "overflows": self.overflows,
+            "failed": self.failed,
+            "retried": self.retried,
+            "dropped": self.dropped,
+            "lastError": self.lastError,
+            "lastFlushDuration": self.lastFlushDuration,
+        }
+
+
+bufferSettings = getattr(settings, "GREENHOUSE_WRITE_BUFFER", {})
+sensorWriteBuffer = SensorWriteBuffer(
+    flushSize=bufferSettings.get("FLUSH_SIZE", 500),
+    flushInterval=bufferSettings.get("FLUSH_INTERVAL_MS", 1000),
+    maxQueue=bufferSettings.get("MAX_QUEUE", 10000),
+    maxRetries=bufferSettings.get("MAX_RETRIES", 3),
+    retryDelay=bufferSettings.get("RETRY_DELAY_MS", 1000),
+)
+atexit.register(sensorWriteBuffer.stop)
@@ -0,0 +1,212 @@
+"""
+Signed requests of the greenhouse devices on the gh/ endpoints. Each greenhouse can
+be given a device key from the app (`app/greenhouse/<greenhouseUID>/device-key`).
+A device signs every request with it:
+
+#### Request headers
+```
+X-Greenhouse-Timestamp: 1714521600 # unix time in seconds
+X-Greenhouse-Nonce: 9f2c51d0a4e8b713 # optional, any string
+X-Greenhouse-Signature: hex(HMAC-SHA256(deviceKey, "<timestamp>\\n<METHOD>\\n<path>\\n<hex sha256 of the body>[\\n<nonce>]"))
+```
+
+The keys are kept in an in-process cache, so a signature is checked without any
+query on the ingest path. A key rotated by another process is loaded when a
+signature does not match the cached keys, at most once every
+GREENHOUSE_DEVICE_AUTH["RELOAD_INTERVAL"] seconds per greenhouse, and the previous
+key stays valid for GREENHOUSE_DEVICE_AUTH["ROTATION_GRACE"] seconds after a
+rotation.
+
+Once a greenhouse has a device key, all its requests must be signed with it, and
+after the key is revoked all its requests are rejected until a new key is created.
+Another process sees a new or revoked key within GREENHOUSE_DEVICE_AUTH["CACHE_TTL"]
+seconds. The greenhouses without a key accept unsigned requests unless
+GREENHOUSE_DEVICE_AUTH["ENFORCE"] is set, so the devices can be moved to signed
+requests one greenhouse at a time.
+
+The signatures of the POST, PUT, PATCH and DELETE requests are remembered for twice
+GREENHOUSE_DEVICE_AUTH["MAX_SKEW"] in the NONCE_CACHE entry of CACHES, and a
+request repeating one is rejected as a replay. Set a different nonce to send the
+same request twice within a second. The cache must be shared when several
+processes serve the devices, otherwise a request can be replayed to another
+process. The GET requests only read, they are not checked for replays.
+"""
+import datetime
+import hashlib
+import hmac
+import secrets
+import time
+
+from django.conf import settings
+from django.core import exceptions
+from django.core.cache import caches
+from django.utils import timezone
+
+from .models import *
+from .utils import TTLCache
+
+TIMESTAMP_HEADER = "X-Greenhouse-Timestamp"
+SIGNATURE_HEADER = "X-Greenhouse-Signature"
+NONCE_HEADER = "X-Greenhouse-Nonce"
+# set by the clients of the streaming endpoints, see `RealSensorStreamAPI`
+CONTENT_HASH_HEADER = "X-Greenhouse-Content-SHA256"
+
+EMPTY_BODY_DIGEST = hashlib.sha256(b"").hexdigest()
+
+
+def generateDeviceKey():
+    return secrets.token_hex(32)
+
+
+def bodyDigest(body: bytes):
+    return hashlib.sha256(body).hexdigest()
+
+
+def signRequest(key: str, timestamp, method: str, path: str, digest: str, nonce: str = None):
+    message = f"{timestamp}\n{method.upper()}\n{path}\n{digest}"
+    if nonce is not None:
+        message += f"\n{nonce}"
+    return hmac.new(key.encode(), message.encode(), hashlib.sha256).hexdigest()
+
+
+class DeviceKeyCache:
+    """
+    Map each greenhouse to the keys its devices may sign with. Greenhouses without
+    a key are cached as well, so unsigned requests are not a query either.
+    """
+
+    def __init__(self, maxSize: int = 4096, ttl: float = 300, reloadInterval: float = 10):
+        self.cache = TTLCache(maxSize=maxSize, ttl=ttl)
+        # greenhouses reloaded after a signature mismatch, not reloaded again before
+        # `reloadInterval` seconds
+        self.reloaded = TTLCache(maxSize=maxSize, ttl=reloadInterval)
+
+    def loadKeys(self, greenhouseUID):
+        deviceKey = DeviceKeyModel.objects.filter(
+            greenhouse=greenhouseUID).first()
+        if deviceKey is None:
+            return ()
+
+        grace = datetime.timedelta(
+            seconds=settings.GREENHOUSE_DEVICE_AUTH["ROTATION_GRACE"])
+        return (deviceKey.key, deviceKey.previousKey, deviceKey.rotatedAt + grace)
+
+    def getKeys(self, greenhouseUID, reload: bool = False):
+        """
+        The keys accepted now, the current one first. None when the greenhouse has
+        no device key, an empty list when its key is revoked.
+        """
+        keys = None if reload else self.cache.get(str(greenhouseUID))
+        if keys is None:
+            keys = self.loadKeys(greenhouseUID)
+            self.cache.set(str(greenhouseUID), keys)
+
+        if len(keys) == 0:
+            return None
+
+        key, previousKey, previousValidUntil = keys
+        if key is None:
+            return []
+        if previousKey is not None and timezone.now() < previousValidUntil:
+            return [key, previousKey]
+        return [key]
+
+    def reloadKeys(self, greenhouseUID):
+        """
+        `getKeys` from the database, or None when the keys of the greenhouse were
+        reloaded less than `reloadInterval` seconds ago
+        """
+        if self.reloaded.get(str(greenhouseUID), False):
+            return None
+
+        self.reloaded.set(str(greenhouseUID), True)
+        return self.getKeys(greenhouseUID, reload=True)
+
+    def invalidate(self, greenhouseUID):
+        self.cache.pop(str(greenhouseUID))
+        self.reloaded.pop(str(greenhouseUID))
+
+    def clear(self):
+        self.cache.clear()
+        self.reloaded.clear()
+
+    def stats(self):
+        return self.cache.stats()
+
+
+def isSignatureValid(greenhouseUID, timestamp, signature: str, method: str, path: str, digest: str, nonce: str = None):
+    def matches(keys):
+        return any(
+            hmac.compare_digest(signRequest(
+                key, timestamp, method, path, digest, nonce), signature)
+            for key in keys or []
+        )
+
+    try:
+        if matches(deviceKeyCache.getKeys(greenhouseUID)):
+            return True
+        # the key may have been rotated by another process
+        return matches(deviceKeyCache.reloadKeys(greenhouseUID))
+    except exceptions.ValidationError:
+        # not a uuid
+        return False
+
+
+def isReplay(signature: str, method: str):
+    """ Remember the signature of a write, return True when it was already seen """
+    if method.upper() in ("GET", "HEAD", "OPTIONS"):
+        return False
+
+    config = settings.GREENHOUSE_DEVICE_AUTH
+    # a timestamp is accepted from MAX_SKEW seconds before to MAX_SKEW seconds after
+    return not caches[config["NONCE_CACHE"]].add(
+        f"greenhouse-device-signature:{signature}", True, 2 * config["MAX_SKEW"])
+
+
+def checkDeviceRequest(greenhouseUID, headers, method: str, path: str, getDigest):
+    """
+    Check the signature headers of a device request. `getDigest()` returns the hex
+    sha256 of the body, it is only called for signed requests.
+
+    Return None when the request is accepted, otherwise the reason of the rejection
+    """
+    signature = headers.get(SIGNATURE_HEADER, None)
+    if signature is None:
+        if settings.GREENHOUSE_DEVICE_AUTH["ENFORCE"]:
+            return "device signature is required"
+
+        try:
+            keys = deviceKeyCache.getKeys(greenhouseUID)
+        except exceptions.ValidationError:
+            # not a uuid, the view answers
+            return None
+        if keys is not None:
+            return "device signature is required"
+        return None
+
+    try:
+        timestamp = int(headers.get(TIMESTAMP_HEADER, ""))
+    except ValueError:
+        return f"{TIMESTAMP_HEADER} is not a unix timestamp"
+
+    if abs(time.time() - timestamp) > settings.GREENHOUSE_DEVICE_AUTH["MAX_SKEW"]:
+        return "device signature is expired"
+
+    signature = signature.lower()
+    digest = getDigest()
+    if digest is None or not isSignatureValid(greenhouseUID, timestamp, signature, method, path, digest, headers.get(NONCE_HEADER, None)):
+        return "invalid device signature"
+
+    if isReplay(signature, method):
+        return "replayed device request"
+
+    return None
+
+
+def createDeviceKeyCache():
+    config = settings.GREENHOUSE_DEVICE_AUTH
+    return DeviceKeyCache(
+        maxSize=config["CACHE_SIZE"], ttl=config["CACHE_TTL"], reloadInterval=config["RELOAD_INTERVAL"])
+
+
+deviceKeyCache = createDeviceKeyCache()
@@ -4,16 +4,34 @@ from rest_framework.response import Response
 from rest_framework.authtoken.models import Token
 from rest_framework.permissions import IsAuthenticated
 from rest_framework import status
-
+from django.conf import settings
+from django.core import exceptions
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DatabaseError
+from django.db.models import Max
+from django.http import HttpResponse, JsonResponse
+from django.views import View
+from asgiref.sync import sync_to_async
+
+from contextlib import nullcontext
 from datetime import datetime
+import asyncio
+import hashlib
+import hmac
+import json
 
 from .models import *
 from .serializer import *
 from .api_base import *
+from .buffer import sensorWriteBuffer
+from .device_auth import CONTENT_HASH_HEADER, EMPTY_BODY_DIGEST, SIGNATURE_HEADER, checkDeviceRequest
+from .ingest import bulkCreateSensorValues, bulkUpdateControllers
+from .pubsub import broker, controllerChannel
+from .routers import atomicWithHistory, setRollbackWithHistory
 
 """
 TODO:
-a2. implement websocket on getting controller update
+a2. implement websocket on getting controller update (done, see push.py)
 """
 
 
@@ -189,7 +207,12 @@ class RealSensorAPI(RealSensorBaseAPI):
 
     def put(self, request, greenhouseUID):
         """
-        Update the corresponding sensor value from the request object
+        Update the corresponding sensor value from the request object. The readings of
+        all real sensors are validated as one batch and written in one transaction with
+        a single `isCurrent` update and a single bulk insert.
+
+        When `GREENHOUSE_INGEST_MODE` is "buffered", the readings are queued in the write
+        buffer and the request returns 202. They are written directly if the queue is full.
 
         #### Request format
         ```
@@ -229,6 +252,11 @@ class RealSensorAPI(RealSensorBaseAPI):
             if not sensorValueSer.is_valid():
                 raise ValidationError(sensorValueSer.errors)
 
+            if getattr(settings, "GREENHOUSE_INGEST_MODE", "direct") == "buffered":
+                if sensorWriteBuffer.append(sensorValueSer.validated_data):
+                    return Response({"message": "sensor history queued"}, status=status.HTTP_202_ACCEPTED)
+                print("write buffer is full, write sensor history directly")
+
             sensorValueSer.save()
 
             return Response({"message": "sensor history updated"}, status=status.HTTP_200_OK)
@@ -246,6 +274,135 @@ class RealSensorAPI(RealSensorBaseAPI):
             return Response({"message": e.detail}, status=status.HTTP_400_BAD_REQUEST)
 
 
+class RealSensorStreamAPI(RealSensorBaseAPI):
+
+    def getBodyDigest(self, request):
+        # the body is not read before the view, the client signs the digest it
+        # announces and the view checks it while reading
+        digest = request.headers.get(CONTENT_HASH_HEADER, None)
+        return None if digest is None else digest.lower()
+
+    def parseStreamLine(self, line: bytes, greenhouseUID: str):
+        """
+        Parse one line of the stream into sensor history data. The line has the same
+        format as the request body of `RealSensorAPI.put`.
+        """
+        try:
+            data = json.loads(line)
+            assert isinstance(data, dict)
+        except (ValueError, AssertionError):
+            raise ValidationError(detail={"line is not a json map"})
+
+        sensorDatas = []
+        for realSensorData in self.parseRealSensorFormat(data, greenhouseUID=greenhouseUID):
+            for sensorKey, sensorValueData in realSensorData["sensors"].items():
+                if sensorValueData.setdefault("sensor", None) is None:
+                    raise ValidationError(
+                        detail={f"real sensor {realSensorData['realSensorID']} not found"})
+                sensorDatas.append(sensorValueData)
+
+        return sensorDatas
+
+    def put(self, request, greenhouseUID):
+        """
+        Update sensor values from newline-delimited json. Each line has the same format
+        as the request body of `RealSensorAPI.put`, so a gateway can replay its buffered
+        readings in one request. The body is read line by line and the valid lines are
+        written every `GREENHOUSE_STREAM_CHUNK_SIZE` readings. Invalid lines are skipped
+        and reported with their line number, and so are the lines of a chunk the
+        database failed to write.
+
+        A signed request also sends the sha256 of its body in X-Greenhouse-Content-SHA256
+        (see device_auth.py). Its chunks are then committed together, once the body read
+        matches the digest, and nothing is written when it does not.
+
+        - method: PUT
+        - content type: application/x-ndjson
+
+        #### Request format
+        ```
+        {"AirSensor_1": {"address": {"lat": 24.112, "lng": 47.330}, "sensors": {"airTemp": 33, "timestamp": "2024-04-18 17:00:00"}}}
+        {"AirSensor_1": {"address": {"lat": 24.112, "lng": 47.330}, "sensors": {"airTemp": 32, "timestamp": "2024-04-18 18:00:00"}}}
+        ```
+
+        #### Return format
+        ```
+        {
+            "accepted": 1,
+            "rejected": 1,
+            "errors": {
+                "2": ["timestamp is not included in sensors field"]
+            }
+        }
+        ```
+        """
+        if request.stream is None:
+            return Response({"message": "request body is empty"}, status=status.HTTP_400_BAD_REQUEST)
+
+        chunkSize = getattr(settings, "GREENHOUSE_STREAM_CHUNK_SIZE", 1000)
+        # sensors loaded by earlier lines are shared with the later ones
+        context = {"sensors": {}}
+        accepted = 0
+        errors = {}
+
+        chunk = []
+        chunkLines = []
+
+        def writeChunk():
+            nonlocal accepted
+            try:
+                bulkCreateSensorValues(chunk)
+                accepted += len(chunkLines)
+            except (DatabaseError, ValidationError) as e:
+                # the chunk is rolled back, its lines are rejected with the error
+                for lineNo in chunkLines:
+                    errors[lineNo] = [f"failed to write sensor history: {e}"]
+            chunk.clear()
+            chunkLines.clear()
+
+        signedDigest = None
+        if SIGNATURE_HEADER in request.headers:
+            signedDigest = self.getBodyDigest(request)
+        hasher = hashlib.sha256()
+
+        with atomicWithHistory() if signedDigest is not None else nullcontext():
+            for lineNo, line in enumerate(request.stream, start=1):
+                hasher.update(line)
+                if not line.strip():
+                    continue
+
+                try:
+                    sensorValueSer = SensorValueHistorySerializer(
+                        data=self.parseStreamLine(line, greenhouseUID), many=True, context=context)
+                    if not sensorValueSer.is_valid():
+                        raise ValidationError(sensorValueSer.errors)
+
+                except ValidationError as e:
+                    errors[lineNo] = e.detail
+                    continue
+
+                chunk.extend(sensorValueSer.validated_data)
+                chunkLines.append(lineNo)
+                if len(chunk) >= chunkSize:
+                    writeChunk()
+
+            if chunk:
+                writeChunk()
+
+            if signedDigest is not None and not hmac.compare_digest(hasher.hexdigest(), signedDigest):
+                setRollbackWithHistory(True)
+                return Response({"message": "body does not match the signed digest"}, status=status.HTTP_401_UNAUTHORIZED)
+
+        return Response(
+            {
+                "accepted": accepted,
+                "rejected": len(errors),
+                "errors": errors,
+            },
+            status=status.HTTP_200_OK,
+        )
+
+
 class ControllerAPI(ControllerBaseAPI):
     def post(self, request, greenhouseUID):
         """
@@ -322,7 +479,10 @@ class ControllerAPI(ControllerBaseAPI):
 
     def put(self, req, greenhouseUID):
         """
-        Update the corresponding controller on/off state and electricity
+        Update the corresponding controller on/off state and electricity. The controllers
+        are loaded with one query, and the changed controller fields and the new settings
+        are written in one transaction with bulk queries. A setting equal to the current
+        one only updates its `lastSeen`.
 
         #### Request format
         ```
@@ -357,10 +517,22 @@ class ControllerAPI(ControllerBaseAPI):
             greenhouse = GreenhouseModel.objects.get(
                 greenhouseUID=greenhouseUID)
 
+            # all the controllers with their current setting, a fixed number of queries
+            controllers = {
+                controller.controllerID: controller
+                for controller in ControllerModel.objects.filter(
+                    greenhouse=greenhouse, controllerID__in=list(req.data.keys()),
+                ).prefetch_related("currentSetting__schedules")
+            }
+
             settingDataList = []
+            changedControllers = []
+            changedFields = set()
             for controllerID, controllerData in req.data.items():
-                controller = ControllerModel.objects.get(
-                    greenhouse=greenhouse, controllerID=controllerID)
+                controller = controllers.get(controllerID, None)
+                if controller is None:
+                    raise ControllerModel.DoesNotExist()
+
                 settingData = controllerData.pop("setting", None)
 
                 if not settingData:
@@ -371,27 +543,39 @@ class ControllerAPI(ControllerBaseAPI):
 
                 settingDataList.append(settingData)
 
-                controllerData["greenhouse"] = greenhouse.greenhouseUID
-                controllerData["controllerID"] = controllerID
+                # the greenhouse and the controllerID are given by the url
+                controllerData.pop("greenhouse", None)
+                controllerData.pop("controllerID", None)
 
                 controllerSer = ControllerSerializer(
                     controller, data=controllerData, partial=True)
 
-                if controllerSer.is_valid():
-                    controllerSer.save()
+                if not controllerSer.is_valid():
+                    print("invalid controller data", controllerSer.errors)
+                    return Response(controllerSer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+                fields = [
+                    field for field, value in controllerSer.validated_data.items()
+                    if getattr(controller, field) != value
+                ]
+                for field in fields:
+                    setattr(controller, field,
+                            controllerSer.validated_data[field])
+                if len(fields) != 0:
+                    changedControllers.append(controller)
+                    changedFields.update(fields)
 
             ser = ControllerSettingSerializer(
-                data=settingDataList, many=True)
-            if not controllerSer.is_valid():
-                print("invalid controller data", controllerSer.errors)
-                return Response(controllerSer.errors, status=status.HTTP_400_BAD_REQUEST)
+                data=settingDataList, many=True,
+                context={"controllers": {c.id: c for c in controllers.values()}})
 
             if not ser.is_valid():
                 print("invalid setting data", ser.errors)
                 return Response(ser.errors, status=status.HTTP_400_BAD_REQUEST)
 
-            controllerSer.save()
-            ser.save()
+            with atomicWithHistory():
+                bulkUpdateControllers(changedControllers, list(changedFields))
+                ser.save()
             return Response({"message": "controller updated"}, status=status.HTTP_200_OK)
 
         except GreenhouseModel.DoesNotExist:
@@ -402,6 +586,13 @@ class ControllerAPI(ControllerBaseAPI):
             print(f"controllerID {controllerID} not found")
             return Response({"message": f"controllerID {controllerID} not found"}, status=status.HTTP_404_NOT_FOUND)
 
+    def getControllersResponse(self, greenhouse):
+        allControllers = list(ControllerModel.objects.filter(greenhouse=greenhouse).prefetch_related("currentSetting__schedules"))
+
+        controllerData = self.parseToControllerFormat(allControllers)
+
+        return Response(controllerData, status=status.HTTP_200_OK)
+
     def get(self, request, greenhouseUID):
         """
         Return the setting of the specified controllers
@@ -451,13 +642,9 @@ class ControllerAPI(ControllerBaseAPI):
             greenhouse = GreenhouseModel.objects.get(
                 greenhouseUID=greenhouseUID)
 
-            allControllers = list(ControllerModel.objects.filter(
-                greenhouse=greenhouse
-            ))
-
-            controllerData = self.parseToControllerFormat(allControllers)
-
-            return Response(controllerData, status=status.HTTP_200_OK)
+            etag = self.getETag("gh-controllers",
+                                greenhouseUID, greenhouse.version)
+            return self.conditionalResponse(request, etag, lambda: self.getControllersResponse(greenhouse))
 
         except GreenhouseModel.DoesNotExist:
             print("Greenhouse not found")
@@ -466,3 +653,109 @@ class ControllerAPI(ControllerBaseAPI):
         except Exception as e:
             print(e)
             return Response({"message": "server error occurs"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class ControllerPollAPI(View):
+    """
+    Long-poll variant of `ControllerAPI.get`. It is an async Django view, so under
+    ASGI (e.g. `uvicorn myproject.asgi:application`) a waiting request holds no
+    worker thread. Under WSGI it still works but blocks a thread while waiting.
+    Setting changes are received through the controller channel of `pubsub.broker`.
+    """
+
+    def getSettingVersion(self, greenhouseUID):
+        """
+        The setting version of a greenhouse is the id of its latest controller setting
+        history record. Return None when the greenhouse does not exist.
+        """
+        try:
+            if not GreenhouseModel.objects.filter(greenhouseUID=greenhouseUID).exists():
+                return None
+        except exceptions.ValidationError:
+            return None
+
+        # the history may live on another database, no join with the controllers
+        controllerIDs = list(ControllerModel.objects.filter(
+            greenhouse=greenhouseUID).values_list("id", flat=True))
+        return ControllerSettingHistoryModel.objects.filter(
+            controller__in=controllerIDs).aggregate(settingVersion=Max("id"))["settingVersion"] or 0
+
+    def getControllerSettings(self, greenhouseUID):
+        controllers = ControllerModel.objects.filter(greenhouse=greenhouseUID).prefetch_related("currentSetting__schedules")
+        return ControllerBaseAPI().parseToControllerFormat(controllers)
+
+    async def get(self, request, greenhouseUID):
+        """
+        Return the settings of the controllers once a setting newer than `version`
+        is recorded for the greenhouse, or 204 when `timeout` expires first.
+
+        - method: GET
+        - return: the setting version and the controller settings in the format of
+          `ControllerAPI.get`
+
+        #### Parameters
+        - version: the last setting version seen by the controller, 0 at start up
+        - timeout (optional): seconds to wait, GREENHOUSE_LONG_POLL["TIMEOUT"] by default
+
+        #### Return data format
+        ```
+        {
+            "version": 1024,
+            "controllers": {
+                "fan_3": {
+                    "controllerKey": "fan",
+                    "setting": {"on": False, "manualControl": False, ...},
+                    ...
+                }
+            }
+        }
+        ```
+        """
+        pollSettings = settings.GREENHOUSE_LONG_POLL
+        try:
+            lastVersion = int(request.GET.get("version", 0))
+            timeout = min(float(request.GET.get(
+                "timeout", pollSettings["TIMEOUT"])), pollSettings["MAX_TIMEOUT"])
+        except ValueError:
+            return JsonResponse({"message": "version and timeout should be numbers"}, status=status.HTTP_400_BAD_REQUEST)
+
+        reason = await sync_to_async(checkDeviceRequest)(
+            greenhouseUID, request.headers, request.method, request.path, lambda: EMPTY_BODY_DIGEST)
+        if reason is not None:
+            return JsonResponse({"message": reason}, status=status.HTTP_401_UNAUTHORIZED)
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        # subscribed before the first check, so a change committed in between
+        # still wakes the request
+        subscription = broker.subscribe([controllerChannel(greenhouseUID)])
+
+        try:
+            while True:
+                # the check below sees every change published so far
+                subscription.drain()
+                version = await sync_to_async(self.getSettingVersion)(greenhouseUID)
+                if version is None:
+                    return JsonResponse({"message": "Parent greenhouse not found"}, status=status.HTTP_404_NOT_FOUND)
+
+                if version > lastVersion:
+                    controllerData = await sync_to_async(self.getControllerSettings)(greenhouseUID)
+                    return JsonResponse(
+                        {"version": version, "controllers": controllerData},
+                        encoder=DjangoJSONEncoder,
+                        status=status.HTTP_200_OK,
+                    )
+
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return HttpResponse(status=status.HTTP_204_NO_CONTENT)
+
+                # changes of other processes are found by the recheck when the
+                # broker is not shared
+                try:
+                    await subscription.get(min(remaining, pollSettings["RECHECK_INTERVAL"]))
+                except asyncio.TimeoutError:
+                    pass
+
+        finally:
+            subscription.close()
@@ -0,0 +1,206 @@
+"""
+History engines computing the chart data returned by `SensorAPI.get`
+"""
+import datetime
+from itertools import chain
+from statistics import fmean
+
+from django.db.models import Count, Max, Sum
+
+from django.utils import timezone
+
+from .models import *
+from .partitions import getHistoryPartitions
+from .rollups import dayBucket, hourBucket
+
+
+class SensorHistoryEngine:
+    """
+    Compute the history chart of a sensor with one indexed range scan per monthly
+    partition of the time range (see partitions.py). The value of
+    each hour is the first record within `sampleWindow` of the hour, missing hours
+    are filled with the last known value, and leading missing hours with the first
+    known value. The hourly values are then averaged into `unitScale`-hour buckets.
+    """
+
+    sampleWindow = datetime.timedelta(minutes=15)
+
+    def __init__(self, sensor):
+        self.sensor = sensor
+
+    def toAware(self, time: datetime.datetime):
+        if timezone.is_naive(time):
+            return timezone.make_aware(time)
+        return time
+
+    def hourly(self, startTime: datetime.datetime, endTime: datetime.datetime, delta=datetime.timedelta(hours=1)):
+        now = timezone.now()
+        currentTime = self.toAware(startTime)
+        endTime = self.toAware(endTime)
+        while currentTime <= endTime and currentTime < now:
+            yield currentTime
+            currentTime += delta
+
+    def fillGaps(self, hourlyData: list):
+        """
+        Replace missing values with the last value, or with the first value when
+        nothing has been found yet. Return an empty list when every value is missing.
+        """
+        firstData = next(
+            (value for value in hourlyData if value is not None), None)
+        if firstData is None:
+            return []
+
+        lastData = firstData
+        filledData = []
+        for value in hourlyData:
+            if value is not None:
+                lastData = value
+            filledData.append(lastData)
+
+        return filledData
+
+    def findHourlyData(self, startTime: datetime.datetime, endTime: datetime.datetime):
+        hours = list(self.hourly(startTime, endTime))
+        if len(hours) == 0:
+            return []
+
+        # records outside of the requested time range are not sampled
+        timeRange = [hours[0], min(hours[-1] + self.sampleWindow, self.toAware(endTime))]
+        records = chain.from_iterable(
+            model.objects.filter(
+                sensor_id=self.sensor.id,
+                timestamp__range=timeRange,
+            ).order_by("timestamp").values_list("timestamp", "value").iterator()
+            for model in getHistoryPartitions().models(*timeRange)
+        )
+
+        hourlyData = []
+        record = next(records, None)
+        for t in hours:
+            while record is not None and record[0] < t - self.sampleWindow:
+                record = next(records, None)
+
+            if record is not None and record[0] <= t + self.sampleWindow:
+                hourlyData.append(record[1])
+            else:
+                hourlyData.append(None)
+
+        return self.fillGaps(hourlyData)
+
+    def getHistoryVersion(self, startTime: datetime.datetime, endTime: datetime.datetime, unitScale: int):
+        """
+        Values changing whenever `getHistoryDatas` would return another result, read
+        with one aggregate query over the same rows
+        """
+        hours = list(self.hourly(startTime, endTime))
+        if len(hours) == 0:
+            return (0,)
+
+        timeRange = [hours[0], min(hours[-1] + self.sampleWindow, self.toAware(endTime))]
+        aggregates = [
+            model.objects.filter(
+                sensor_id=self.sensor.id,
+                timestamp__range=timeRange,
+            ).aggregate(lastTimestamp=Max("timestamp"), count=Count("id"), valueSum=Sum("value"))
+            for model in getHistoryPartitions().models(*timeRange)
+        ]
+
+        timestamps = [a["lastTimestamp"] for a in aggregates if a["lastTimestamp"] is not None]
+        return (
+            len(hours),
+            max(timestamps, default=None),
+            sum(a["count"] for a in aggregates),
+            sum(a["valueSum"] or 0 for a in aggregates),
+        )
+
+    def bucketMeans(self, hourlyData: list, unitScale: int):
+        return [
+            fmean(hourlyData[i:i+unitScale])
+            for i in range(0, len(hourlyData), unitScale)
+        ]
+
+    def getHistoryDatas(self, startTime: datetime.datetime, endTime: datetime.datetime, unitScale: int):
+        hourlyData = self.findHourlyData(startTime, endTime)
+        return self.bucketMeans(hourlyData, unitScale)
+
+
+class RollupHistoryEngine(SensorHistoryEngine):
+    """
+    Compute the history chart from the rollup tables instead of the raw history.
+    The coarsest rollup fitting `unitScale` is read: the daily rollup when the
+    buckets are whole UTC days, the hourly rollup otherwise. The value of a bucket
+    is the mean of every reading in it, and missing buckets are filled like the
+    hourly values of `SensorHistoryEngine`.
+    """
+
+    def getRollupRanges(self, hours: list, unitScale: int):
+        """
+        The (rollupModel, firstBucket, lastBucket) ranges covering the hour buckets
+        of `hours`. The last day is read from the hourly rollup unless it is
+        complete, the readings after the end time are not counted.
+        """
+        firstHour = hourBucket(hours[0])
+        lastHour = hourBucket(hours[-1])
+        if unitScale % 24 != 0 or hours[0] != dayBucket(hours[0]):
+            return [(SensorHourlyRollupModel, firstHour, lastHour)]
+
+        lastDay = dayBucket(lastHour + datetime.timedelta(hours=1))
+        ranges = []
+        if lastDay > firstHour:
+            ranges.append((SensorDailyRollupModel, firstHour, lastDay - datetime.timedelta(days=1)))
+        if lastDay <= lastHour:
+            ranges.append((SensorHourlyRollupModel, lastDay, lastHour))
+        return ranges
+
+    def getHistoryVersion(self, startTime: datetime.datetime, endTime: datetime.datetime, unitScale: int):
+        hours = list(self.hourly(startTime, endTime))
+        if len(hours) == 0:
+            return (0,)
+
+        aggregates = [
+            rollupModel.objects.filter(
+                sensor=self.sensor,
+                bucket__range=[firstBucket, lastBucket],
+            ).aggregate(lastTimestamp=Max("lastTimestamp"), count=Sum("count"), valueSum=Sum("valueSum"))
+            for rollupModel, firstBucket, lastBucket in self.getRollupRanges(hours, unitScale)
+        ]
+
+        timestamps = [a["lastTimestamp"] for a in aggregates if a["lastTimestamp"] is not None]
+        return (
+            len(hours),
+            max(timestamps, default=None),
+            sum(a["count"] or 0 for a in aggregates),
+            sum(a["valueSum"] or 0 for a in aggregates),
+        )
+
+    def getHistoryDatas(self, startTime: datetime.datetime, endTime: datetime.datetime, unitScale: int):
+        hours = list(self.hourly(startTime, endTime))
+        if len(hours) == 0:
+            return []
+
+        # the buckets start on the hour of the first sample, like the hours sampled
+        # by `SensorHistoryEngine`
+        origin = hourBucket(hours[0])
+        unit = datetime.timedelta(hours=unitScale)
+        bucketCount = (len(hours) + unitScale - 1) // unitScale
+
+        rollups = chain.from_iterable(
+            rollupModel.objects.filter(
+                sensor=self.sensor,
+                bucket__range=[firstBucket, lastBucket],
+            ).values_list("bucket", "count", "valueSum")
+            for rollupModel, firstBucket, lastBucket in self.getRollupRanges(hours, unitScale)
+        )
+
+        counts = [0] * bucketCount
+        sums = [0.0] * bucketCount
+        for bucket, count, valueSum in rollups:
+            i = (bucket - origin) // unit
+            counts[i] += count
+            sums[i] += valueSum
+
+        return self.fillGaps([
+            sums[i] / counts[i] if counts[i] > 0 else None
+            for i in range(bucketCount)
+        ])
@@ -0,0 +1,331 @@
+"""
+Set-based write helpers shared by the ingest endpoints. Each helper writes a
+whole batch with a fixed number of queries instead of one round trip per row.
+"""
+from django.db import transaction
+from rest_framework import serializers
+
+from .models import *
+from .partitions import getHistoryPartitions
+from .pubsub import publishSensorValues
+from .rollups import toUTC, updateSensorRollups
+from .routers import atomicWithHistory
+from .snapshot import bumpGreenhouseVersions, stampChangeVersions
+
+# rows per INSERT of `upsertSensorHistory`, 4 parameters each
+UPSERT_BATCH_SIZE = 1000
+
+
+def upsertSensorHistory(instances: list):
+    """
+    Upsert sensor history rows into their monthly partitions (see partitions.py),
+    and return the values of the rows they replaced as
+    `{(sensorID, timestamp): previousValue}`. The partitions of new months are
+    created first.
+
+    On PostgreSQL each batch is one INSERT ... ON CONFLICT DO UPDATE ... RETURNING.
+    The subquery of RETURNING reads the snapshot taken before the statement, so it
+    returns the replaced value, or NULL for a new row. The other databases read the
+    stored values first and upsert with `bulk_create`, one month table at a time.
+    """
+    partitions = getHistoryPartitions()
+    partitions.ensureMonths(instance.timestamp for instance in instances)
+    connection = partitions.connection
+    if connection.vendor != "postgresql":
+        previousValues = {}
+        for model, monthInstances in partitions.groupByModel(instances):
+            previousValues.update({
+                (sensor, toUTC(timestamp)): value
+                for sensor, timestamp, value in model.objects.filter(
+                    sensor_id__in={instance.sensor_id for instance in monthInstances},
+                    timestamp__in={instance.timestamp for instance in monthInstances},
+                ).values_list("sensor_id", "timestamp", "value")
+            })
+            model.objects.bulk_create(
+                monthInstances,
+                update_conflicts=True,
+                unique_fields=["sensor_id", "timestamp"],
+                update_fields=["value", "isCurrent"],
+            )
+        return previousValues
+
+    qn = connection.ops.quote_name
+    table = qn(SensorValueHistoryModel._meta.db_table)
+    columns = ", ".join(qn(c)
+                        for c in ["sensor_id", "timestamp", "value", "isCurrent"])
+    previousValues = {}
+    with connection.cursor() as cursor:
+        for start in range(0, len(instances), UPSERT_BATCH_SIZE):
+            batch = instances[start:start + UPSERT_BATCH_SIZE]
+            cursor.execute(
+                f"INSERT INTO {table} AS new ({columns}) "
+                f"VALUES {', '.join(['(%s, %s, %s, %s)'] * len(batch))} "
+                f"ON CONFLICT ({qn('sensor_id')}, {qn('timestamp')}) DO UPDATE SET "
+                f"{qn('value')} = EXCLUDED.{qn('value')}, {qn('isCurrent')} = EXCLUDED.{qn('isCurrent')} "
+                f"RETURNING new.{qn('sensor_id')}, new.{qn('timestamp')}, "
+                # the timestamp restricts the subquery to the partition of the row
+                f"(SELECT old.{qn('value')} FROM {table} AS old "
+                f"WHERE old.{qn('id')} = new.{qn('id')} AND old.{qn('timestamp')} = new.{qn('timestamp')})",
+                [
+                    param
+                    for instance in batch
+                    for param in (
+                        instance.sensor_id,
+                        connection.ops.adapt_datetimefield_value(
+                            instance.timestamp),
+                        instance.value,
+                        instance.isCurrent,
+                    )
+                ],
+            )
+            for sensor, timestamp, previousValue in cursor.fetchall():
+                if previousValue is not None:
+                    previousValues[(sensor, toUTC(timestamp))] = previousValue
+
+    return previousValues
+
+
+def bulkCreateSensorValues(sensorValues: list):
+    """
+    Insert a batch of sensor readings inside one transaction
+
+    - flip `isCurrent` of every affected sensor with a single UPDATE per month
+      holding a current record
+    - upsert all history rows with `upsertSensorHistory`. A reading with the same
+      (sensor, timestamp) as an existing record overwrites it, so replays of the
+      same report do not add records
+    - the latest reading of each sensor in the batch becomes the current one
+      unless the sensor already has a later one, and is copied to `currentValue` /
+      `currentTimestamp` with a single `bulk_update`. Late readings, e.g. replayed
+      by a gateway, are only added to the history
+    - the version of the affected greenhouses is bumped and copied to the
+      `changeVersion` of the sensors with one UPDATE each, which invalidates the
+      app snapshots and feeds the delta sync
+    - the new current values, and only them, are published to the push
+      subscribers on commit
+    - the hourly and daily rollups are updated with one upsert each. The values
+      replaced by the upsert are known, so replays adjust the rollups instead of
+      counting the reading twice, and the minimum and maximum of the buckets of a
+      replaced value are read again from the history
+
+    #### Input format
+    ```
+    [
+        {"sensor": sensorInstance, "value": 22, "timestamp": datetime},
+        {"sensor": sensorInstance, "value": 31, "timestamp": datetime},
+    ]
+    ```
+    """
+    if len(sensorValues) == 0:
+        return []
+
+    # readings repeated in the batch are written once, the last one wins
+    historyInstances = {}
+    latestInstances = {}
+    for sensorValue in sensorValues:
+        if sensorValue.get("sensor", None) is None:
+            raise serializers.ValidationError(
+                {"sensor instance is not provided"})
+
+        instance = SensorValueHistoryModel(
+            sensor=sensorValue["sensor"],
+            timestamp=sensorValue["timestamp"],
+            value=sensorValue["value"],
+            isCurrent=False,
+        )
+        historyInstances.pop((instance.sensor_id, instance.timestamp), None)
+        historyInstances[(instance.sensor_id, instance.timestamp)] = instance
+
+        # the reading with the highest timestamp, the last one on a tie
+        latest = latestInstances.get(instance.sensor_id, None)
+        if latest is None or toUTC(instance.timestamp) >= toUTC(latest.timestamp):
+            latestInstances[instance.sensor_id] = instance
+
+    with atomicWithHistory():
+        # the stored current timestamps, locked until the sensors are updated
+        storedTimestamps = dict(SensorModel.objects.select_for_update().filter(
+            id__in=latestInstances.keys()).values_list("id", "currentTimestamp"))
+        currentInstances = [
+            instance for instance in latestInstances.values()
+            if storedTimestamps.get(instance.sensor_id, None) is None
+            or toUTC(instance.timestamp) >= storedTimestamps[instance.sensor_id]
+        ]
+
+        sensors = []
+        for instance in currentInstances:
+            instance.isCurrent = True
+            instance.sensor.currentValue = instance.value
+            instance.sensor.currentTimestamp = instance.timestamp
+            sensors.append(instance.sensor)
+
+        getHistoryPartitions().clearCurrent(
+            [instance.sensor_id for instance in currentInstances])
+        previousValues = upsertSensorHistory(list(historyInstances.values()))
+        SensorModel.objects.bulk_update(
+            sensors, ["currentValue", "currentTimestamp"])
+        bumpGreenhouseVersions(realSensors__sensors__in=latestInstances.keys())
+        stampChangeVersions(SensorModel.objects.filter(
+            id__in=latestInstances.keys()), "realSensors", "realSensor")
+        publishSensorValues(currentInstances)
+        replacedTimestamps = [
+            timestamp for (_, timestamp) in previousValues.keys()]
+        updateSensorRollups(SensorHourlyRollupModel, SensorDailyRollupModel, [
+            (
+                instance.sensor_id,
+                instance.timestamp,
+                instance.value,
+                previousValues.get(
+                    (instance.sensor_id, toUTC(instance.timestamp)), None),
+            )
+            for instance in historyInstances.values()
+        ], historyModels=getHistoryPartitions().models(
+            min(replacedTimestamps), max(replacedTimestamps)) if replacedTimestamps else [])
+
+    return list(historyInstances.values())
+
+
+CONTROLLER_SETTING_FIELDS = ["on", "manualControl",
+                             "openTemp", "closeTemp", "cutHumidity"]
+
+
+def isSameSetting(setting, settingData: dict):
+    """
+    Check if a reported setting equals the stored `setting`, schedules included.
+    The timestamp is not compared.
+    """
+    if setting is None:
+        return False
+
+    for field in CONTROLLER_SETTING_FIELDS:
+        default = ControllerSettingHistoryModel._meta.get_field(
+            field).get_default()
+        if getattr(setting, field) != settingData.get(field, default):
+            return False
+
+    defaultStartTime = ScheduleModel._meta.get_field(
+        "startTime").get_default()
+    schedules = [
+        (s["duration"], s.get("startTime", defaultStartTime))
+        for s in settingData.get("schedules", None) or []
+    ]
+    # sorted by id, the prefetched schedules are used when there are some
+    return schedules == [
+        (s.duration, s.startTime)
+        for s in sorted(setting.schedules.all(), key=lambda s: s.id)
+    ]
+
+
+def bulkUpdateControllers(controllers: list, fields: list):
+    """
+    Write the changed `fields` of a batch of controllers with a single
+    `bulk_update`, and bump the version of their greenhouses
+    """
+    if len(controllers) == 0 or len(fields) == 0:
+        return
+
+    with transaction.atomic():
+        ControllerModel.objects.bulk_update(controllers, fields)
+        ids = [controller.id for controller in controllers]
+        bumpGreenhouseVersions(controllers__in=ids)
+        stampChangeVersions(ControllerModel.objects.filter(id__in=ids))
+
+
+def bulkCreateControllerSettings(settingDatas: list):
+    """
+    Write a batch of reported controller settings inside one transaction. The
+    controllers report their setting periodically, so only a setting that differs
+    from the current one of its controller is recorded.
+
+    - the unchanged reports only set `lastSeen` of the current settings with a
+      single `bulk_update`
+    - flip `isCurrent` of the changed controllers with a single UPDATE, insert the
+      new settings and their schedules with one `bulk_create` each, and point the
+      controllers to them with a single `bulk_update`
+    - the version of the affected greenhouses is bumped and copied to the
+      `changeVersion` of the controllers
+
+    Use `prefetch_related("currentSetting__schedules")` on the controllers to
+    compare the settings without a query per controller.
+
+    Return the current setting of each controller and the list of the new settings
+
+    #### Input format
+    ```
+    [
+        {
+            "controller": controllerInstance,
+            "timestamp": datetime,
+            "on": False,
+            "manualControl": False,
+            "cutHumidity": 30,
+            "schedules": [{"duration": timedelta, "startTime": time}]
+        },
+    ]
+    ```
+    """
+    if len(settingDatas) == 0:
+        return [], []
+
+    # settings repeated for the same controller in the batch, the last one wins
+    latestDatas = {}
+    for settingData in settingDatas:
+        if settingData.get("controller", None) is None:
+            raise serializers.ValidationError(
+                {"controller instance is not provided"})
+        latestDatas.pop(settingData["controller"].id, None)
+        latestDatas[settingData["controller"].id] = settingData
+
+    seenSettings = []
+    newSettings = []
+    newSchedules = []
+    for settingData in latestDatas.values():
+        controller = settingData["controller"]
+        currentSetting = controller.currentSetting
+        if isSameSetting(currentSetting, settingData):
+            currentSetting.lastSeen = settingData["timestamp"]
+            seenSettings.append(currentSetting)
+            continue
+
+        setting = ControllerSettingHistoryModel(
+            controller=controller,
+            timestamp=settingData["timestamp"],
+            isCurrent=True,
+            **{
+                field: settingData[field]
+                for field in CONTROLLER_SETTING_FIELDS if field in settingData
+            },
+        )
+        newSettings.append(setting)
+        for scheduleData in settingData.get("schedules", None) or []:
+            newSchedules.append((setting, scheduleData))
+
+    with atomicWithHistory():
+        ControllerSettingHistoryModel.objects.bulk_update(
+            seenSettings, ["lastSeen"])
+
+        if len(newSettings) != 0:
+            ControllerSettingHistoryModel.objects.filter(
+                controller__in=[setting.controller_id for setting in newSettings], isCurrent=True).update(isCurrent=False)
+            ControllerSettingHistoryModel.objects.bulk_create(newSettings)
+            ScheduleModel.objects.bulk_create([
+                ScheduleModel(
+                    controllerSetting=setting,
+                    duration=scheduleData["duration"],
+                    **({"startTime": scheduleData["startTime"]} if "startTime" in scheduleData else {}),
+                )
+                for setting, scheduleData in newSchedules
+            ])
+
+            controllers = []
+            for setting in newSettings:
+                setting.controller.currentSetting = setting
+                controllers.append(setting.controller)
+            ControllerModel.objects.bulk_update(
+                controllers, ["currentSetting"])
+
+        # lastSeen is part of the app documents as well
+        bumpGreenhouseVersions(controllers__in=latestDatas.keys())
+        stampChangeVersions(ControllerModel.objects.filter(
+            id__in=latestDatas.keys()))
+
+    return [data["controller"].currentSetting for data in latestDatas.values()], newSettings
@@ -0,0 +1,198 @@
+"""
+Database maintenance jobs shared by the management commands and the data migrations.
+The models are passed in as parameters so the migrations can use their historical
+models.
+"""
+import copy
+from itertools import chain
+
+from django.core.management.color import no_style
+from django.db import connections, router, transaction
+from django.db.models import Count, Max, Q
+
+from .rollups import aggregateReadings, dayBucket, hourBucket, upsertRollups
+
+
+def dedupeSensorHistory(SensorModel, SensorValueHistoryModel, sensorsPerChunk: int = 100, log=print, historyModels: list = None):
+    """
+    Remove sensor history records sharing the same (sensor, timestamp), keeping the
+    latest written one. The kept record is marked current when any of its duplicates
+    was current. Sensors are processed `sensorsPerChunk` at a time, each chunk in its
+    own transaction. `historyModels` are the monthly partitions to clean (see
+    partitions.py), only `SensorValueHistoryModel` by default. Return the number of
+    deleted records.
+    """
+    if historyModels is None:
+        historyModels = [SensorValueHistoryModel]
+
+    sensorIDs = list(SensorModel.objects.order_by(
+        "id").values_list("id", flat=True))
+    deletedCount = 0
+
+    for i in range(0, len(sensorIDs), sensorsPerChunk):
+        chunk = sensorIDs[i:i+sensorsPerChunk]
+        chunkCount = 0
+
+        with transaction.atomic(using=router.db_for_write(SensorValueHistoryModel)):
+            # a (sensor, timestamp) is always stored in the partition of its month
+            for model in historyModels:
+                chunkCount += dedupeHistoryModel(model, chunk)
+
+        deletedCount += chunkCount
+        log(f"sensors {chunk[0]}-{chunk[-1]}: deleted {chunkCount} duplicated records")
+
+    return deletedCount
+
+
+def dedupeHistoryModel(model, sensorIDs: list):
+    duplicates = list(model.objects.filter(
+        sensor_id__in=sensorIDs,
+    ).values("sensor_id", "timestamp").annotate(
+        count=Count("id"),
+        keep=Max("id"),
+        currentCount=Count("id", filter=Q(isCurrent=True)),
+    ).filter(count__gt=1).order_by())
+
+    if len(duplicates) == 0:
+        return 0
+
+    keepIDs = {d["keep"] for d in duplicates}
+    duplicateKeys = {(d["sensor_id"], d["timestamp"]) for d in duplicates}
+
+    records = model.objects.filter(
+        sensor_id__in={d["sensor_id"] for d in duplicates},
+        timestamp__in={d["timestamp"] for d in duplicates},
+    ).values_list("id", "sensor_id", "timestamp")
+
+    deleteIDs = [
+        id for id, sensor, timestamp in records
+        if (sensor, timestamp) in duplicateKeys and id not in keepIDs
+    ]
+
+    model.objects.filter(
+        id__in=[d["keep"] for d in duplicates if d["currentCount"] > 0],
+    ).update(isCurrent=True)
+
+    for j in range(0, len(deleteIDs), 500):
+        model.objects.filter(id__in=deleteIDs[j:j+500]).delete()
+
+    return len(deleteIDs)
+
+
+def flushRollups(HourlyRollupModel, DailyRollupModel, readings: list):
+    upsertRollups(HourlyRollupModel, aggregateReadings(readings, hourBucket))
+    upsertRollups(DailyRollupModel, aggregateReadings(readings, dayBucket))
+
+
+def rebuildSensorRollups(SensorModel, SensorValueHistoryModel, HourlyRollupModel, DailyRollupModel, sensorsPerChunk: int = 100, log=print, historyModels: list = None):
+    """
+    Recompute the hourly and daily rollups from the raw sensor history. Sensors are
+    processed `sensorsPerChunk` at a time, each chunk in its own transaction, and the
+    history is streamed so a chunk never holds all its raw records in memory.
+    `historyModels` are the monthly partitions to read (see partitions.py), only
+    `SensorValueHistoryModel` by default. Return the number of raw records read.
+    """
+    if historyModels is None:
+        historyModels = [SensorValueHistoryModel]
+
+    sensorIDs = list(SensorModel.objects.order_by(
+        "id").values_list("id", flat=True))
+    readCount = 0
+
+    for i in range(0, len(sensorIDs), sensorsPerChunk):
+        chunk = sensorIDs[i:i+sensorsPerChunk]
+        chunkCount = 0
+
+        with transaction.atomic(using=router.db_for_write(HourlyRollupModel)):
+            HourlyRollupModel.objects.filter(sensor__in=chunk).delete()
+            DailyRollupModel.objects.filter(sensor__in=chunk).delete()
+
+            records = chain.from_iterable(
+                model.objects.filter(
+                    sensor_id__in=chunk,
+                ).order_by("sensor_id", "timestamp").values_list(
+                    "sensor_id", "timestamp", "value").iterator(chunk_size=5000)
+                for model in historyModels
+            )
+
+            # the aggregates are flushed every few thousand records, the upsert
+            # merges the buckets split between two flushes
+            readings = []
+            for sensor, timestamp, value in records:
+                readings.append((sensor, timestamp, value, 1, value))
+                if len(readings) >= 5000:
+                    flushRollups(HourlyRollupModel, DailyRollupModel, readings)
+                    chunkCount += len(readings)
+                    readings = []
+
+            flushRollups(HourlyRollupModel, DailyRollupModel, readings)
+            chunkCount += len(readings)
+
+        readCount += chunkCount
+        log(f"sensors {chunk[0]}-{chunk[-1]}: rolled up {chunkCount} records")
+
+    return readCount
+
+
+def dropForeignKeyConstraints(fields: list, alias: str, log=print):
+    """
+    Drop the database constraints left on the foreign keys `fields`, which the models
+    declare with `db_constraint=False`. Migration 0010 keeps them on an install with
+    a single database, they must be dropped before its history moves to its own
+    database. Return the number of dropped constraints.
+    """
+    connection = connections[alias]
+    droppedCount = 0
+    for field in fields:
+        model = field.model
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(
+                cursor, model._meta.db_table)
+        if not any(c["foreign_key"] and c["columns"] == [field.column] for c in constraints.values()):
+            continue
+
+        constrainedField = copy.copy(field)
+        constrainedField.db_constraint = True
+        with connection.schema_editor() as editor:
+            editor.alter_field(model, constrainedField, field)
+        log(f"{alias}: dropped the constraint of {model._meta.db_table}.{field.column}")
+        droppedCount += 1
+
+    return droppedCount
+
+
+def copyHistoryTables(models: list, source: str, target: str, chunkSize: int = 5000, log=print):
+    """
+    Copy the rows of `models` from the `source` database to the `target` database,
+    keeping their ids, e.g. to move the history of an existing install to its own
+    database. Only the rows with an id above the largest id of the target are
+    copied, so an interrupted copy resumes where it stopped. Pass the models in the
+    order of their foreign keys. Return the number of copied rows.
+    """
+    copiedCount = 0
+    for model in models:
+        lastID = model.objects.using(target).aggregate(
+            lastID=Max("pk"))["lastID"] or 0
+        modelCount = 0
+
+        while True:
+            rows = list(model.objects.using(source).filter(
+                pk__gt=lastID).order_by("pk")[:chunkSize])
+            if len(rows) == 0:
+                break
+
+            with transaction.atomic(using=target):
+                model.objects.using(target).bulk_create(rows)
+            lastID = rows[-1].pk
+            modelCount += len(rows)
+
+        # the next ids continue after the copied ones
+        connection = connections[target]
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), [model]):
+                cursor.execute(sql)
+
+        copiedCount += modelCount
+        log(f"{model._meta.db_table}: copied {modelCount} rows")
+
+    return copiedCount
@@ -0,0 +1,64 @@
+import io
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.parsers import JSONParser
+
+from greenhouse_data.parsers import MessagePackParser, msgpack
+
+
+class Command(BaseCommand):
+    help = "Compare the size and parse time of json and compact MessagePack gh/real-sensor bodies"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--real-sensors", type=int, default=4)
+        parser.add_argument("--sensor-keys", type=int, default=5)
+        parser.add_argument("--iterations", type=int, default=10000)
+
+    def buildPayloads(self, realSensorCount: int, sensorKeyCount: int):
+        timestamp = 1713459844
+        jsonData = {}
+        compactData = {}
+
+        for i in range(realSensorCount):
+            realSensorID = f"AirSensor_{i}"
+            sensors = {
+                f"sensorKey{k}": 20 + k * 0.25 for k in range(sensorKeyCount)}
+
+            jsonData[realSensorID] = {
+                "address": {"lat": 24.112, "lng": 47.330},
+                "sensors": dict(sensors, timestamp="2024-04-18T17:04:04"),
+            }
+            compactData[realSensorID] = [24.112, 47.330, timestamp, sensors]
+
+        return json.dumps(jsonData).encode(), msgpack.packb(compactData)
+
+    def timeParser(self, parser, body: bytes, iterations: int):
+        startTime = time.perf_counter()
+        for _ in range(iterations):
+            parser.parse(io.BytesIO(body))
+        return (time.perf_counter() - startTime) / iterations
+
+    def handle(self, *args, **options):
+        if msgpack is None:
+            raise CommandError("the msgpack package is not installed")
+
+        jsonBody, msgpackBody = self.buildPayloads(
+            options["real_sensors"], options["sensor_keys"])
+
+        jsonTime = self.timeParser(
+            JSONParser(), jsonBody, options["iterations"])
+        msgpackTime = self.timeParser(
+            MessagePackParser(), msgpackBody, options["iterations"])
+
+        self.stdout.write(
+            f"{options['real_sensors']} real sensors x {options['sensor_keys']} sensor keys, "
+            f"{options['iterations']} iterations")
+        self.stdout.write(f"{'format':<10}{'bytes':>10}{'parse (us)':>14}")
+        self.stdout.write(f"{'json':<10}{len(jsonBody):>10}{jsonTime * 1e6:>14.2f}")
+        self.stdout.write(
+            f"{'msgpack':<10}{len(msgpackBody):>10}{msgpackTime * 1e6:>14.2f}")
+        self.stdout.write(
+            f"msgpack / json: {len(msgpackBody) / len(jsonBody):.2f} bytes, "
+            f"{msgpackTime / jsonTime:.2f} parse time")
@@ -0,0 +1,59 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Max, Min
+
+from greenhouse_data.maintenance import copyHistoryTables, dropForeignKeyConstraints
+from greenhouse_data.models import ControllerModel, ControllerSettingHistoryModel, ScheduleModel, SensorDailyRollupModel, SensorHourlyRollupModel, SensorValueHistoryModel
+from greenhouse_data.partitions import getHistoryPartitions, monthRange
+from greenhouse_data.routers import getHistoryDatabase
+
+
+class Command(BaseCommand):
+    help = "Copy the history tables of the default database to the history database, run it with the ingest stopped"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=5000)
+
+    def handle(self, *args, **options):
+        history = getHistoryDatabase()
+        if history == DEFAULT_DB_ALIAS:
+            raise CommandError(
+                "the history database is not configured, see GREENHOUSE_HISTORY_DATABASE")
+
+        # the keys between the two sides kept their constraints while the install
+        # had one database, see migration 0010
+        crossDatabaseFields = [
+            ControllerModel._meta.get_field("currentSetting"),
+            SensorValueHistoryModel._meta.get_field("sensor"),
+            ControllerSettingHistoryModel._meta.get_field("controller"),
+            SensorHourlyRollupModel._meta.get_field("sensor"),
+            SensorDailyRollupModel._meta.get_field("sensor"),
+        ]
+        for alias in [DEFAULT_DB_ALIAS, history]:
+            dropForeignKeyConstraints(crossDatabaseFields, alias, log=self.stdout.write)
+
+        # the sensor history is copied through the partitioned table on PostgreSQL,
+        # and moved from sensorHistoryTable to the month tables elsewhere
+        partitions = getHistoryPartitions(history)
+        bounds = SensorValueHistoryModel.objects.using(DEFAULT_DB_ALIAS).aggregate(
+            first=Min("timestamp"), last=Max("timestamp"))
+        if bounds["first"] is not None:
+            partitions.ensureMonths(monthRange(bounds["first"], bounds["last"]))
+
+        copiedCount = copyHistoryTables(
+            [
+                ControllerSettingHistoryModel,
+                ScheduleModel,
+                SensorValueHistoryModel,
+                SensorHourlyRollupModel,
+                SensorDailyRollupModel,
+            ],
+            DEFAULT_DB_ALIAS,
+            history,
+            chunkSize=options["chunk_size"],
+            log=self.stdout.write,
+        )
+        self.stdout.write(f"copied {copiedCount} rows")
+        movedCount = partitions.absorbBaseTable()
+        if movedCount != 0:
+            self.stdout.write(f"moved {movedCount} sensor history rows to the month tables")
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from greenhouse_data.maintenance import dedupeSensorHistory
+from greenhouse_data.models import SensorModel, SensorValueHistoryModel
+from greenhouse_data.partitions import getHistoryPartitions
+
+
+class Command(BaseCommand):
+    help = "Remove sensor history records with the same sensor and timestamp, keeping the latest written one"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sensors-per-chunk", type=int, default=100)
+
+    def handle(self, *args, **options):
+        deletedCount = dedupeSensorHistory(
+            SensorModel,
+            SensorValueHistoryModel,
+            sensorsPerChunk=options["sensors_per_chunk"],
+            log=self.stdout.write,
+            historyModels=getHistoryPartitions().models(),
+        )
+        self.stdout.write(f"deleted {deletedCount} duplicated records")
@@ -0,0 +1,38 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from greenhouse_data.partitions import addMonths, getHistoryPartitions, monthStart
+
+
+class Command(BaseCommand):
+    help = "Create the next monthly partitions of the sensor history and detach the old ones, run it daily"
+
+    def add_arguments(self, parser):
+        config = settings.GREENHOUSE_HISTORY_PARTITIONS
+        parser.add_argument("--months-ahead", type=int,
+                            default=config["MONTHS_AHEAD"])
+        parser.add_argument("--retain-months", type=int,
+                            default=config["RETAIN_MONTHS"])
+        parser.add_argument("--drop", action="store_true",
+                            help="drop the old partitions instead of keeping them as *_detached tables")
+
+    def handle(self, *args, **options):
+        partitions = getHistoryPartitions()
+        currentMonth = monthStart(timezone.now())
+
+        for i in range(options["months_ahead"] + 1):
+            partitions.createMonth(addMonths(currentMonth, i))
+
+        retainMonths = options["retain_months"]
+        if retainMonths is not None:
+            firstKept = addMonths(currentMonth, -retainMonths)
+            for month in partitions.listMonths():
+                if month >= firstKept:
+                    continue
+                partitions.detachMonth(month, drop=options["drop"])
+                self.stdout.write(
+                    f"{partitions.partitionName(month)}: {'dropped' if options['drop'] else 'detached'}")
+
+        for month in partitions.listMonths():
+            self.stdout.write(f"{partitions.partitionName(month)}: attached")
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from greenhouse_data.maintenance import rebuildSensorRollups
+from greenhouse_data.models import SensorDailyRollupModel, SensorHourlyRollupModel, SensorModel, SensorValueHistoryModel
+from greenhouse_data.partitions import getHistoryPartitions
+
+
+class Command(BaseCommand):
+    help = "Recompute the hourly and daily sensor rollups from the raw sensor history"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sensors-per-chunk", type=int, default=100)
+
+    def handle(self, *args, **options):
+        readCount = rebuildSensorRollups(
+            SensorModel,
+            SensorValueHistoryModel,
+            SensorHourlyRollupModel,
+            SensorDailyRollupModel,
+            sensorsPerChunk=options["sensors_per_chunk"],
+            log=self.stdout.write,
+            historyModels=getHistoryPartitions().models(),
+        )
+        self.stdout.write(f"rolled up {readCount} records")
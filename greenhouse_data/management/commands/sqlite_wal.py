@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from greenhouse_data.sqlite import CHECKPOINT_MODES, checkpointWAL, getWALStatus
+
+
+class Command(BaseCommand):
+    help = "Report the write-ahead log of the SQLite database and optionally checkpoint it"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--database", default=DEFAULT_DB_ALIAS)
+        parser.add_argument("--checkpoint", nargs="?", const="PASSIVE",
+                            choices=CHECKPOINT_MODES, default=None)
+
+    def report(self, connection):
+        status = getWALStatus(connection)
+        self.stdout.write(f"database: {status['database']}")
+        self.stdout.write(f"journal mode: {status['journalMode']}")
+        self.stdout.write(f"wal size: {status['walSize']} bytes")
+        for name, value in status["pragmas"].items():
+            if name == "journal_mode":
+                continue
+            self.stdout.write(f"{name}: {value}")
+
+    def handle(self, *args, **options):
+        connection = connections[options["database"]]
+        if connection.vendor != "sqlite":
+            raise CommandError(
+                f"database {options['database']} is not a SQLite database")
+
+        self.report(connection)
+
+        mode = options["checkpoint"]
+        if mode is None:
+            return
+
+        busy, walPages, checkpointedPages = checkpointWAL(connection, mode)
+        self.stdout.write(
+            f"checkpoint {mode}: {checkpointedPages} of {walPages} pages copied" + (" (busy)" if busy else ""))
+        self.report(connection)
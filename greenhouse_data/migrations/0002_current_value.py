@@ -0,0 +1,60 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:10
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def backfillCurrentValues(apps, schema_editor):
+    """
+    Copy the history records with isCurrent == True to the new current columns
+    """
+    SensorModel = apps.get_model("greenhouse_data", "SensorModel")
+    SensorValueHistoryModel = apps.get_model(
+        "greenhouse_data", "SensorValueHistoryModel")
+    ControllerModel = apps.get_model("greenhouse_data", "ControllerModel")
+    ControllerSettingHistoryModel = apps.get_model(
+        "greenhouse_data", "ControllerSettingHistoryModel")
+
+    currentSensorData = SensorValueHistoryModel.objects.filter(
+        sensor=OuterRef("pk"), isCurrent=True).order_by("-id")
+    SensorModel.objects.update(
+        currentValue=Subquery(currentSensorData.values("value")[:1]),
+        currentTimestamp=Subquery(currentSensorData.values("timestamp")[:1]),
+    )
+
+    currentSetting = ControllerSettingHistoryModel.objects.filter(
+        controller=OuterRef("pk"), isCurrent=True).order_by("-id")
+    ControllerModel.objects.update(
+        currentSetting=Subquery(currentSetting.values("id")[:1]),
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("greenhouse_data", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="controllermodel",
+            name="currentSetting",
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="+",
+                to="greenhouse_data.controllersettinghistorymodel",
+            ),
+        ),
+        migrations.AddField(
+            model_name="sensormodel",
+            name="currentTimestamp",
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name="sensormodel",
+            name="currentValue",
+            field=models.FloatField(null=True),
+        ),
+        migrations.RunPython(backfillCurrentValues, migrations.RunPython.noop),
+    ]
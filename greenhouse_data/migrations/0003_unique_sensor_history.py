@@ -0,0 +1,69 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:12
+
+from django.db import migrations, models
+from django.db.models import Count, Max, Q
+
+
+def dedupe(apps, schema_editor):
+    """
+    Remove existing duplicates so the constraint can be created, keeping the latest
+    written record of each (sensor, timestamp). Run `manage.py dedupe_sensor_history`
+    before migrating to do it ahead of time. A copy of `dedupeSensorHistory` as it
+    was when this migration was written, the history was one table.
+    """
+    SensorModel = apps.get_model("greenhouse_data", "SensorModel")
+    SensorValueHistoryModel = apps.get_model("greenhouse_data", "SensorValueHistoryModel")
+
+    sensorIDs = list(SensorModel.objects.order_by(
+        "id").values_list("id", flat=True))
+
+    for i in range(0, len(sensorIDs), 100):
+        chunk = sensorIDs[i:i+100]
+
+        duplicates = list(SensorValueHistoryModel.objects.filter(
+            sensor__in=chunk,
+        ).values("sensor", "timestamp").annotate(
+            count=Count("id"),
+            keep=Max("id"),
+            currentCount=Count("id", filter=Q(isCurrent=True)),
+        ).filter(count__gt=1).order_by())
+
+        if len(duplicates) == 0:
+            continue
+
+        keepIDs = {d["keep"] for d in duplicates}
+        duplicateKeys = {(d["sensor"], d["timestamp"]) for d in duplicates}
+
+        records = SensorValueHistoryModel.objects.filter(
+            sensor__in={d["sensor"] for d in duplicates},
+            timestamp__in={d["timestamp"] for d in duplicates},
+        ).values_list("id", "sensor", "timestamp")
+
+        deleteIDs = [
+            id for id, sensor, timestamp in records
+            if (sensor, timestamp) in duplicateKeys and id not in keepIDs
+        ]
+
+        SensorValueHistoryModel.objects.filter(
+            id__in=[d["keep"] for d in duplicates if d["currentCount"] > 0],
+        ).update(isCurrent=True)
+
+        for j in range(0, len(deleteIDs), 500):
+            SensorValueHistoryModel.objects.filter(
+                id__in=deleteIDs[j:j+500]).delete()
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("greenhouse_data", "0002_current_value"),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="sensorvaluehistorymodel",
+            constraint=models.UniqueConstraint(
+                fields=("sensor", "timestamp"), name="unique_sensor_history_timestamp"
+            ),
+        ),
+    ]
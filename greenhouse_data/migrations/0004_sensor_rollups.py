@@ -0,0 +1,136 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:31
+
+import datetime
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def backfillRollups(apps, schema_editor):
+    """
+    Build the rollups of the existing history. Run `manage.py rebuild_sensor_rollups`
+    to rebuild them again later. A copy of `rebuildSensorRollups` as it was when this
+    migration was written: the history is streamed one sensor at a time, ordered by
+    timestamp, and the buckets of a sensor are written once it is read.
+    """
+    SensorModel = apps.get_model("greenhouse_data", "SensorModel")
+    SensorValueHistoryModel = apps.get_model("greenhouse_data", "SensorValueHistoryModel")
+    rollupModels = [
+        (apps.get_model("greenhouse_data", "SensorHourlyRollupModel"),
+         lambda timestamp: timestamp.replace(minute=0, second=0, microsecond=0)),
+        (apps.get_model("greenhouse_data", "SensorDailyRollupModel"),
+         lambda timestamp: timestamp.replace(hour=0, minute=0, second=0, microsecond=0)),
+    ]
+
+    for sensorID in SensorModel.objects.order_by("id").values_list("id", flat=True):
+        buckets = [{} for _ in rollupModels]
+        records = SensorValueHistoryModel.objects.filter(
+            sensor=sensorID,
+        ).order_by("timestamp").values_list("timestamp", "value").iterator(chunk_size=5000)
+
+        for timestamp, value in records:
+            timestamp = timestamp.astimezone(datetime.timezone.utc)
+            for (rollupModel, truncate), rollups in zip(rollupModels, buckets):
+                bucket = truncate(timestamp)
+                rollup = rollups.get(bucket, None)
+                if rollup is None:
+                    rollups[bucket] = rollupModel(
+                        sensor_id=sensorID, bucket=bucket, count=1, valueSum=value,
+                        valueMin=value, valueMax=value, lastTimestamp=timestamp, lastValue=value)
+                    continue
+
+                rollup.count += 1
+                rollup.valueSum += value
+                rollup.valueMin = min(rollup.valueMin, value)
+                rollup.valueMax = max(rollup.valueMax, value)
+                rollup.lastTimestamp = timestamp
+                rollup.lastValue = value
+
+        for (rollupModel, _), rollups in zip(rollupModels, buckets):
+            rollupModel.objects.bulk_create(rollups.values(), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("greenhouse_data", "0003_unique_sensor_history"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SensorDailyRollupModel",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("bucket", models.DateTimeField()),
+                ("count", models.IntegerField(default=0)),
+                ("valueSum", models.FloatField(default=0)),
+                ("valueMin", models.FloatField(null=True)),
+                ("valueMax", models.FloatField(null=True)),
+                ("lastValue", models.FloatField(null=True)),
+                ("lastTimestamp", models.DateTimeField(null=True)),
+                (
+                    "sensor",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="greenhouse_data.sensormodel",
+                    ),
+                ),
+            ],
+            options={
+                "db_table": "sensorDailyRollupTable",
+                "ordering": ["sensor", "bucket"],
+                "abstract": False,
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("sensor", "bucket"), name="unique_sensor_daily_rollup"
+                    )
+                ],
+            },
+        ),
+        migrations.CreateModel(
+            name="SensorHourlyRollupModel",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("bucket", models.DateTimeField()),
+                ("count", models.IntegerField(default=0)),
+                ("valueSum", models.FloatField(default=0)),
+                ("valueMin", models.FloatField(null=True)),
+                ("valueMax", models.FloatField(null=True)),
+                ("lastValue", models.FloatField(null=True)),
+                ("lastTimestamp", models.DateTimeField(null=True)),
+                (
+                    "sensor",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="greenhouse_data.sensormodel",
+                    ),
+                ),
+            ],
+            options={
+                "db_table": "sensorHourlyRollupTable",
+                "ordering": ["sensor", "bucket"],
+                "abstract": False,
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("sensor", "bucket"), name="unique_sensor_hourly_rollup"
+                    )
+                ],
+            },
+        ),
+        migrations.RunPython(backfillRollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("greenhouse_data", "0004_sensor_rollups"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="controllersettinghistorymodel",
+            index=models.Index(
+                fields=["controller", "timestamp"], name="controller_history_timestamp"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="controllersettinghistorymodel",
+            index=models.Index(
+                condition=models.Q(("isCurrent", True)),
+                fields=["controller"],
+                name="controller_history_current",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="sensorvaluehistorymodel",
+            index=models.Index(
+                condition=models.Q(("isCurrent", True)),
+                fields=["sensor"],
+                name="sensor_history_current",
+            ),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("greenhouse_data", "0005_history_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="greenhousemodel",
+            name="version",
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("greenhouse_data", "0006_greenhouse_version"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="greenhousemodel",
+            name="structureVersion",
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="realsensormodel",
+            name="changeVersion",
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="sensormodel",
+            name="changeVersion",
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="controllermodel",
+            name="changeVersion",
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 21:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("greenhouse_data", "0007_change_versions"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="controllersettinghistorymodel",
+            name="lastSeen",
+            field=models.DateTimeField(null=True),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-18 21:47
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("greenhouse_data", "0008_controller_setting_last_seen"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DeviceKeyModel",
+            fields=[
+                (
+                    "greenhouse",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="deviceKey",
+                        serialize=False,
+                        to="greenhouse_data.greenhousemodel",
+                    ),
+                ),
+                ("key", models.CharField(max_length=64)),
+                ("previousKey", models.CharField(max_length=64, null=True)),
+                ("rotatedAt", models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                "db_table": "deviceKeyTable",
+            },
+        ),
+    ]
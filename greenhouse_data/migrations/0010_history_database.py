@@ -0,0 +1,95 @@
+# Generated by Django 5.2.18 on 2026-10-18 22:40
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, migrations, models
+
+# The foreign keys between the history and the metadata, see routers.py
+CROSS_DATABASE_FIELDS = [
+    (
+        "controllermodel",
+        "currentSetting",
+        {
+            "null": True,
+            "related_name": "+",
+            "to": "greenhouse_data.controllersettinghistorymodel",
+        },
+    ),
+    (
+        "sensorvaluehistorymodel",
+        "sensor",
+        {
+            "null": True,
+            "related_name": "sensorHistory",
+            "to": "greenhouse_data.sensormodel",
+        },
+    ),
+    (
+        "controllersettinghistorymodel",
+        "controller",
+        {
+            "related_name": "controllerHistory",
+            "to": "greenhouse_data.controllermodel",
+        },
+    ),
+    (
+        "sensorhourlyrollupmodel",
+        "sensor",
+        {"to": "greenhouse_data.sensormodel"},
+    ),
+    (
+        "sensordailyrollupmodel",
+        "sensor",
+        {"to": "greenhouse_data.sensormodel"},
+    ),
+]
+
+
+def isHistorySplit():
+    """ Whether the history has its own database, a copy of `routers.getHistoryDatabase` """
+    alias = getattr(settings, "GREENHOUSE_HISTORY_DATABASE", None)
+    return alias is not None and alias != DEFAULT_DB_ALIAS and alias in settings.DATABASES
+
+
+class AlterCrossDatabaseField(migrations.AlterField):
+    """
+    Change the key in the migration state, and drop its constraint only when the
+    history has its own database. With one database the constraint is kept, the
+    history is deleted with the devices in the same transaction (see signals.py).
+    """
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if isHistorySplit():
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if isHistorySplit():
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+
+
+def dropConstraint(modelName, name, options):
+    """
+    Drop the constraint of a key created by the earlier migrations when the two
+    sides are on different databases. The deletions are propagated by signals.py
+    instead of the ORM.
+    """
+    return AlterCrossDatabaseField(
+        model_name=modelName,
+        name=name,
+        field=models.ForeignKey(
+            db_constraint=False,
+            on_delete=django.db.models.deletion.DO_NOTHING,
+            **options,
+        ),
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("greenhouse_data", "0009_device_key"),
+    ]
+
+    operations = [
+        dropConstraint(modelName, name, options)
+        for modelName, name, options in CROSS_DATABASE_FIELDS
+    ]
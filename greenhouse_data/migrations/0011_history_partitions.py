@@ -0,0 +1,206 @@
+# Generated by Django 5.2.18 on 2026-10-18 23:55
+
+import datetime
+
+from django.apps.registry import Apps
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+
+TABLE = "sensorHistoryTable"
+UNPARTITIONED_TABLE = "sensorHistoryTable_unpartitioned"
+SEQUENCE = "sensorHistoryTable_id_seq"
+
+# copies of the helpers of partitions.py as they were when this migration was written
+
+
+def monthStart(timestamp):
+    return timestamp.astimezone(datetime.timezone.utc).replace(
+        day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def addMonths(month, count: int):
+    index = month.year * 12 + month.month - 1 + count
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+
+def monthRange(startTime, endTime):
+    month = monthStart(startTime)
+    lastMonth = monthStart(endTime)
+    months = []
+    while month <= lastMonth:
+        months.append(month)
+        month = addMonths(month, 1)
+    return months
+
+
+def createPostgreSQLMonth(connection, month):
+    qn = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"CREATE TABLE IF NOT EXISTS {qn(f'{TABLE}_{month:%Y%m}')} "
+            f"PARTITION OF {qn(TABLE)} "
+            f"FOR VALUES FROM ('{month.isoformat()}') TO ('{addMonths(month, 1).isoformat()}')")
+
+
+def createMonthTable(schema_editor, month):
+    """ The `sensorHistoryTable_YYYYMM` table of the other databases """
+    suffix = f"{month:%Y%m}"
+    name = f"{TABLE}_{suffix}"
+    with schema_editor.connection.cursor() as cursor:
+        if name in schema_editor.connection.introspection.table_names(cursor):
+            return
+
+    class Meta:
+        apps = Apps()
+        app_label = "greenhouse_data"
+        db_table = name
+        constraints = [
+            models.UniqueConstraint(
+                fields=["sensor_id", "timestamp"], name=f"unique_sensor_history_{suffix}"),
+        ]
+        indexes = [
+            models.Index(
+                fields=["sensor_id"], condition=models.Q(isCurrent=True), name=f"sensor_history_current_{suffix}"),
+        ]
+
+    model = type(f"SensorValueHistoryModel_{suffix}", (models.Model,), {
+        "__module__": __name__,
+        "Meta": Meta,
+        "id": models.BigAutoField(primary_key=True),
+        "sensor_id": models.BigIntegerField(null=True),
+        "timestamp": models.DateTimeField(),
+        "isCurrent": models.BooleanField(default=True),
+        "value": models.FloatField(),
+    })
+    schema_editor.create_model(model)
+
+
+def partitionPostgreSQL(schema_editor):
+    """
+    Rebuild sensorHistoryTable as a table partitioned by month. The rows are copied
+    once into the partitions, the indexes, the unique constraint and the foreign
+    key (kept on a single database, see 0010) are created again with their names. The primary key becomes (id, timestamp), as it must
+    contain the partition key, the ids still come from one sequence.
+    """
+    connection = schema_editor.connection
+    qn = connection.ops.quote_name
+    table = qn(TABLE)
+    unpartitioned = qn(UNPARTITIONED_TABLE)
+
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT relkind FROM pg_class WHERE oid = %s::regclass", [table])
+        if cursor.fetchone()[0] == "p":
+            return
+
+        cursor.execute(f"SELECT MIN({qn('timestamp')}), MAX({qn('timestamp')}) FROM {table}")
+        first, last = cursor.fetchone()
+
+        # the identity sequence is dropped with the identity, the new sequence
+        # takes its name
+        cursor.execute(f"ALTER TABLE {table} RENAME TO {unpartitioned}")
+        cursor.execute(f"ALTER TABLE {unpartitioned} ALTER COLUMN {qn('id')} DROP IDENTITY IF EXISTS")
+        cursor.execute(f"CREATE SEQUENCE {qn(SEQUENCE)}")
+        cursor.execute(
+            f"CREATE TABLE {table} (LIKE {unpartitioned}) PARTITION BY RANGE ({qn('timestamp')})")
+        cursor.execute(
+            f"ALTER TABLE {table} ALTER COLUMN {qn('id')} SET DEFAULT nextval('{qn(SEQUENCE)}')")
+        cursor.execute(f"ALTER SEQUENCE {qn(SEQUENCE)} OWNED BY {table}.{qn('id')}")
+
+    # the months of the existing rows, up to the months created ahead by the command
+    now = timezone.now()
+    lastMonth = addMonths(monthStart(now), settings.GREENHOUSE_HISTORY_PARTITIONS["MONTHS_AHEAD"])
+    for month in monthRange(min(first or now, now), max(last or lastMonth, lastMonth)):
+        createPostgreSQLMonth(connection, month)
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"INSERT INTO {table} SELECT * FROM {unpartitioned}")
+        cursor.execute(
+            f"SELECT setval('{qn(SEQUENCE)}', COALESCE(MAX({qn('id')}), 0) + 1, false) FROM {table}")
+
+        cursor.execute(
+            "SELECT indexdef FROM pg_indexes WHERE schemaname = current_schema() AND tablename = %s "
+            "AND indexname NOT IN (SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass)",
+            [UNPARTITIONED_TABLE, unpartitioned],
+        )
+        indexes = [row[0].replace(unpartitioned, table) for row in cursor.fetchall()]
+        cursor.execute(
+            "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+            "WHERE conrelid = %s::regclass AND contype IN ('u', 'f')",
+            [unpartitioned],
+        )
+        constraints = cursor.fetchall()
+
+        cursor.execute(f"DROP TABLE {unpartitioned}")
+        cursor.execute(
+            f"ALTER TABLE {table} ADD CONSTRAINT {qn(TABLE + '_pkey')} PRIMARY KEY ({qn('id')}, {qn('timestamp')})")
+        for name, definition in constraints:
+            cursor.execute(f"ALTER TABLE {table} ADD CONSTRAINT {qn(name)} {definition}")
+        for definition in indexes:
+            cursor.execute(definition)
+
+
+def absorbBaseTable(SensorValueHistoryModel, schema_editor):
+    """
+    Move the rows of sensorHistoryTable into the month tables, one month at a time.
+    The readings already stored in a month table are not copied again.
+    """
+    connection = schema_editor.connection
+    qn = connection.ops.quote_name
+    columns = ", ".join(qn(c)
+                        for c in ["id", "sensor_id", "timestamp", "isCurrent", "value"])
+
+    bounds = SensorValueHistoryModel.objects.using(connection.alias).aggregate(
+        first=models.Min("timestamp"), last=models.Max("timestamp"))
+    first, last = bounds["first"], bounds["last"]
+    if first is None:
+        return
+
+    for month in monthRange(first, last):
+        params = [
+            connection.ops.adapt_datetimefield_value(month),
+            connection.ops.adapt_datetimefield_value(addMonths(month, 1)),
+        ]
+        createMonthTable(schema_editor, month)
+        partition = qn(f"{TABLE}_{month:%Y%m}")
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {partition} ({columns}) "
+                f"SELECT {columns} FROM {qn(TABLE)} AS base "
+                f"WHERE base.{qn('timestamp')} >= %s AND base.{qn('timestamp')} < %s "
+                f"AND NOT EXISTS (SELECT 1 FROM {partition} AS stored "
+                f"WHERE stored.{qn('sensor_id')} = base.{qn('sensor_id')} "
+                f"AND stored.{qn('timestamp')} = base.{qn('timestamp')})",
+                params,
+            )
+            cursor.execute(
+                f"DELETE FROM {qn(TABLE)} "
+                f"WHERE {qn('timestamp')} >= %s AND {qn('timestamp')} < %s",
+                params,
+            )
+
+
+def partitionHistory(apps, schema_editor):
+    """
+    Move the sensor history to its monthly partitions, see partitions.py. Run with
+    the ingest stopped, the existing rows are copied once.
+    """
+    if schema_editor.connection.vendor == "postgresql":
+        partitionPostgreSQL(schema_editor)
+        return
+
+    absorbBaseTable(apps.get_model("greenhouse_data", "SensorValueHistoryModel"), schema_editor)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("greenhouse_data", "0010_history_database"),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            partitionHistory,
+            migrations.RunPython.noop,
+            hints={"model_name": "sensorvaluehistorymodel"},
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('greenhouse_data', '0011_history_partitions'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='devicekeymodel',
+            name='key',
+            field=models.CharField(max_length=64, null=True),
+        ),
+    ]
@@ -22,10 +22,40 @@ class GreenhouseModel(models.Model):
     beginDate = models.DateField()  # format YYYY-MM-DD
     photo = models.ImageField(
         "Greenhouse Avatar", upload_to="image/greenhouse_photo", null=True)
+    # Increased on every change of the greenhouse or its devices, see snapshot.py
+    version = models.PositiveBigIntegerField(default=0)
+    # The version of the last device creation / deletion or greenhouse update
+    structureVersion = models.PositiveBigIntegerField(default=0)
 
     def __str__(self) -> str:
         return super().__str__()
 
+    def save(self, *args, **kwargs):
+        # the versions are only written by `bumpGreenhouseVersions`, saving a stale
+        # instance must not move them back
+        if not self._state.adding and kwargs.get("update_fields", None) is None:
+            kwargs["update_fields"] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in ["version", "structureVersion"]
+            ]
+        super().save(*args, **kwargs)
+
+
+class DeviceKeyModel(models.Model):
+    """
+    The key signing the requests of the devices of a greenhouse, see device_auth.py
+    """
+    class Meta:
+        db_table = "deviceKeyTable"
+
+    greenhouse = models.OneToOneField(
+        GreenhouseModel, on_delete=models.CASCADE, primary_key=True, related_name="deviceKey")
+    # None once revoked, the requests of the greenhouse are then all rejected
+    key = models.CharField(max_length=64, null=True)
+    # still accepted for GREENHOUSE_DEVICE_AUTH["ROTATION_GRACE"] seconds after a rotation
+    previousKey = models.CharField(max_length=64, null=True)
+    rotatedAt = models.DateTimeField(auto_now=True)
+
 
 class RealSensorModel(models.Model):
     """
@@ -44,6 +74,8 @@ class RealSensorModel(models.Model):
     electricity = models.FloatField(default=100)
     lat = models.FloatField(null=True)
     lng = models.FloatField(null=True)
+    # The greenhouse version of the last change, see snapshot.py
+    changeVersion = models.PositiveBigIntegerField(default=0)
 
 
 class SensorModel(models.Model):
@@ -59,6 +91,11 @@ class SensorModel(models.Model):
     itemName = models.CharField(max_length=64)
     # The sensor key would not duplicate in one real sensor
     sensorKey = models.CharField(max_length=32)
+    # Copy of the current sensor history record, updated on every insert
+    currentValue = models.FloatField(null=True)
+    currentTimestamp = models.DateTimeField(null=True)
+    # The greenhouse version of the last change, see snapshot.py
+    changeVersion = models.PositiveBigIntegerField(default=0)
 
 
 class ControllerModel(models.Model):
@@ -77,6 +114,12 @@ class ControllerModel(models.Model):
     electricity = models.FloatField(default=100)
     lat = models.FloatField(null=True)
     lng = models.FloatField(null=True)
+    # The setting history record with isCurrent == True. The history may live on
+    # another database, see routers.py
+    currentSetting = models.ForeignKey(
+        "ControllerSettingHistoryModel", null=True, on_delete=models.DO_NOTHING, db_constraint=False, related_name="+")
+    # The greenhouse version of the last change, see snapshot.py
+    changeVersion = models.PositiveBigIntegerField(default=0)
 
 
 class SensorValueHistoryModel(models.Model):
@@ -86,14 +129,70 @@ class SensorValueHistoryModel(models.Model):
     class Meta:
         db_table = "sensorHistoryTable"
         ordering = ["sensor", "timestamp"]
-
+        constraints = [
+            # a retried report must not insert the same reading twice
+            models.UniqueConstraint(
+                fields=["sensor", "timestamp"], name="unique_sensor_history_timestamp"),
+        ]
+        indexes = [
+            # the unique constraint already covers (sensor, timestamp) ranges, this
+            # one finds the current record without reading the sensor's history
+            models.Index(
+                fields=["sensor"], condition=models.Q(isCurrent=True), name="sensor_history_current"),
+        ]
+
+    # set to NULL when the sensor is deleted, see signals.py
     sensor = models.ForeignKey(
-        SensorModel, on_delete=models.SET_NULL, null=True, related_name="sensorHistory")
+        SensorModel, on_delete=models.DO_NOTHING, db_constraint=False, null=True, related_name="sensorHistory")
     timestamp = models.DateTimeField()
     isCurrent = models.BooleanField(default=True)
     value = models.FloatField()
 
 
+class SensorRollupBase(models.Model):
+    """
+    Aggregated sensor history of one time bucket, updated by the ingest path
+    """
+    class Meta:
+        abstract = True
+        ordering = ["sensor", "bucket"]
+
+    # deleted with the sensor, see signals.py
+    sensor = models.ForeignKey(
+        SensorModel, on_delete=models.DO_NOTHING, db_constraint=False)
+    bucket = models.DateTimeField()  # start of the bucket in UTC
+    count = models.IntegerField(default=0)
+    valueSum = models.FloatField(default=0)
+    valueMin = models.FloatField(null=True)
+    valueMax = models.FloatField(null=True)
+    lastValue = models.FloatField(null=True)
+    lastTimestamp = models.DateTimeField(null=True)
+
+
+class SensorHourlyRollupModel(SensorRollupBase):
+    """
+    Aggregated sensor history per hour
+    """
+    class Meta(SensorRollupBase.Meta):
+        db_table = "sensorHourlyRollupTable"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["sensor", "bucket"], name="unique_sensor_hourly_rollup"),
+        ]
+
+
+class SensorDailyRollupModel(SensorRollupBase):
+    """
+    Aggregated sensor history per day
+    """
+    class Meta(SensorRollupBase.Meta):
+        db_table = "sensorDailyRollupTable"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["sensor", "bucket"], name="unique_sensor_daily_rollup"),
+        ]
+
+
 class ControllerSettingHistoryModel(models.Model):
     """
     Record controller setting history
@@ -102,9 +201,16 @@ class ControllerSettingHistoryModel(models.Model):
     class Meta:
         db_table = "controllerHistoryTable"
         ordering = ["controller", "timestamp"]
-
+        indexes = [
+            models.Index(
+                fields=["controller", "timestamp"], name="controller_history_timestamp"),
+            models.Index(
+                fields=["controller"], condition=models.Q(isCurrent=True), name="controller_history_current"),
+        ]
+
+    # deleted with the controller, see signals.py
     controller = models.ForeignKey(
-        ControllerModel, on_delete=models.CASCADE, related_name="controllerHistory")
+        ControllerModel, on_delete=models.DO_NOTHING, db_constraint=False, related_name="controllerHistory")
     timestamp = models.DateTimeField()
     isCurrent = models.BooleanField(default=True)
     on = models.BooleanField()
@@ -112,6 +218,9 @@ class ControllerSettingHistoryModel(models.Model):
     openTemp = models.FloatField(null=True)
     closeTemp = models.FloatField(null=True)
     cutHumidity = models.FloatField(null=True)
+    # The timestamp of the last report of this same setting, the unchanged reports
+    # are not recorded as new history rows
+    lastSeen = models.DateTimeField(null=True)
 
 
 class ScheduleModel(models.Model):
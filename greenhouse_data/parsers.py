@@ -0,0 +1,90 @@
+"""
+Request parsers for the gh/ endpoints
+"""
+import datetime
+
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def expandCompactRealSensor(compactData: list):
+    """
+    Turn the compact real sensor format into the format of the json request body
+
+    #### Compact format
+    ```
+    [24.112, 47.330, 1713459844, {"airTemp": 33, "airHumidity": 68}]
+    ```
+    The third item is a unix timestamp in seconds or an iso format string.
+
+    #### Expanded format
+    ```
+    {
+        "address": {"lat": 24.112, "lng": 47.330},
+        "sensors": {"airTemp": 33, "airHumidity": 68, "timestamp": "2024-04-18T17:04:04+00:00"}
+    }
+    ```
+    """
+    if len(compactData) != 4 or not isinstance(compactData[3], dict):
+        raise ParseError(
+            "compact real sensor should be [lat, lng, timestamp, sensors]")
+
+    lat, lng, timestamp, sensors = compactData
+    if isinstance(timestamp, (int, float)):
+        try:
+            timestamp = datetime.datetime.fromtimestamp(
+                timestamp, tz=datetime.timezone.utc).isoformat()
+        except (ValueError, OverflowError, OSError):
+            raise ParseError(f"invalid unix timestamp {timestamp}")
+
+    sensors["timestamp"] = timestamp
+    return {
+        "address": {"lat": lat, "lng": lng},
+        "sensors": sensors,
+    }
+
+
+def expandCompactRealSensors(data):
+    """
+    Expand every compact real sensor of a request body. Real sensors are looked up at
+    the top level (gh/real-sensor) and in the "realSensors" map (gh/greenhouse).
+    Maps that are already in the json format are left unchanged.
+    """
+    if not isinstance(data, dict):
+        return data
+
+    for realSensors in [data, data.get("realSensors", None)]:
+        if not isinstance(realSensors, dict):
+            continue
+
+        for realSensorID, realSensorData in realSensors.items():
+            if isinstance(realSensorData, list):
+                realSensors[realSensorID] = expandCompactRealSensor(
+                    realSensorData)
+
+    return data
+
+
+class MessagePackParser(BaseParser):
+    """
+    Parse MessagePack request bodies. Real sensors may use the compact list format
+    of `expandCompactRealSensor`, which drops the repeated address and sensors keys.
+    The parsed data has the same format as the json request body.
+    """
+    media_type = "application/msgpack"
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        if msgpack is None:
+            raise ParseError("MessagePack is not supported by the server")
+
+        try:
+            data = msgpack.unpackb(stream.read(), raw=False)
+        except Exception as e:
+            raise ParseError(f"MessagePack parse error - {e}")
+
+        return expandCompactRealSensors(data)
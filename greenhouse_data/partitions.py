@@ -0,0 +1,413 @@
+"""
+Monthly partitions of the sensor history. `sensorHistoryTable` only grows: range
+scans slow down with it and dropping old readings is a huge DELETE. The readings of
+each UTC month are stored in their own table, `sensorHistoryTable_YYYYMM`:
+
+- PostgreSQL: `sensorHistoryTable` is a native partitioned table (PARTITION BY
+  RANGE on the timestamp, see migration 0011), the queries on
+  `SensorValueHistoryModel` only read the partitions of their time range
+- the other databases: one plain table per month with the same columns and
+  indexes, read and written through the models of `getMonthModel`. The
+  `sensorHistoryTable` of these databases stays empty. The ids are only unique
+  within a month.
+
+Use `getHistoryPartitions()` instead of `SensorValueHistoryModel.objects` to read
+or write the sensor history. The models it returns are filtered on `sensor_id`,
+which works for both kinds.
+
+The ingest creates the partition of a month on its first reading.
+`manage.py history_partitions` creates the next months ahead of time and detaches
+(or drops) the months older than RETAIN_MONTHS, which replaces the DELETE of the
+old readings.
+"""
+import datetime
+import re
+import threading
+
+from django.apps.registry import Apps
+from django.conf import settings
+from django.db import connections, models, router, transaction
+from django.utils import timezone
+
+from .models import SensorModel, SensorValueHistoryModel
+from .rollups import toUTC
+from .routers import APP_LABEL
+from .utils import TTLCache
+
+# the month models are kept out of the app registry, so the migrations never see them
+monthModelApps = Apps()
+monthModels = {}
+monthModelsLock = threading.Lock()
+
+
+def monthStart(timestamp):
+    return toUTC(timestamp).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def addMonths(month: datetime.datetime, count: int):
+    index = month.year * 12 + month.month - 1 + count
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+
+def monthRange(startTime, endTime):
+    """ The months from the month of `startTime` to the month of `endTime`, included """
+    month = monthStart(startTime)
+    lastMonth = monthStart(endTime)
+    months = []
+    while month <= lastMonth:
+        months.append(month)
+        month = addMonths(month, 1)
+    return months
+
+
+def parseMonth(text: str):
+    """ Parse "YYYY-MM" """
+    return datetime.datetime.strptime(text, "%Y-%m").replace(tzinfo=datetime.timezone.utc)
+
+
+def getMonthModel(month: datetime.datetime):
+    """
+    Unmanaged model of the `sensorHistoryTable_YYYYMM` table of the other databases,
+    with the columns, constraint and index of `SensorValueHistoryModel`. The sensor
+    is a plain `sensor_id` column, there is no relation to follow.
+    """
+    suffix = f"{month:%Y%m}"
+    with monthModelsLock:
+        model = monthModels.get(suffix, None)
+        if model is not None:
+            return model
+
+        class Meta:
+            apps = monthModelApps
+            app_label = APP_LABEL
+            db_table = f"{SensorValueHistoryModel._meta.db_table}_{suffix}"
+            managed = False
+            constraints = [
+                models.UniqueConstraint(
+                    fields=["sensor_id", "timestamp"], name=f"unique_sensor_history_{suffix}"),
+            ]
+            indexes = [
+                models.Index(
+                    fields=["sensor_id"], condition=models.Q(isCurrent=True), name=f"sensor_history_current_{suffix}"),
+            ]
+
+        model = type(f"SensorValueHistoryModel_{suffix}", (models.Model,), {
+            "__module__": __name__,
+            "Meta": Meta,
+            "id": models.BigAutoField(primary_key=True),
+            "sensor_id": models.BigIntegerField(null=True),
+            "timestamp": models.DateTimeField(),
+            "isCurrent": models.BooleanField(default=True),
+            "value": models.FloatField(),
+        })
+        monthModels[suffix] = model
+        return model
+
+
+class HistoryPartitions:
+    """
+    The monthly partitions of the sensor history on the database `alias`
+    """
+
+    def __init__(self, alias: str):
+        self.alias = alias
+        self.table = SensorValueHistoryModel._meta.db_table
+        self.namePattern = re.compile(rf"^{re.escape(self.table)}_(\d{{6}})$")
+        # current and next months whose partition exists, remembered once its
+        # creation committed. The current month is never detached.
+        self.knownMonths = TTLCache(
+            maxSize=1024, ttl=settings.GREENHOUSE_HISTORY_PARTITIONS["CACHE_TTL"])
+        # the result of `listMonths`, read by every history query
+        self.monthList = TTLCache(
+            maxSize=1, ttl=settings.GREENHOUSE_HISTORY_PARTITIONS["CACHE_TTL"])
+
+    @property
+    def connection(self):
+        return connections[self.alias]
+
+    def partitionName(self, month: datetime.datetime):
+        return f"{self.table}_{month:%Y%m}"
+
+    def listPartitionNames(self):
+        raise NotImplementedError
+
+    def listMonths(self):
+        """
+        The months with an attached partition, in order. The list is cached for
+        CACHE_TTL seconds: a month detached by another process is listed until then.
+        """
+        months = self.monthList.get("months")
+        if months is not None:
+            return months
+
+        months = []
+        for name in self.listPartitionNames():
+            match = self.namePattern.match(name)
+            if match is not None:
+                months.append(datetime.datetime.strptime(
+                    match.group(1), "%Y%m").replace(tzinfo=datetime.timezone.utc))
+        months.sort()
+
+        # a partition created by a transaction which can still roll back is not cached
+        if not self.connection.in_atomic_block:
+            self.monthList.set("months", months)
+        return months
+
+    def forgetMonths(self):
+        """ Read the months again on the next `listMonths`, after a partition changed """
+        self.monthList.clear()
+        if self.connection.in_atomic_block:
+            transaction.on_commit(self.monthList.clear, using=self.alias)
+
+    def clear(self):
+        self.knownMonths.clear()
+        self.monthList.clear()
+
+    def createMonth(self, month: datetime.datetime):
+        """ Create the partition of `month` unless it exists """
+        raise NotImplementedError
+
+    def detachMonth(self, month: datetime.datetime, drop: bool = False):
+        """
+        Remove the partition of `month` from the history. It is kept as the
+        `sensorHistoryTable_YYYYMM_detached` table, or dropped when `drop` is set.
+        """
+        raise NotImplementedError
+
+    def ensureMonths(self, timestamps):
+        """
+        Create the missing partitions of the months of `timestamps`. Only the current
+        and the next months are remembered: `manage.py history_partitions` may detach
+        a past month from another process, so the partitions of late readings are
+        checked again on each write.
+        """
+        currentMonth = monthStart(timezone.now())
+        for month in sorted({monthStart(timestamp) for timestamp in timestamps}):
+            if month >= currentMonth and self.knownMonths.get(month, False):
+                continue
+
+            self.createMonth(month)
+            if month >= currentMonth:
+                transaction.on_commit(
+                    lambda month=month: self.knownMonths.set(month, True), using=self.alias)
+
+    def models(self, startTime=None, endTime=None):
+        """ The models to query for the readings between `startTime` and `endTime` """
+        raise NotImplementedError
+
+    def groupByModel(self, instances: list):
+        """
+        Split `SensorValueHistoryModel` instances by the model storing them, return
+        `[(model, instances)]`
+        """
+        raise NotImplementedError
+
+    def clearCurrent(self, sensorIDs):
+        """ Set `isCurrent` to False on the current records of the sensors """
+        raise NotImplementedError
+
+    def absorbBaseTable(self):
+        """ Move the rows of `sensorHistoryTable` into the partitions, return their number """
+        return 0
+
+
+class NativePartitions(HistoryPartitions):
+    """
+    PostgreSQL partitions of `sensorHistoryTable`. The database routes the rows
+    and prunes the partitions, so the queries use `SensorValueHistoryModel`.
+    """
+
+    def listPartitionNames(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT child.relname FROM pg_inherits "
+                "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+                "WHERE pg_inherits.inhparent = %s::regclass",
+                [self.connection.ops.quote_name(self.table)],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+    def createMonth(self, month: datetime.datetime):
+        qn = self.connection.ops.quote_name
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                f"CREATE TABLE IF NOT EXISTS {qn(self.partitionName(month))} "
+                f"PARTITION OF {qn(self.table)} "
+                f"FOR VALUES FROM ('{month.isoformat()}') TO ('{addMonths(month, 1).isoformat()}')")
+        self.forgetMonths()
+
+    def detachMonth(self, month: datetime.datetime, drop: bool = False):
+        qn = self.connection.ops.quote_name
+        name = self.partitionName(month)
+        with transaction.atomic(using=self.alias), self.connection.cursor() as cursor:
+            cursor.execute(
+                f"ALTER TABLE {qn(self.table)} DETACH PARTITION {qn(name)}")
+            if drop:
+                cursor.execute(f"DROP TABLE {qn(name)}")
+            else:
+                cursor.execute(
+                    f"ALTER TABLE {qn(name)} RENAME TO {qn(name + '_detached')}")
+        self.knownMonths.pop(month)
+        self.forgetMonths()
+
+    def models(self, startTime=None, endTime=None):
+        return [SensorValueHistoryModel]
+
+    def groupByModel(self, instances: list):
+        return [(SensorValueHistoryModel, instances)]
+
+    def clearCurrent(self, sensorIDs):
+        # one UPDATE, each partition is searched with its partial index
+        SensorValueHistoryModel.objects.filter(
+            sensor__in=sensorIDs, isCurrent=True).update(isCurrent=False)
+
+
+class TablePartitions(HistoryPartitions):
+    """
+    One table per month, on the databases without native partitioning (SQLite)
+    """
+
+    def listPartitionNames(self):
+        with self.connection.cursor() as cursor:
+            return self.connection.introspection.table_names(cursor)
+
+    def createMonth(self, month: datetime.datetime):
+        if self.partitionName(month) in self.listPartitionNames():
+            return
+
+        model = getMonthModel(month)
+
+        def create(editor):
+            editor.create_model(model)
+            # the indexes of an unmanaged model are left out by `create_model`
+            for index in model._meta.indexes:
+                editor.add_index(model, index)
+
+        if not self.connection.in_atomic_block:
+            with self.connection.schema_editor() as editor:
+                create(editor)
+        else:
+            # the SQLite schema editor can not be entered inside the ingest
+            # transaction, where the foreign key checks can not be turned off. The
+            # month table has no foreign key, the statements the editor defers to
+            # its exit are run here.
+            editor = self.connection.schema_editor(atomic=False)
+            editor.deferred_sql = []
+            create(editor)
+            for sql in editor.deferred_sql:
+                editor.execute(sql)
+        self.forgetMonths()
+
+    def detachMonth(self, month: datetime.datetime, drop: bool = False):
+        qn = self.connection.ops.quote_name
+        name = self.partitionName(month)
+        with self.connection.cursor() as cursor:
+            if drop:
+                cursor.execute(f"DROP TABLE {qn(name)}")
+            else:
+                # the index names are global and follow a renamed table, the month
+                # could not be created again for its late readings
+                for index in getMonthModel(month)._meta.indexes:
+                    cursor.execute(f"DROP INDEX IF EXISTS {qn(index.name)}")
+                cursor.execute(
+                    f"ALTER TABLE {qn(name)} RENAME TO {qn(name + '_detached')}")
+        self.knownMonths.pop(month)
+        self.forgetMonths()
+
+    def models(self, startTime=None, endTime=None):
+        months = self.listMonths()
+        if startTime is not None:
+            months = [month for month in months if month >= monthStart(startTime)]
+        if endTime is not None:
+            months = [month for month in months if month <= monthStart(endTime)]
+        return [getMonthModel(month) for month in months]
+
+    def groupByModel(self, instances: list):
+        groups = {}
+        for instance in instances:
+            groups.setdefault(monthStart(instance.timestamp), []).append(instance)
+
+        return [
+            (getMonthModel(month), [
+                getMonthModel(month)(
+                    sensor_id=instance.sensor_id,
+                    timestamp=instance.timestamp,
+                    value=instance.value,
+                    isCurrent=instance.isCurrent,
+                )
+                for instance in monthInstances
+            ])
+            for month, monthInstances in sorted(groups.items())
+        ]
+
+    def clearCurrent(self, sensorIDs):
+        # the current record of a sensor is its reading at currentTimestamp, so only
+        # the months of these timestamps are updated
+        timestamps = SensorModel.objects.filter(
+            id__in=sensorIDs, currentTimestamp__isnull=False).values_list("currentTimestamp", flat=True)
+        months = {monthStart(timestamp) for timestamp in timestamps}
+        for month in sorted(months & set(self.listMonths())):
+            getMonthModel(month).objects.filter(
+                sensor_id__in=sensorIDs, isCurrent=True).update(isCurrent=False)
+
+    def absorbBaseTable(self):
+        """
+        Move the rows of `sensorHistoryTable` into the month tables, one month per
+        transaction. The readings already stored in a month table are not copied
+        again, so an interrupted move can be restarted.
+        """
+        connection = self.connection
+        qn = connection.ops.quote_name
+        columns = ", ".join(qn(c)
+                            for c in ["id", "sensor_id", "timestamp", "isCurrent", "value"])
+        bounds = SensorValueHistoryModel.objects.using(self.alias).aggregate(
+            first=models.Min("timestamp"), last=models.Max("timestamp"))
+        if bounds["first"] is None:
+            return 0
+
+        movedCount = 0
+        for month in monthRange(bounds["first"], bounds["last"]):
+            params = [
+                connection.ops.adapt_datetimefield_value(month),
+                connection.ops.adapt_datetimefield_value(addMonths(month, 1)),
+            ]
+            with transaction.atomic(using=self.alias), connection.cursor() as cursor:
+                self.createMonth(month)
+                partition = qn(self.partitionName(month))
+                cursor.execute(
+                    f"INSERT INTO {partition} ({columns}) "
+                    f"SELECT {columns} FROM {qn(self.table)} AS base "
+                    f"WHERE base.{qn('timestamp')} >= %s AND base.{qn('timestamp')} < %s "
+                    f"AND NOT EXISTS (SELECT 1 FROM {partition} AS stored "
+                    f"WHERE stored.{qn('sensor_id')} = base.{qn('sensor_id')} "
+                    f"AND stored.{qn('timestamp')} = base.{qn('timestamp')})",
+                    params,
+                )
+                movedCount += cursor.rowcount
+                cursor.execute(
+                    f"DELETE FROM {qn(self.table)} "
+                    f"WHERE {qn('timestamp')} >= %s AND {qn('timestamp')} < %s",
+                    params,
+                )
+
+        return movedCount
+
+
+historyPartitions = {}
+historyPartitionsLock = threading.Lock()
+
+
+def getHistoryPartitions(alias: str = None):
+    """ The partitions of the sensor history database, or of the database `alias` """
+    if alias is None:
+        alias = router.db_for_write(SensorValueHistoryModel)
+
+    with historyPartitionsLock:
+        partitions = historyPartitions.get(alias, None)
+        if partitions is None:
+            if connections[alias].vendor == "postgresql":
+                partitions = NativePartitions(alias)
+            else:
+                partitions = TablePartitions(alias)
+            historyPartitions[alias] = partitions
+        return partitions
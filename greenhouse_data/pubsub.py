@@ -0,0 +1,234 @@
+"""
+Publish / subscribe of the greenhouse updates pushed to the app and the controllers
+(server-sent events, websockets and the controller long-poll). Every greenhouse has
+a channel for new sensor readings and one for controller setting changes.
+
+The broker is set by GREENHOUSE_PUBSUB. `LocalBroker` fans messages out to the
+subscribers of the same process. `RedisBroker` publishes through redis, so the
+subscribers of every worker receive the messages of every other worker.
+"""
+import asyncio
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+from .models import *
+from .rollups import toUTC
+
+logger = logging.getLogger(__name__)
+
+CHANNEL_PREFIX = "greenhouse"
+
+
+def sensorChannel(greenhouseUID):
+    return f"{CHANNEL_PREFIX}:{greenhouseUID}:sensors"
+
+
+def controllerChannel(greenhouseUID):
+    return f"{CHANNEL_PREFIX}:{greenhouseUID}:controllers"
+
+
+class Subscription:
+    """
+    Queue of the messages of some channels, read by one request on its event loop.
+    When the reader is too slow the oldest messages are dropped.
+    """
+
+    def __init__(self, broker, channels: list, maxQueue: int):
+        self.broker = broker
+        self.channels = channels
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=maxQueue)
+        self.dropped = 0
+
+    def _put(self, message):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(message)
+
+    def deliver(self, message):
+        """ Thread safe, called by the broker """
+        try:
+            self.loop.call_soon_threadsafe(self._put, message)
+        except RuntimeError:
+            # the loop of the request is closed
+            pass
+
+    async def get(self, timeout: float = None):
+        """ Wait for the next message, raise asyncio.TimeoutError after `timeout` """
+        return await asyncio.wait_for(self.queue.get(), timeout)
+
+    def drain(self):
+        """ Drop the queued messages """
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class LocalBroker:
+    """
+    Fan out the messages to the subscriptions of this process
+    """
+
+    def __init__(self, maxQueue: int = 100):
+        self.maxQueue = maxQueue
+        self._subscriptions = {}
+        self._lock = threading.Lock()
+        self.published = 0
+        self.delivered = 0
+
+    def subscribe(self, channels: list):
+        subscription = Subscription(self, channels, self.maxQueue)
+        with self._lock:
+            for channel in channels:
+                self._subscriptions.setdefault(
+                    channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            for channel in subscription.channels:
+                subscriptions = self._subscriptions.get(channel, None)
+                if subscriptions is None:
+                    continue
+
+                subscriptions.discard(subscription)
+                if len(subscriptions) == 0:
+                    del self._subscriptions[channel]
+
+    def wantsMessages(self):
+        """ Publishers skip building messages nobody would receive """
+        return len(self._subscriptions) != 0
+
+    def publish(self, channel: str, message: dict):
+        with self._lock:
+            self.published += 1
+        self.fanOut(channel, message)
+
+    def fanOut(self, channel: str, message: dict):
+        """ Deliver a message to the subscriptions of this process """
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(channel, ()))
+            self.delivered += len(subscriptions)
+
+        for subscription in subscriptions:
+            subscription.deliver(message)
+
+    def stats(self):
+        """
+        `published` counts the messages published by this process, with either
+        backend, and `delivered` the messages handed to its subscriptions
+        """
+        with self._lock:
+            return {
+                "backend": self.__class__.__name__,
+                "channels": len(self._subscriptions),
+                "subscriptions": len({s for subs in self._subscriptions.values() for s in subs}),
+                "published": self.published,
+                "delivered": self.delivered,
+            }
+
+
+class RedisBroker(LocalBroker):
+    """
+    Publish the messages to redis. A listener thread receives the messages of every
+    worker and fans them out to the subscriptions of this process.
+    """
+
+    def __init__(self, url: str = "redis://localhost:6379/0", maxQueue: int = 100):
+        super().__init__(maxQueue=maxQueue)
+        try:
+            import redis
+        except ImportError:
+            raise ImproperlyConfigured(
+                "RedisBroker requires the redis package")
+
+        self.client = redis.Redis.from_url(url)
+        self.listener = threading.Thread(
+            target=self._listen, name="greenhouse-pubsub", daemon=True)
+        self.listener.start()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(f"{CHANNEL_PREFIX}:*")
+                for item in pubsub.listen():
+                    self.fanOut(item["channel"].decode(),
+                                json.loads(item["data"]))
+            except Exception:
+                logger.exception("pubsub listener error, reconnecting")
+                time.sleep(1)
+
+    def wantsMessages(self):
+        # the subscribers of the other workers are unknown
+        return True
+
+    def publish(self, channel: str, message: dict):
+        with self._lock:
+            self.published += 1
+        # delivered here by the listener, like the messages of the other workers
+        self.client.publish(channel, json.dumps(
+            message, cls=DjangoJSONEncoder))
+
+
+def publishOnCommit(channel: str, message: dict):
+    """ Publish once the current transaction commits, or now in autocommit mode """
+    transaction.on_commit(lambda: broker.publish(channel, message))
+
+
+def publishSensorValues(instances: list):
+    """
+    Publish the readings written by `bulkCreateSensorValues`, one message per
+    greenhouse
+
+    #### Message format
+    ```
+    {
+        "type": "sensors",
+        "sensors": [
+            {"realSensorID": "AirSensor_1", "sensorKey": "airTemp", "value": 31, "timestamp": "2024-04-03T17:04:04+00:00"}
+        ]
+    }
+    ```
+    """
+    if len(instances) == 0 or not broker.wantsMessages():
+        return
+
+    sensors = {
+        id: (greenhouseUID, realSensorID, sensorKey)
+        for id, greenhouseUID, realSensorID, sensorKey in SensorModel.objects.filter(
+            id__in=[instance.sensor_id for instance in instances],
+        ).values_list("id", "realSensor__greenhouse", "realSensor__realSensorID", "sensorKey")
+    }
+
+    messages = {}
+    for instance in instances:
+        greenhouseUID, realSensorID, sensorKey = sensors[instance.sensor_id]
+        messages.setdefault(greenhouseUID, {"type": "sensors", "sensors": []})["sensors"].append({
+            "realSensorID": realSensorID,
+            "sensorKey": sensorKey,
+            "value": instance.value,
+            "timestamp": toUTC(instance.timestamp).isoformat(),
+        })
+
+    for greenhouseUID, message in messages.items():
+        publishOnCommit(sensorChannel(greenhouseUID), message)
+
+
+def createBroker():
+    config = settings.GREENHOUSE_PUBSUB
+    return import_string(config["BACKEND"])(**config.get("OPTIONS", {}))
+
+
+broker = createBroker()
@@ -0,0 +1,185 @@
+"""
+ASGI push channels of the greenhouse updates published through `pubsub.broker`.
+
+- server-sent events: `gh/greenhouse/<greenhouseUID>/events` for the controllers and
+  `app/greenhouse/<greenhouseUID>/events` for the app (token required)
+- websocket: `ws/gh/greenhouse/<greenhouseUID>` and
+  `ws/app/greenhouse/<greenhouseUID>?token=<token>`, routed by `myproject/asgi.py`
+
+The gh/ channels check the device signature like the other gh/ endpoints (see
+device_auth.py), the websocket signs "GET" and its path.
+
+Every message is one json object, see `pubsub.publishSensorValues` and
+`ControllerSettingSerializer.create` for the formats. Keep-alive comments (server-sent
+events) or `{"type": "keepalive"}` messages (websocket) are sent when nothing was
+published for GREENHOUSE_PUSH_KEEPALIVE seconds.
+"""
+import asyncio
+import json
+import re
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core import exceptions
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils.datastructures import CaseInsensitiveMapping
+from django.views import View
+from rest_framework import status
+from rest_framework.exceptions import AuthenticationFailed
+
+from myapp.authentication import CachedTokenAuthentication, getOwnedGreenhouses
+
+from .device_auth import EMPTY_BODY_DIGEST, checkDeviceRequest
+from .models import *
+from .pubsub import broker, controllerChannel, sensorChannel
+
+
+@sync_to_async
+def greenhouseExists(greenhouseUID):
+    try:
+        return GreenhouseModel.objects.filter(greenhouseUID=greenhouseUID).exists()
+    except exceptions.ValidationError:
+        return False
+
+
+@sync_to_async
+def isGreenhouseOwner(greenhouseUID, tokenKey: str):
+    """ Check the token like the app APIs, through the authentication caches """
+    if not tokenKey:
+        return False
+
+    try:
+        user, token = CachedTokenAuthentication().authenticate_credentials(tokenKey)
+    except AuthenticationFailed:
+        return False
+
+    return str(greenhouseUID) in getOwnedGreenhouses(user)
+
+
+@sync_to_async
+def checkDeviceSignature(greenhouseUID, headers, method: str, path: str):
+    """ Check the signature like the gh/ APIs, the body is always empty here """
+    return checkDeviceRequest(greenhouseUID, headers, method, path, lambda: EMPTY_BODY_DIGEST)
+
+
+def subscribeGreenhouse(greenhouseUID):
+    return broker.subscribe([sensorChannel(greenhouseUID), controllerChannel(greenhouseUID)])
+
+
+class GreenhouseEventsAPI(View):
+    """
+    Server-sent events of a greenhouse for the controllers. Like the other gh/
+    endpoints, the request must be signed with the device key once the greenhouse
+    has one, see device_auth.py.
+    """
+
+    async def authorize(self, request, greenhouseUID):
+        if not await greenhouseExists(greenhouseUID):
+            return JsonResponse({"message": "greenhouse not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        reason = await checkDeviceSignature(greenhouseUID, request.headers, request.method, request.path)
+        if reason is not None:
+            return JsonResponse({"message": reason}, status=status.HTTP_401_UNAUTHORIZED)
+        return None
+
+    async def events(self, subscription):
+        keepalive = settings.GREENHOUSE_PUSH_KEEPALIVE
+        try:
+            yield ": connected\n\n"
+            while True:
+                try:
+                    message = await subscription.get(keepalive)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+
+                yield f"event: {message['type']}\ndata: {json.dumps(message, cls=DjangoJSONEncoder)}\n\n"
+        finally:
+            subscription.close()
+
+    async def get(self, request, greenhouseUID):
+        errorResponse = await self.authorize(request, greenhouseUID)
+        if errorResponse is not None:
+            return errorResponse
+
+        response = StreamingHttpResponse(
+            self.events(subscribeGreenhouse(greenhouseUID)),
+            content_type="text/event-stream",
+        )
+        response["Cache-Control"] = "no-cache"
+        response["X-Accel-Buffering"] = "no"
+        return response
+
+
+class AppGreenhouseEventsAPI(GreenhouseEventsAPI):
+    """
+    Server-sent events of a greenhouse for the app. The token is sent as
+    "Authorization: Token <token>", or as `?token=<token>` since EventSource can not
+    set headers.
+    """
+
+    async def authorize(self, request, greenhouseUID):
+        tokenKey = request.GET.get("token", None)
+        authorization = request.headers.get("Authorization", "").split()
+        if len(authorization) == 2 and authorization[0] == "Token":
+            tokenKey = authorization[1]
+
+        if not await isGreenhouseOwner(greenhouseUID, tokenKey):
+            return JsonResponse({"error": "not permitted to get greenhouse"}, status=status.HTTP_403_FORBIDDEN)
+        return None
+
+
+WEBSOCKET_PATH = re.compile(r"^/ws/(gh|app)/greenhouse/([^/]+)/?$")
+
+
+async def websocketApplication(scope, receive, send):
+    """
+    ASGI application of the websocket push channel. Messages sent by the client
+    are ignored.
+    """
+    match = WEBSOCKET_PATH.match(scope["path"])
+    if match is None:
+        await send({"type": "websocket.close", "code": 4404})
+        return
+
+    side, greenhouseUID = match.groups()
+    if (await receive())["type"] != "websocket.connect":
+        return
+
+    if side == "app":
+        tokenKey = parse_qs(scope["query_string"].decode()).get("token", [None])[0]
+        permitted = await isGreenhouseOwner(greenhouseUID, tokenKey)
+    else:
+        headers = CaseInsensitiveMapping({
+            name.decode("latin-1"): value.decode("latin-1") for name, value in scope.get("headers", [])
+        })
+        permitted = await greenhouseExists(greenhouseUID) and await checkDeviceSignature(
+            greenhouseUID, headers, "GET", scope["path"]) is None
+
+    if not permitted:
+        await send({"type": "websocket.close", "code": 4403})
+        return
+
+    await send({"type": "websocket.accept"})
+    subscription = subscribeGreenhouse(greenhouseUID)
+
+    async def forward():
+        keepalive = settings.GREENHOUSE_PUSH_KEEPALIVE
+        while True:
+            try:
+                message = await subscription.get(keepalive)
+            except asyncio.TimeoutError:
+                message = {"type": "keepalive"}
+            await send({"type": "websocket.send", "text": json.dumps(message, cls=DjangoJSONEncoder)})
+
+    forwardTask = asyncio.create_task(forward())
+    try:
+        while True:
+            event = await receive()
+            if event["type"] == "websocket.disconnect":
+                break
+    finally:
+        forwardTask.cancel()
+        subscription.close()
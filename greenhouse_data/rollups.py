@@ -0,0 +1,172 @@
+"""
+Incremental maintenance of the hourly and daily sensor rollups. The helpers take the
+rollup model as a parameter so the data migrations can use their historical models.
+"""
+import datetime
+
+from django.db import connections, router
+from django.db.models import Max, Min
+from django.db.models.functions import Trunc
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+
+def toUTC(timestamp):
+    if isinstance(timestamp, str):
+        timestamp = parse_datetime(timestamp)
+    if timezone.is_naive(timestamp):
+        timestamp = timezone.make_aware(timestamp)
+    return timestamp.astimezone(datetime.timezone.utc)
+
+
+def hourBucket(timestamp):
+    return toUTC(timestamp).replace(minute=0, second=0, microsecond=0)
+
+
+def dayBucket(timestamp):
+    return toUTC(timestamp).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def aggregateReadings(readings, truncate):
+    """
+    Aggregate `(sensorID, timestamp, value, count, valueSum)` readings into
+    `{(sensorID, bucket): [count, valueSum, valueMin, valueMax, lastTimestamp, lastValue]}`.
+    A new reading has count 1 and its value as valueSum. A replayed reading has count 0
+    and the difference to the stored value as valueSum.
+    """
+    aggregates = {}
+    for sensorID, timestamp, value, count, valueSum in readings:
+        timestamp = toUTC(timestamp)
+        key = (sensorID, truncate(timestamp))
+        aggregate = aggregates.get(key, None)
+        if aggregate is None:
+            aggregates[key] = [count, valueSum, value, value, timestamp, value]
+            continue
+
+        aggregate[0] += count
+        aggregate[1] += valueSum
+        aggregate[2] = min(aggregate[2], value)
+        aggregate[3] = max(aggregate[3], value)
+        if timestamp >= aggregate[4]:
+            aggregate[4] = timestamp
+            aggregate[5] = value
+
+    return aggregates
+
+
+def upsertRollups(rollupModel, aggregates: dict):
+    """
+    Merge aggregates into the rollup table with one INSERT ... ON CONFLICT DO UPDATE,
+    so concurrent writers add to the same bucket without losing updates
+    """
+    if len(aggregates) == 0:
+        return
+
+    connection = connections[router.db_for_write(rollupModel)]
+    qn = connection.ops.quote_name
+    table = qn(rollupModel._meta.db_table)
+    least, greatest = ("LEAST", "GREATEST") if connection.vendor == "postgresql" else (
+        "MIN", "MAX")
+
+    columns = ["sensor_id", "bucket", "count", "valueSum",
+               "valueMin", "valueMax", "lastTimestamp", "lastValue"]
+    sql = (
+        f"INSERT INTO {table} ({', '.join(qn(c) for c in columns)}) "
+        f"VALUES ({', '.join(['%s'] * len(columns))}) "
+        f"ON CONFLICT ({qn('sensor_id')}, {qn('bucket')}) DO UPDATE SET "
+        f"{qn('count')} = {table}.{qn('count')} + EXCLUDED.{qn('count')}, "
+        f"{qn('valueSum')} = {table}.{qn('valueSum')} + EXCLUDED.{qn('valueSum')}, "
+        f"{qn('valueMin')} = {least}({table}.{qn('valueMin')}, EXCLUDED.{qn('valueMin')}), "
+        f"{qn('valueMax')} = {greatest}({table}.{qn('valueMax')}, EXCLUDED.{qn('valueMax')}), "
+        f"{qn('lastValue')} = CASE WHEN EXCLUDED.{qn('lastTimestamp')} >= {table}.{qn('lastTimestamp')} "
+        f"THEN EXCLUDED.{qn('lastValue')} ELSE {table}.{qn('lastValue')} END, "
+        f"{qn('lastTimestamp')} = {greatest}({table}.{qn('lastTimestamp')}, EXCLUDED.{qn('lastTimestamp')})"
+    )
+
+    params = [
+        (
+            sensorID,
+            connection.ops.adapt_datetimefield_value(bucket),
+            count,
+            valueSum,
+            valueMin,
+            valueMax,
+            connection.ops.adapt_datetimefield_value(lastTimestamp),
+            lastValue,
+        )
+        for (sensorID, bucket), (count, valueSum, valueMin, valueMax, lastTimestamp, lastValue) in aggregates.items()
+    ]
+
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, params)
+
+
+# the length of the buckets of each Trunc kind
+BUCKET_SPANS = {"hour": datetime.timedelta(hours=1), "day": datetime.timedelta(days=1)}
+
+
+def recomputeRollupExtremes(rollupModel, kind: str, keys: set, historyModels: list):
+    """
+    Set `valueMin` / `valueMax` of the rollups of the `(sensorID, bucket)` keys from
+    the raw history. The upsert only widens them, a replaced value may have been the
+    minimum or the maximum of its bucket.
+    """
+    if len(keys) == 0:
+        return
+
+    buckets = [bucket for _, bucket in keys]
+    extremes = {}
+    for historyModel in historyModels:
+        rows = historyModel.objects.filter(
+            sensor_id__in={sensorID for sensorID, _ in keys},
+            timestamp__gte=min(buckets),
+            timestamp__lt=max(buckets) + BUCKET_SPANS[kind],
+        ).annotate(
+            bucket=Trunc("timestamp", kind, tzinfo=datetime.timezone.utc),
+        ).values("sensor_id", "bucket").annotate(
+            valueMin=Min("value"), valueMax=Max("value"),
+        ).order_by()
+        for row in rows:
+            key = (row["sensor_id"], toUTC(row["bucket"]))
+            if key in keys:
+                extremes[key] = (row["valueMin"], row["valueMax"])
+
+    rollups = list(rollupModel.objects.filter(
+        sensor_id__in={sensorID for sensorID, _ in keys},
+        bucket__in=set(buckets),
+    ))
+    for rollup in rollups:
+        rollup.valueMin, rollup.valueMax = extremes.get(
+            (rollup.sensor_id, toUTC(rollup.bucket)), (rollup.valueMin, rollup.valueMax))
+    rollupModel.objects.bulk_update(rollups, ["valueMin", "valueMax"])
+
+
+def updateSensorRollups(HourlyRollupModel, DailyRollupModel, readings, historyModels: list = None):
+    """
+    Add readings to the hourly and daily rollups. Each reading is
+    `(sensorID, timestamp, value, previousValue)`, where `previousValue` is the value
+    already stored for the same sensor and timestamp, or None for a new reading.
+    The extremes of the buckets where a value was replaced by another one are read
+    again from `historyModels`, the history models holding these readings.
+    """
+    rollupReadings = []
+    replaced = []
+    for sensorID, timestamp, value, previousValue in readings:
+        if previousValue is None:
+            rollupReadings.append((sensorID, timestamp, value, 1, value))
+        else:
+            rollupReadings.append(
+                (sensorID, timestamp, value, 0, value - previousValue))
+            if previousValue != value:
+                replaced.append((sensorID, timestamp))
+
+    upsertRollups(HourlyRollupModel, aggregateReadings(
+        rollupReadings, hourBucket))
+    upsertRollups(DailyRollupModel, aggregateReadings(
+        rollupReadings, dayBucket))
+
+    if historyModels is not None:
+        for rollupModel, kind, truncate in [(HourlyRollupModel, "hour", hourBucket), (DailyRollupModel, "day", dayBucket)]:
+            recomputeRollupExtremes(rollupModel, kind, {
+                (sensorID, truncate(timestamp)) for sensorID, timestamp in replaced
+            }, historyModels)
@@ -0,0 +1,194 @@
+"""
+Database routing of the greenhouse models. The sensor and controller history, the
+schedules and the rollups grow without bound, while the greenhouses, the devices and
+the auth tables stay small and are read by every request. `HistoryRouter` puts the
+history models on the GREENHOUSE_HISTORY_DATABASE alias, so vacuuming or bulk
+loading the history does not evict or lock the metadata.
+
+A query can not join tables of two databases:
+
+- the foreign keys between the two sides have no database constraint and do not
+  cascade, the deletions are propagated by `signals.py` once they commit
+- the current setting of the controllers is loaded with `prefetch_related`, never
+  with `select_related`
+- writes touching both sides use `atomicWithHistory`
+
+The history tables stay on the default database when the alias is not configured,
+which is always the case with SQLite: `atomicWithHistory` can not make a write
+atomic across two SQLite files. Both databases are migrated with every table. With
+the alias configured, the migration 0010 drops the foreign key constraints between
+the two sides, otherwise they are kept and `signals.py` deletes the history in the
+transaction of the device deletion.
+
+`ReplicaRouter` sends the reads of the app GET requests to the read replicas of
+GREENHOUSE_READ_REPLICAS (see `AppBaseAPI`). Everything else, the writes and the gh/
+ingest included, uses the primary databases. A user is pinned to the primaries for
+a few seconds after each of their own writes, so they read their changes even when
+the replicas lag behind.
+"""
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+APP_LABEL = "greenhouse_data"
+
+HISTORY_MODELS = {
+    "sensorvaluehistorymodel",
+    "controllersettinghistorymodel",
+    "schedulemodel",
+    "sensorhourlyrollupmodel",
+    "sensordailyrollupmodel",
+}
+
+# the models of the monthly sensor history tables, see partitions.py
+HISTORY_PARTITION_PREFIX = "sensorvaluehistorymodel_"
+
+
+def getHistoryDatabase():
+    """ The alias of the history models, "default" when they are not split """
+    alias = getattr(settings, "GREENHOUSE_HISTORY_DATABASE", None)
+    if alias is None or alias not in settings.DATABASES:
+        return DEFAULT_DB_ALIAS
+    return alias
+
+
+def isHistoryModel(appLabel: str, modelName: str):
+    return appLabel == APP_LABEL and (
+        modelName in HISTORY_MODELS or modelName.startswith(HISTORY_PARTITION_PREFIX))
+
+
+class HistoryRouter:
+    """
+    Route the history models to `getHistoryDatabase()`, and only them. Every table is
+    created on both databases, the other side stays empty.
+    """
+
+    def getDatabase(self, model):
+        if isHistoryModel(model._meta.app_label, model._meta.model_name):
+            return getHistoryDatabase()
+        return None
+
+    def db_for_read(self, model, **hints):
+        return self.getDatabase(model)
+
+    def db_for_write(self, model, **hints):
+        return self.getDatabase(model)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the relations between the two sides have no database constraint
+        if obj1._meta.app_label == APP_LABEL and obj2._meta.app_label == APP_LABEL:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        history = getHistoryDatabase()
+        if history == DEFAULT_DB_ALIAS:
+            return None
+
+        if model_name is None:
+            # data migrations without a model_name hint only run on the default database
+            return db != history
+        # the shipped migrations create foreign keys between the two sides, the tables
+        # they reference must exist on both databases
+        return None
+
+
+@contextmanager
+def atomicWithHistory():
+    """
+    `transaction.atomic` on the default database and on the history database. This is
+    not a distributed transaction: the history transaction commits first, and a failed
+    commit of the default database can leave history records nothing points to. The
+    devices never point to history records which were not committed.
+    """
+    history = getHistoryDatabase()
+    with transaction.atomic():
+        if history == DEFAULT_DB_ALIAS:
+            yield
+            return
+
+        with transaction.atomic(using=history):
+            yield
+
+
+def setRollbackWithHistory(rollback: bool):
+    """ `transaction.set_rollback` of both transactions of `atomicWithHistory` """
+    transaction.set_rollback(rollback)
+    if getHistoryDatabase() != DEFAULT_DB_ALIAS:
+        transaction.set_rollback(rollback, using=getHistoryDatabase())
+
+
+# set for the requests allowed to read from the replicas
+replicaReads = ContextVar("greenhouseReplicaReads", default=False)
+
+
+def getReplicas(primary: str):
+    """ The configured replica aliases of the `primary` alias """
+    replicas = settings.GREENHOUSE_READ_REPLICAS["DATABASES"].get(primary, [])
+    return [alias for alias in replicas if alias in settings.DATABASES]
+
+
+def hasReplicas():
+    return any(getReplicas(primary) for primary in settings.GREENHOUSE_READ_REPLICAS["DATABASES"])
+
+
+class ReplicaRouter:
+    """
+    Route the reads to a random replica of the database of the model while
+    `replicaReads` is set. Must come before `HistoryRouter` in DATABASE_ROUTERS.
+    """
+
+    def getPrimary(self, model):
+        return HistoryRouter().getDatabase(model) or DEFAULT_DB_ALIAS
+
+    def db_for_read(self, model, **hints):
+        if not replicaReads.get():
+            return None
+
+        replicas = getReplicas(self.getPrimary(model))
+        if len(replicas) == 0:
+            return None
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        # an instance read from a replica is saved to the primary
+        if hasReplicas():
+            return self.getPrimary(model)
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the instances of a replica and of its primary are the same rows
+        if hasReplicas() and obj1._state.db in settings.DATABASES and obj2._state.db in settings.DATABASES:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # the replicas are migrated through their primary
+        for primary in settings.GREENHOUSE_READ_REPLICAS["DATABASES"]:
+            if db in getReplicas(primary):
+                return False
+        return None
+
+
+def getPinKey(user):
+    return f"greenhouse-primary-pin:{user.id}"
+
+
+def pinToPrimary(user):
+    """ Read from the primaries for the next PIN_SECONDS """
+    if not hasReplicas() or not user.is_authenticated:
+        return
+
+    config = settings.GREENHOUSE_READ_REPLICAS
+    caches[config["PIN_CACHE"]].set(
+        getPinKey(user), True, config["PIN_SECONDS"])
+
+
+def isPinnedToPrimary(user):
+    if not hasReplicas() or not user.is_authenticated:
+        return False
+    return caches[settings.GREENHOUSE_READ_REPLICAS["PIN_CACHE"]].get(getPinKey(user), False)
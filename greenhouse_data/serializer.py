@@ -1,12 +1,15 @@
 from datetime import datetime, timedelta
 
 from django.contrib.auth.models import User
+from django.db.models import prefetch_related_objects
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 from rest_framework.utils import html, model_meta, representation
 
 from django.core.exceptions import ValidationError as DjangoValidationError
 from greenhouse_data.models import *
+from greenhouse_data.ingest import bulkCreateControllerSettings, bulkCreateSensorValues
+from greenhouse_data.pubsub import broker, controllerChannel, publishOnCommit
 
 """
 The propose of the serializers is to
@@ -14,11 +17,59 @@ The propose of the serializers is to
 2. turn the model instance into json format
 """
 
+"""
+Common fields
+"""
+
+
+class PrefetchedPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    """
+    Primary key field that resolves the instance from a map preloaded into the
+    serializer context (`context[prefetchKey] = {pk: instance}`) by the parent
+    list serializer, and only queries the database for keys not in the map
+    """
+
+    def __init__(self, prefetchKey, **kwargs):
+        self.prefetchKey = prefetchKey
+        super().__init__(**kwargs)
+
+    def to_internal_value(self, data):
+        prefetched = self.context.get(self.prefetchKey, {})
+        if not isinstance(data, bool) and data in prefetched:
+            return prefetched[data]
+        return super().to_internal_value(data)
+
+
 """
 Sensors
 """
 
 
+class SensorValueHistoryListSerializer(serializers.ListSerializer):
+    """
+    Validate and save a whole batch of sensor readings. All referenced sensors
+    are loaded with one query before validation and the batch is written with
+    `bulkCreateSensorValues` instead of one `create()` per reading. Sensors
+    already in `context["sensors"]` are not loaded again, so the same map can be
+    shared by several batches.
+    """
+
+    def to_internal_value(self, data):
+        if isinstance(data, list):
+            sensorIDs = {
+                item["sensor"] for item in data
+                if isinstance(item, dict) and isinstance(item.get("sensor", None), int)
+            }
+            prefetched = self._context.setdefault("sensors", {})
+            missingIDs = sensorIDs - prefetched.keys()
+            if missingIDs:
+                prefetched.update(SensorModel.objects.in_bulk(missingIDs))
+        return super().to_internal_value(data)
+
+    def create(self, validated_data):
+        return bulkCreateSensorValues(validated_data)
+
+
 class SensorValueHistorySerializer(serializers.ModelSerializer):
     """
     Convert json data to sensor value history instance / convert sensor value history instance into dictionary
@@ -33,38 +84,32 @@ class SensorValueHistorySerializer(serializers.ModelSerializer):
     ```
     """
 
+    sensor = PrefetchedPrimaryKeyRelatedField(
+        prefetchKey="sensors",
+        queryset=SensorModel.objects.all(),
+        allow_null=True,
+        required=False,
+    )
+
     class Meta:
         model = SensorValueHistoryModel
         fields = '__all__'
-
-    def __pushLastCurrent(self, sensor):
-        sensorDatas = list(SensorValueHistoryModel.objects.filter(
-            sensor=sensor, isCurrent=True))
-        if (len(sensorDatas) == 0):
-            return True
-        if (len(sensorDatas) == 1):
-            sensorDatas[0].isCurrent = False
-            sensorDatas[0].save()
-            return True
-        if (len(sensorDatas) > 1):
-            for setting in sensorDatas:
-                setting.isCurrent = False
-            print(
-                "warning: multiple instances have isCurrent == True, something might went wrong")
-            return True
+        list_serializer_class = SensorValueHistoryListSerializer
+        # duplicated (sensor, timestamp) are upserted instead of rejected
+        validators = []
 
     def create(self, validated_data):
         """
         Update sensor data is actually creating new sensor data history
-        instance. In the `create` method from controller setting serializer,
-        the last current data will be set to `isCurrent = False` automatically.
+        instance. The write goes through `bulkCreateSensorValues`, so the last
+        current data is set to `isCurrent = False`, and the current value of the
+        sensor and its rollups are updated in the same transaction.
         """
         if validated_data.setdefault("sensor", None) is None:
             raise serializers.ValidationError(
                 {"sensor instance is not provided"})
-        self.__pushLastCurrent(validated_data["sensor"])
-        sensorData = SensorValueHistoryModel.objects.create(
-            **validated_data)
+
+        sensorData = bulkCreateSensorValues([validated_data])[0]
         return sensorData
 
     def to_representation(self, instance):
@@ -107,6 +152,8 @@ class SensorSerializer(serializers.ModelSerializer):
     class Meta:
         model = SensorModel
         fields = '__all__'
+        read_only_fields = ["currentValue",
+                            "currentTimestamp", "changeVersion"]
 
     def getClosestHour(self, timestamp):
         roundedTime = timestamp.replace(
@@ -145,13 +192,8 @@ class SensorSerializer(serializers.ModelSerializer):
             "sensorKey": instance.sensorKey,
             "itemName": instance.itemName,
             "realSensorID": instance.realSensor.realSensorID,
+            "value": instance.currentValue,
         }
-        currentSensorData = list(SensorValueHistoryModel.objects.filter(
-            sensor=instance).filter(isCurrent=True))
-        if len(currentSensorData) == 0:
-            ret["value"] = None
-            return ret
-        ret["value"] = currentSensorData[0].value
 
         return ret
 
@@ -211,6 +253,7 @@ class RealSensorSerializer(serializers.ModelSerializer):
     class Meta:
         model = RealSensorModel
         fields = '__all__'
+        read_only_fields = ["changeVersion"]
 
     def run_validation(self, data=...):
         data["sensors"] = toList(data.setdefault(
@@ -274,6 +317,8 @@ class RealSensorSerializer(serializers.ModelSerializer):
 
     def to_representation(self, instance):
         ret = super().to_representation(instance)
+        # only the delta of `getGreenhouseDelta` sends the change versions
+        ret.pop("changeVersion", None)
         return ret
 
 
@@ -303,6 +348,34 @@ class EValveScheduleSerializer(serializers.ModelSerializer):
         return instance
 
 
+class ControllerSettingListSerializer(serializers.ListSerializer):
+    """
+    Validate and save the settings reported for several controllers at once. The
+    referenced controllers are loaded with their current setting in one query
+    before validation, unless they are already in `context["controllers"]`, and
+    the batch is written with `bulkCreateControllerSettings`.
+    """
+
+    def to_internal_value(self, data):
+        if isinstance(data, list):
+            controllerIDs = {
+                item["controller"] for item in data
+                if isinstance(item, dict) and isinstance(item.get("controller", None), int)
+            }
+            prefetched = self._context.setdefault("controllers", {})
+            missingIDs = controllerIDs - prefetched.keys()
+            if missingIDs:
+                prefetched.update(ControllerModel.objects.prefetch_related(
+                    "currentSetting__schedules").in_bulk(missingIDs))
+        return super().to_internal_value(data)
+
+    def create(self, validated_data):
+        currentSettings, newSettings = bulkCreateControllerSettings(
+            validated_data)
+        self.child.publishSettings(newSettings)
+        return currentSettings
+
+
 class ControllerSettingSerializer(serializers.ModelSerializer):
     """
     Convert jsoon data in to instance
@@ -322,7 +395,8 @@ class ControllerSettingSerializer(serializers.ModelSerializer):
     ```
     """
 
-    controller = serializers.PrimaryKeyRelatedField(
+    controller = PrefetchedPrimaryKeyRelatedField(
+        prefetchKey="controllers",
         queryset=ControllerModel.objects.all(),
         required=False
     )
@@ -334,22 +408,8 @@ class ControllerSettingSerializer(serializers.ModelSerializer):
     class Meta:
         model = ControllerSettingHistoryModel
         fields = '__all__'
-
-    def __pushLastCurrent(self, controller):
-        controllerSettings = list(ControllerSettingHistoryModel.objects.filter(
-            controller=controller, isCurrent=True))
-        if (len(controllerSettings) == 0):
-            return True
-        if (len(controllerSettings) == 1):
-            controllerSettings[0].isCurrent = False
-            controllerSettings[0].save()
-            return True
-        if (len(controllerSettings) > 1):
-            for setting in controllerSettings:
-                setting.isCurrent = False
-            print(
-                "warning: multiple instances have isCurrent == True, something might went wrong")
-            return True
+        read_only_fields = ["lastSeen"]
+        list_serializer_class = ControllerSettingListSerializer
 
     def validate(self, attrs):
         attrs = super().validate(attrs)
@@ -358,41 +418,46 @@ class ControllerSettingSerializer(serializers.ModelSerializer):
     def create(self, validated_data):
         """
         Update controller setting is actually creating new controller setting history
-        data. In the `create` method from controller setting serializer, the last current
-        data will be set to `isCurrent = False` automatically.
-        """
-        controllerSetting = None
-        try:
-            if validated_data.setdefault("controller", None) is None:
-                raise serializers.ValidationError(
-                    {"controller instance is not provided"})
-            self.__pushLastCurrent(validated_data["controller"])
+        data. The write goes through `bulkCreateControllerSettings`, so the last current
+        data is set to `isCurrent = False`, and the controller points to the new setting
+        as its current setting. A setting equal to the current one only updates
+        `lastSeen` of the current setting.
 
-            validated_data.setdefault("openTemp", None)
-            validated_data.setdefault("closeTemp", None)
-            validated_data.setdefault("schedules", None)
-            validated_data.setdefault("cutHumidity", None)
-            schedulesData = validated_data.pop("schedules")
-
-            controllerSetting = ControllerSettingHistoryModel.objects.create(
-                **validated_data)
+        Return the stored current setting of the controller: the new setting, or the
+        old one when the report did not change it.
+        """
+        if validated_data.setdefault("controller", None) is None:
+            raise serializers.ValidationError(
+                {"controller instance is not provided"})
 
-            if schedulesData is not None:
-                eSer = self.fields["schedules"]
-                for s in schedulesData:
-                    s["controllerSetting"] = controllerSetting
-                eSer.create(schedulesData)
+        currentSettings, newSettings = bulkCreateControllerSettings(
+            [validated_data])
+        self.publishSettings(newSettings)
+        return currentSettings[0]
 
-        except Exception as e:
-            if controllerSetting:
-                controllerSetting.delete()
-            raise e
-        return controllerSetting
+    def publishSettings(self, newSettings: list):
+        """
+        Push the new settings to the subscribers and the long-polling controllers
+        once committed, see `pubsub.py`
+        """
+        if len(newSettings) == 0 or not broker.wantsMessages():
+            return
+
+        prefetch_related_objects(newSettings, "schedules")
+        for setting in newSettings:
+            controller = setting.controller
+            publishOnCommit(controllerChannel(controller.greenhouse_id), {
+                "type": "controller",
+                "version": setting.id,
+                "controllerID": controller.controllerID,
+                "controllerKey": controller.controllerKey,
+                "setting": self.to_representation(setting),
+            })
 
     def to_representation(self, instance):
         ret = super().to_representation(instance)
-        schedules = list(ScheduleModel.objects.filter(
-            controllerSetting=instance))
+        # uses the prefetched schedules when the setting comes from a prefetch
+        schedules = list(instance.schedules.all())
 
         if len(schedules) != 0:
             ret["schedules"] = []
@@ -462,6 +527,7 @@ class ControllerSerializer(serializers.ModelSerializer):
     class Meta:
         model = ControllerModel
         fields = '__all__'
+        read_only_fields = ["currentSetting", "changeVersion"]
 
     def run_validation(self, data=...):
         return super().run_validation(data)
@@ -498,7 +564,6 @@ class ControllerSerializer(serializers.ModelSerializer):
         setting would be labeled with "isCurrent == True" in ControllerSettingHistoryModel
         """
         controller = None
-        setting = None
         try:
             validated_data.setdefault(
                 "itemName", "default name")  # TODO: add defult naming function
@@ -525,7 +590,7 @@ class ControllerSerializer(serializers.ModelSerializer):
         `["on", "manualControl", "openTemp", "closeTemp", "schedules]`
         """
         ret = {
-            "greenhouseUID": instance.greenhouse.greenhouseUID,
+            "greenhouseUID": instance.greenhouse_id,
             "controllerID": instance.controllerID,
             "controllerKey": instance.controllerKey,
             "electricity": instance.electricity,
@@ -534,15 +599,11 @@ class ControllerSerializer(serializers.ModelSerializer):
             "lng": instance.lng,
         }
 
-        currentControllerSettingList = list(ControllerSettingHistoryModel.objects.filter(
-            controller=instance).filter(isCurrent=True))
-
-        if len(currentControllerSettingList) == 0:
+        if instance.currentSetting is None:
             ret["setting"] = None
             return ret
 
-        currentControllerSetting = currentControllerSettingList[0]
-        cSettingSer = ControllerSettingSerializer(currentControllerSetting)
+        cSettingSer = ControllerSettingSerializer(instance.currentSetting)
         ret["setting"] = cSettingSer.data
         return ret
 
@@ -638,6 +699,7 @@ class GreenhouseSerializer(serializers.ModelSerializer):
     class Meta:
         model = GreenhouseModel
         fields = '__all__'
+        read_only_fields = ["version", "structureVersion"]
 
     def update(self, instance, validated_data):
         if validated_data.setdefault("realSensors", None):
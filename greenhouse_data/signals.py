@@ -0,0 +1,100 @@
+"""
+Model signal receivers keeping the in-process caches and the greenhouse snapshot
+versions consistent with the database
+"""
+from django.db import router, transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .device_auth import deviceKeyCache
+from .models import *
+from .partitions import getHistoryPartitions
+from .snapshot import bumpGreenhouseVersions, stampChangeVersions
+from .topology import topologyCache
+
+
+@receiver([post_save, post_delete], sender=RealSensorModel)
+def invalidateRealSensorTopology(sender, instance, **kwargs):
+    topologyCache.invalidateGreenhouse(instance.greenhouse_id)
+
+
+@receiver([post_save, post_delete], sender=SensorModel)
+def invalidateSensorTopology(sender, instance, **kwargs):
+    greenhouseUID = RealSensorModel.objects.filter(
+        pk=instance.realSensor_id).values_list("greenhouse", flat=True).first()
+
+    if greenhouseUID is None:
+        topologyCache.clear()
+        return
+
+    topologyCache.invalidateGreenhouse(greenhouseUID)
+
+
+@receiver(post_save, sender=GreenhouseModel)
+def bumpGreenhouseSnapshot(sender, instance, created, **kwargs):
+    if not created:
+        bumpGreenhouseVersions(structure=True, pk=instance.pk)
+
+
+@receiver([post_save, post_delete], sender=RealSensorModel)
+@receiver([post_save, post_delete], sender=ControllerModel)
+def bumpDeviceSnapshot(sender, instance, created=True, **kwargs):
+    # creations and deletions change the structure, other saves are stamped. The
+    # stamp must commit with the version, or a reader could miss the change
+    with transaction.atomic():
+        bumpGreenhouseVersions(structure=created, pk=instance.greenhouse_id)
+        if not created:
+            stampChangeVersions(sender.objects.filter(pk=instance.pk))
+
+
+@receiver([post_save, post_delete], sender=SensorModel)
+def bumpSensorSnapshot(sender, instance, created=True, **kwargs):
+    with transaction.atomic():
+        bumpGreenhouseVersions(
+            structure=created, realSensors=instance.realSensor_id)
+        if not created:
+            stampChangeVersions(
+                sender.objects.filter(pk=instance.pk), "realSensors", "realSensor")
+
+
+@receiver([post_save, post_delete], sender=DeviceKeyModel)
+def invalidateDeviceKey(sender, instance, **kwargs):
+    deviceKeyCache.invalidate(instance.greenhouse_id)
+
+
+# The history may live on another database, out of reach of the deletion cascades
+# (see routers.py). It follows the deleted devices once their deletion commits. On
+# one database the keys keep their constraints, so it is deleted within the same
+# transaction instead.
+
+def deleteSensorHistory(sensorID):
+    with transaction.atomic(using=router.db_for_write(SensorValueHistoryModel)):
+        for model in getHistoryPartitions().models():
+            model.objects.filter(sensor_id=sensorID).update(sensor_id=None)
+        SensorHourlyRollupModel.objects.filter(sensor=sensorID).delete()
+        SensorDailyRollupModel.objects.filter(sensor=sensorID).delete()
+
+
+def deleteControllerHistory(controllerID):
+    # the schedules cascade within the history database
+    ControllerSettingHistoryModel.objects.filter(
+        controller=controllerID).delete()
+
+
+def cascadeHistory(using, historyModel, delete):
+    if router.db_for_write(historyModel) == using:
+        delete()
+    else:
+        transaction.on_commit(delete, using=using)
+
+
+@receiver(post_delete, sender=SensorModel)
+def cascadeSensorHistory(sender, instance, using, **kwargs):
+    sensorID = instance.pk
+    cascadeHistory(using, SensorValueHistoryModel, lambda: deleteSensorHistory(sensorID))
+
+
+@receiver(post_delete, sender=ControllerModel)
+def cascadeControllerHistory(sender, instance, using, **kwargs):
+    controllerID = instance.pk
+    cascadeHistory(using, ControllerSettingHistoryModel, lambda: deleteControllerHistory(controllerID))
@@ -0,0 +1,117 @@
+"""
+Cache of the app documents of the greenhouses (the output of
+`GetGreenhouseBase.parseToAppFormat`). Each snapshot is stored with the `version`
+of its greenhouse. Every write to a greenhouse bumps the version in the database,
+so a reader only has to read the current version to know whether the cached
+snapshot is still valid. Old snapshots are never served and are overwritten or
+evicted later.
+
+The devices are stamped with the greenhouse version of their last change
+(`changeVersion`), so the app can fetch only what changed since the version it
+holds. Creating or deleting a device, or updating the greenhouse itself, moves
+`structureVersion` as well, and a client older than it gets the full document.
+"""
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import F, OuterRef, Subquery
+from django.utils.module_loading import import_string
+
+from .models import *
+from .utils import LRUCache
+
+
+def bumpGreenhouseVersions(structure: bool = False, **filters):
+    """
+    Increase the version of the greenhouses matching `filters` with a single UPDATE,
+    which invalidates their snapshots once the transaction commits. `structure`
+    also moves `structureVersion` to the new version.
+    """
+    versions = {"version": F("version") + 1}
+    if structure:
+        versions["structureVersion"] = F("version") + 1
+    return GreenhouseModel.objects.filter(**filters).update(**versions)
+
+
+def stampChangeVersions(queryset, greenhouseLookup: str = "pk", greenhouseField: str = "greenhouse"):
+    """
+    Set `changeVersion` of the devices in `queryset` to the current version of their
+    greenhouse with a single UPDATE. Call it after `bumpGreenhouseVersions` in the
+    same transaction.
+    """
+    version = GreenhouseModel.objects.filter(
+        **{greenhouseLookup: OuterRef(greenhouseField)}).values("version")[:1]
+    return queryset.update(changeVersion=Subquery(version))
+
+
+class LocalSnapshotBackend:
+    """
+    Keep the snapshots in the memory of the process, one entry per greenhouse
+    """
+
+    def __init__(self, maxSize: int = 1024):
+        self.cache = LRUCache(maxSize=maxSize)
+
+    def getMany(self, versions: dict):
+        snapshots = {}
+        for greenhouseUID, version in versions.items():
+            entry = self.cache.get(str(greenhouseUID))
+            if entry is not None and entry[0] == version:
+                snapshots[greenhouseUID] = entry[1]
+        return snapshots
+
+    def set(self, greenhouseUID, version: int, snapshot: dict):
+        # a slow reader must not replace a snapshot of a newer version
+        entry = self.cache.get(str(greenhouseUID))
+        if entry is not None and entry[0] > version:
+            return
+        self.cache.set(str(greenhouseUID), (version, snapshot))
+
+    def clear(self):
+        self.cache.clear()
+
+    def stats(self):
+        return self.cache.stats()
+
+
+class DjangoCacheSnapshotBackend:
+    """
+    Keep the snapshots in a Django cache (e.g. redis or memcached) shared by every
+    process. The version is part of the key, so outdated snapshots expire after
+    `timeout` seconds.
+    """
+
+    def __init__(self, alias: str = "default", timeout: int = 300, keyPrefix: str = "greenhouse-snapshot"):
+        self.cache = caches[alias]
+        self.timeout = timeout
+        self.keyPrefix = keyPrefix
+
+    def getKey(self, greenhouseUID, version: int):
+        return f"{self.keyPrefix}:{greenhouseUID}:{version}"
+
+    def getMany(self, versions: dict):
+        keys = {
+            self.getKey(greenhouseUID, version): greenhouseUID
+            for greenhouseUID, version in versions.items()
+        }
+        return {
+            keys[key]: snapshot
+            for key, snapshot in self.cache.get_many(keys.keys()).items()
+        }
+
+    def set(self, greenhouseUID, version: int, snapshot: dict):
+        self.cache.set(self.getKey(greenhouseUID, version),
+                       snapshot, self.timeout)
+
+    def clear(self):
+        self.cache.clear()
+
+    def stats(self):
+        return {"backend": self.cache.__class__.__name__, "timeout": self.timeout}
+
+
+def createSnapshotBackend():
+    config = settings.GREENHOUSE_SNAPSHOT_BACKEND
+    return import_string(config["BACKEND"])(**config.get("OPTIONS", {}))
+
+
+snapshotCache = createSnapshotBackend()
@@ -0,0 +1,79 @@
+"""
+Tuning of the SQLite database of the single node installs. SQLite defaults to the
+rollback journal, where a writer blocks every reader, so a gh/real-sensor PUT
+blocks the app GETs. Every new SQLite connection is given the pragmas of
+GREENHOUSE_SQLITE_PRAGMAS, which move the database to write-ahead logging (WAL):
+the readers keep reading the last committed data while a writer appends to the
+`-wal` file.
+
+The `-wal` file is merged back into the database (checkpoint) by SQLite every
+`wal_autocheckpoint` pages. `manage.py sqlite_wal` reports its size and runs a
+checkpoint by hand, e.g. after a large import.
+"""
+import os
+
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+CHECKPOINT_MODES = ["PASSIVE", "FULL", "RESTART", "TRUNCATE"]
+
+
+@receiver(connection_created)
+def applySQLitePragmas(sender, connection, **kwargs):
+    if connection.vendor != "sqlite":
+        return
+
+    with connection.cursor() as cursor:
+        # in order, busy_timeout first so switching to WAL waits for the other writers
+        for name, value in settings.GREENHOUSE_SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+
+
+def getWALStatus(connection):
+    """
+    #### Return data format
+    ```
+    {
+        "database": "/srv/greenhouse/db.sqlite3",
+        "journalMode": "wal",
+        "walSize": 4124152, # bytes of the -wal file
+        "pragmas": {"synchronous": 1, "cache_size": -65536, ...}
+    }
+    ```
+    """
+    database = str(connection.settings_dict["NAME"])
+    walPath = f"{database}-wal"
+
+    with connection.cursor() as cursor:
+        cursor.execute("PRAGMA journal_mode")
+        journalMode = cursor.fetchone()[0]
+
+        pragmas = {}
+        for name in settings.GREENHOUSE_SQLITE_PRAGMAS:
+            cursor.execute(f"PRAGMA {name}")
+            row = cursor.fetchone()
+            pragmas[name] = None if row is None else row[0]
+
+    return {
+        "database": database,
+        "journalMode": journalMode,
+        "walSize": os.path.getsize(walPath) if os.path.exists(walPath) else 0,
+        "pragmas": pragmas,
+    }
+
+
+def checkpointWAL(connection, mode: str = "PASSIVE"):
+    """
+    Copy the WAL back into the database, see `CHECKPOINT_MODES`. TRUNCATE also
+    empties the `-wal` file, it waits for the readers and writers like RESTART.
+
+    Return (busy, walPages, checkpointedPages), busy is 1 when the checkpoint could
+    not complete because of another connection
+    """
+    if mode not in CHECKPOINT_MODES:
+        raise ValueError(f"unknown checkpoint mode {mode}")
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"PRAGMA wal_checkpoint({mode})")
+        return tuple(cursor.fetchone())
@@ -1,3 +1,1575 @@
-from django.test import TestCase
+import asyncio
+import copy
+import datetime
+import importlib.util
+import io
+import json
+import os
+import tempfile
+import time
+import unittest
+from contextlib import ExitStack
+from statistics import fmean
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, IntegrityError, connection, connections, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from myapp.authentication import ownerCache, tokenCache
+from myproject.asgi import application
+
+from .buffer import SensorWriteBuffer
+from .device_auth import (NONCE_HEADER, SIGNATURE_HEADER, TIMESTAMP_HEADER, bodyDigest,
+                          deviceKeyCache, generateDeviceKey, signRequest)
+from .history import RollupHistoryEngine, SensorHistoryEngine
+from .ingest import bulkCreateSensorValues, upsertSensorHistory
+from .maintenance import dropForeignKeyConstraints
+from .models import *
+from .partitions import addMonths, getHistoryPartitions, getMonthModel, monthStart
+from .pubsub import LocalBroker, RedisBroker, broker, controllerChannel, sensorChannel
+from .routers import getHistoryDatabase, getPinKey, isPinnedToPrimary, replicaReads
+from .serializer import SensorValueHistorySerializer
+from .snapshot import snapshotCache
+from .sqlite import checkpointWAL, getWALStatus
+from .topology import topologyCache
+
+
+def utc(*args):
+    return datetime.datetime(*args, tzinfo=datetime.timezone.utc)
+
+
+class GreenhouseTestCase(TestCase):
+    """
+    A greenhouse owned by `self.user`, with a real sensor measuring airTemp and
+    airHumidity. The in-process caches are cleared before each test, the ids of the
+    rows rolled back by the previous test are given again.
+    """
+    databases = {"default", getHistoryDatabase()}
+
+    def setUp(self):
+        for cache in [topologyCache, snapshotCache, deviceKeyCache, tokenCache, ownerCache]:
+            cache.clear()
+
+        self.user = User.objects.create_user("owner", password="password")
+        self.greenhouse = GreenhouseModel.objects.create(
+            owner=self.user, name="greenhouse", address="address", beginDate=datetime.date(2024, 5, 1))
+        self.realSensor = RealSensorModel.objects.create(
+            greenhouse=self.greenhouse, itemName="AirSensor", realSensorID="AirSensor_1", realSensorKey="AirSensor")
+        self.airTemp = SensorModel.objects.create(
+            realSensor=self.realSensor, itemName="airTemp", sensorKey="airTemp")
+        self.airHumidity = SensorModel.objects.create(
+            realSensor=self.realSensor, itemName="airHumidity", sensorKey="airHumidity")
+        self.client = APIClient()
+
+    def getHistory(self, sensor):
+        """ The (timestamp, value, isCurrent) history records of `sensor`, in order """
+        records = []
+        for model in getHistoryPartitions().models():
+            records.extend(model.objects.filter(sensor_id=sensor.id).values_list(
+                "timestamp", "value", "isCurrent"))
+        return sorted(records)
+
+    def putSensorValues(self, sensors: dict, timestamp: str, path: str = None):
+        """ Report the values of AirSensor_1 like the devices do """
+        return self.client.put(
+            path or f"/gh/real-sensor/{self.greenhouse.greenhouseUID}",
+            {"AirSensor_1": {"address": {"lat": 24.1, "lng": 47.3},
+                             "sensors": {**sensors, "timestamp": timestamp}}},
+            format="json",
+        )
+
+
+class BulkSensorIngestTest(GreenhouseTestCase):
+    """
+    gh/real-sensor PUT validates the readings of a request as one batch and writes
+    them with `bulkCreateSensorValues`
+    """
+
+    def testPutWritesEveryReading(self):
+        response = self.putSensorValues(
+            {"airTemp": 21.5, "airHumidity": 60}, "2024-05-02 10:00:00")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.getHistory(self.airTemp), [
+                         (utc(2024, 5, 2, 10), 21.5, True)])
+        self.assertEqual(self.getHistory(self.airHumidity), [
+                         (utc(2024, 5, 2, 10), 60, True)])
+
+    def testUnknownSensorRejectsTheBatch(self):
+        response = self.putSensorValues(
+            {"airTemp": 21.5, "soilTemp": 18}, "2024-05-02 10:00:00")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.getHistory(self.airTemp), [])
+
+    def testSensorsAreLoadedOnce(self):
+        sensorValues = [
+            {"sensor": sensor.id, "value": i, "timestamp": f"2024-05-02 10:{i:02d}:00"}
+            for i in range(20)
+            for sensor in [self.airTemp, self.airHumidity]
+        ]
+        ser = SensorValueHistorySerializer(data=sensorValues, many=True)
+        with self.assertNumQueries(1):
+            self.assertTrue(ser.is_valid(), ser.errors)
+
+    def testQueryCountDoesNotGrowWithTheBatch(self):
+        def countWriteQueries(readingCount: int, hour: int):
+            sensorValues = [
+                {"sensor": sensor, "value": i, "timestamp": utc(2024, 5, 2, hour, i)}
+                for i in range(readingCount)
+                for sensor in [self.airTemp, self.airHumidity]
+            ]
+            with ExitStack() as stack:
+                captures = [
+                    stack.enter_context(CaptureQueriesContext(connections[alias]))
+                    for alias in self.databases
+                ]
+                bulkCreateSensorValues(sensorValues)
+            return sum(len(queries) for queries in captures)
+
+        # the first batch creates the partition of the month
+        countWriteQueries(1, 0)
+        self.assertEqual(countWriteQueries(2, 1), countWriteQueries(40, 2))
+        self.assertEqual(len(self.getHistory(self.airTemp)), 43)
+        self.assertEqual(
+            [record for record in self.getHistory(self.airTemp) if record[2]],
+            [(utc(2024, 5, 2, 2, 39), 39, True)],
+        )
+
+
+class TopologyCacheTest(GreenhouseTestCase):
+    """
+    The ingest ids are resolved through `topologyCache`. Missing items are not cached,
+    and the model signals invalidate the greenhouse when a sensor is added or renamed.
+    """
+
+    def resolve(self, sensorKey: str, realSensorID: str = "AirSensor_1"):
+        return topologyCache.getSensorID(self.greenhouse.greenhouseUID, realSensorID, sensorKey)
+
+    def testHit(self):
+        hits = topologyCache.stats()["hits"]
+        with self.assertNumQueries(1):
+            self.assertEqual(self.resolve("airTemp"), self.airTemp.id)
+        # every sensor of the real sensor was loaded by the first lookup
+        with self.assertNumQueries(0):
+            self.assertEqual(self.resolve("airTemp"), self.airTemp.id)
+            self.assertEqual(self.resolve("airHumidity"), self.airHumidity.id)
+        self.assertEqual(topologyCache.stats()["hits"], hits + 2)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(topologyCache.getRealSensorID(
+                self.greenhouse.greenhouseUID, "AirSensor_1"), self.realSensor.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(topologyCache.getRealSensorID(
+                self.greenhouse.greenhouseUID, "AirSensor_1"), self.realSensor.id)
+
+    def testMissIsNotCached(self):
+        hits = topologyCache.stats()["hits"]
+        self.assertIsNone(self.resolve("soilTemp"))
+        with self.assertNumQueries(1):
+            self.assertIsNone(self.resolve("soilTemp"))
+        self.assertIsNone(topologyCache.getRealSensorID(self.greenhouse.greenhouseUID, "SoilSensor_1"))
+        self.assertEqual(topologyCache.stats()["hits"], hits)
+
+    def testAddedSensorIsResolved(self):
+        self.assertEqual(self.putSensorValues({"airTemp": 21}, "2024-05-02 10:00:00").status_code, 200)
+        self.assertIsNotNone(topologyCache.cache.get(
+            ("sensor", str(self.greenhouse.greenhouseUID), "AirSensor_1", "airTemp")))
+
+        co2 = SensorModel.objects.create(realSensor=self.realSensor, itemName="co2", sensorKey="co2")
+        self.assertEqual(topologyCache.stats()["size"], 0)
+        self.assertEqual(self.putSensorValues({"co2": 410}, "2024-05-02 10:10:00").status_code, 200)
+        self.assertEqual(self.getHistory(co2), [(utc(2024, 5, 2, 10, 10), 410, True)])
+
+    def testRenamedSensorIsResolved(self):
+        self.assertEqual(self.putSensorValues({"airTemp": 21}, "2024-05-02 10:00:00").status_code, 200)
+
+        self.airTemp.sensorKey = "temperature"
+        self.airTemp.save()
+        self.assertIsNone(self.resolve("airTemp"))
+        self.assertEqual(self.putSensorValues({"temperature": 22}, "2024-05-02 10:10:00").status_code, 200)
+        self.assertEqual(self.putSensorValues({"airTemp": 23}, "2024-05-02 10:20:00").status_code, 400)
+
+        # a sensor replaced under the old key gets a new id
+        self.airTemp.delete()
+        replacement = SensorModel.objects.create(
+            realSensor=self.realSensor, itemName="airTemp", sensorKey="temperature")
+        self.assertEqual(self.putSensorValues({"temperature": 24}, "2024-05-02 10:30:00").status_code, 200)
+        self.assertEqual(self.getHistory(replacement), [(utc(2024, 5, 2, 10, 30), 24, True)])
+
+    def testRenamedRealSensorIsResolved(self):
+        self.assertEqual(self.putSensorValues({"airTemp": 21}, "2024-05-02 10:00:00").status_code, 200)
+
+        self.realSensor.realSensorID = "AirSensor_2"
+        self.realSensor.save()
+        self.assertIsNone(self.resolve("airTemp"))
+        self.assertEqual(self.resolve("airTemp", "AirSensor_2"), self.airTemp.id)
+        self.assertEqual(topologyCache.getRealSensorID(
+            self.greenhouse.greenhouseUID, "AirSensor_2"), self.realSensor.id)
+
+
+@unittest.skipIf(importlib.util.find_spec("msgpack") is None, "msgpack is not installed")
+class MessagePackTest(GreenhouseTestCase):
+    """
+    gh/real-sensor PUT accepts MessagePack bodies in the compact real sensor format and
+    stores the same readings as the json body. A malformed body is a 400.
+    """
+
+    def putMessagePack(self, body: bytes):
+        return self.client.put(
+            f"/gh/real-sensor/{self.greenhouse.greenhouseUID}", body,
+            content_type="application/msgpack")
+
+    def testCompactBodyMatchesTheJsonBody(self):
+        import msgpack
+
+        response = self.putSensorValues(
+            {"airTemp": 21.5, "airHumidity": 60}, "2024-05-02 10:00:00")
+        self.assertEqual(response.status_code, 200)
+        jsonHistory = [self.getHistory(self.airTemp), self.getHistory(self.airHumidity)]
+        SensorValueHistoryModel.objects.all().delete()
+
+        # 1714644000 is 2024-05-02 10:00:00 UTC
+        response = self.putMessagePack(msgpack.packb(
+            {"AirSensor_1": [24.1, 47.3, 1714644000, {"airTemp": 21.5, "airHumidity": 60}]}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [self.getHistory(self.airTemp), self.getHistory(self.airHumidity)], jsonHistory)
+        self.assertEqual(jsonHistory[0], [(utc(2024, 5, 2, 10), 21.5, True)])
+
+    def testMalformedBodyIsRejected(self):
+        import msgpack
+
+        for body in [
+            b"\xc1",  # a reserved type byte
+            msgpack.packb({"AirSensor_1": [24.1, 47.3]})[:-1],  # truncated
+            msgpack.packb({"AirSensor_1": [24.1, 47.3, 1714644000]}),  # no sensors
+            msgpack.packb([24.1, 47.3, 1714644000, {"airTemp": 21.5}]),  # no real sensor id
+            msgpack.packb({"AirSensor_1": [24.1, 47.3, 10 ** 12, {"airTemp": 21.5}]}),  # bad timestamp
+        ]:
+            with self.subTest(body=body):
+                self.assertEqual(self.putMessagePack(body).status_code, 400)
+        self.assertEqual(self.getHistory(self.airTemp), [])
+
+
+class UpsertSensorHistoryTest(GreenhouseTestCase):
+    """
+    `upsertSensorHistory` returns the values of the rows it replaced. On PostgreSQL
+    they come from the RETURNING clause of a single INSERT ... ON CONFLICT per batch.
+    """
+
+    def upsert(self, values: dict):
+        return upsertSensorHistory([
+            SensorValueHistoryModel(sensor=self.airTemp, timestamp=timestamp, value=value, isCurrent=True)
+            for timestamp, value in values.items()
+        ])
+
+    def testReturnsTheReplacedValues(self):
+        self.assertEqual(self.upsert({utc(2024, 5, 2, 10): 21, utc(2024, 5, 2, 11): 22}), {})
+        self.assertEqual(
+            self.upsert({utc(2024, 5, 2, 11): 23, utc(2024, 5, 2, 12): 24}),
+            {(self.airTemp.id, utc(2024, 5, 2, 11)): 22},
+        )
+        self.assertEqual(self.getHistory(self.airTemp), [
+            (utc(2024, 5, 2, 10), 21, True),
+            (utc(2024, 5, 2, 11), 23, True),
+            (utc(2024, 5, 2, 12), 24, True),
+        ])
+
+    @unittest.skipUnless(connections[getHistoryDatabase()].vendor == "postgresql", "PostgreSQL only")
+    def testPostgresUpsertsEachBatchWithReturning(self):
+        self.upsert({utc(2024, 5, 2, 10): 21, utc(2024, 5, 2, 11): 22})
+        values = {utc(2024, 5, 2, hour): hour for hour in range(10, 13)}
+
+        with mock.patch("greenhouse_data.ingest.UPSERT_BATCH_SIZE", 2), \
+                CaptureQueriesContext(connections[getHistoryDatabase()]) as queries:
+            previousValues = self.upsert(values)
+
+        upserts = [query["sql"] for query in queries.captured_queries if "ON CONFLICT" in query["sql"]]
+        self.assertEqual(len(upserts), 2)
+        self.assertTrue(all("RETURNING" in sql for sql in upserts))
+        self.assertEqual(previousValues, {
+            (self.airTemp.id, utc(2024, 5, 2, 10)): 21,
+            (self.airTemp.id, utc(2024, 5, 2, 11)): 22,
+        })
+
+
+class CurrentValueTest(GreenhouseTestCase):
+    """
+    The ingest keeps `currentValue` / `currentTimestamp` of the sensors and
+    `currentSetting` of the controllers up to date
+    """
+
+    def testSensorCurrentValue(self):
+        self.putSensorValues({"airTemp": 21.5, "airHumidity": 60}, "2024-05-02 10:00:00")
+        self.putSensorValues({"airTemp": 22}, "2024-05-02 10:01:00")
+
+        self.airTemp.refresh_from_db()
+        self.airHumidity.refresh_from_db()
+        self.assertEqual((self.airTemp.currentValue, self.airTemp.currentTimestamp),
+                         (22, utc(2024, 5, 2, 10, 1)))
+        self.assertEqual((self.airHumidity.currentValue, self.airHumidity.currentTimestamp),
+                         (60, utc(2024, 5, 2, 10)))
+        self.assertEqual([record[2] for record in self.getHistory(self.airTemp)], [False, True])
+
+    def testControllerCurrentSetting(self):
+        controller = ControllerModel.objects.create(
+            greenhouse=self.greenhouse, itemName="fan", controllerID="fan_1", controllerKey="fan")
+        response = self.client.put(
+            f"/gh/controller/{self.greenhouse.greenhouseUID}",
+            {"fan_1": {"setting": {"on": True, "manualControl": False, "timestamp": "2024-05-02 10:00:00",
+                                   "openTemp": 21, "closeTemp": 20}}},
+            format="json",
+        )
+        self.assertEqual(response.status_code, 200)
+
+        controller.refresh_from_db()
+        self.assertEqual(
+            (controller.currentSetting.on, controller.currentSetting.openTemp), (True, 21))
+        self.assertTrue(controller.currentSetting.isCurrent)
+
+
+class LateReadingTest(GreenhouseTestCase):
+    """
+    A reading older than the current one of its sensor is only added to the history
+    """
+
+    def write(self, readings: list):
+        with mock.patch("greenhouse_data.ingest.publishSensorValues") as publish:
+            bulkCreateSensorValues([
+                {"sensor": sensor, "value": value, "timestamp": timestamp}
+                for sensor, value, timestamp in readings
+            ])
+        return [(instance.sensor_id, instance.value) for instance in publish.call_args.args[0]]
+
+    def testLatestReadingOfTheBatchIsCurrent(self):
+        published = self.write([
+            (self.airTemp, 22, utc(2024, 5, 2, 11)),
+            (self.airTemp, 21, utc(2024, 5, 2, 10)),
+        ])
+        self.airTemp.refresh_from_db()
+        self.assertEqual((self.airTemp.currentValue, self.airTemp.currentTimestamp),
+                         (22, utc(2024, 5, 2, 11)))
+        self.assertEqual(self.getHistory(self.airTemp), [
+            (utc(2024, 5, 2, 10), 21, False), (utc(2024, 5, 2, 11), 22, True)])
+        self.assertEqual(published, [(self.airTemp.id, 22)])
+
+    def testLateReadingKeepsTheCurrentOne(self):
+        self.write([(self.airTemp, 22, utc(2024, 5, 2, 11))])
+        published = self.write([
+            (self.airTemp, 21, utc(2024, 5, 2, 10)),
+            (self.airHumidity, 60, utc(2024, 5, 2, 10)),
+        ])
+        self.airTemp.refresh_from_db()
+        self.assertEqual((self.airTemp.currentValue, self.airTemp.currentTimestamp),
+                         (22, utc(2024, 5, 2, 11)))
+        self.assertEqual(self.getHistory(self.airTemp), [
+            (utc(2024, 5, 2, 10), 21, False), (utc(2024, 5, 2, 11), 22, True)])
+        self.assertEqual(published, [(self.airHumidity.id, 60)])
+
+
+class SensorReplayTest(GreenhouseTestCase):
+    """
+    A reading with the same sensor and timestamp as a stored one replaces it
+    """
+
+    def testReplayIsAnUpsert(self):
+        for _ in range(2):
+            response = self.putSensorValues({"airTemp": 21.5}, "2024-05-02 10:00:00")
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.getHistory(self.airTemp), [(utc(2024, 5, 2, 10), 21.5, True)])
+
+        self.putSensorValues({"airTemp": 23}, "2024-05-02 10:00:00")
+        self.assertEqual(self.getHistory(self.airTemp), [(utc(2024, 5, 2, 10), 23, True)])
+
+    def testRepeatedReadingOfABatchIsWrittenOnce(self):
+        bulkCreateSensorValues([
+            {"sensor": self.airTemp, "value": value, "timestamp": utc(2024, 5, 2, 10)}
+            for value in [21, 22]
+        ])
+        self.assertEqual(self.getHistory(self.airTemp), [(utc(2024, 5, 2, 10), 22, True)])
+
+
+class SensorRollupTest(GreenhouseTestCase):
+    """
+    The ingest keeps the hourly and daily rollups equal to the aggregates of the
+    raw history, replays included
+    """
+
+    def write(self, readings: list):
+        bulkCreateSensorValues([
+            {"sensor": self.airTemp, "value": value, "timestamp": timestamp}
+            for timestamp, value in readings
+        ])
+
+    def getRollups(self, rollupModel):
+        return list(rollupModel.objects.filter(sensor=self.airTemp).order_by("bucket").values_list(
+            "bucket", "count", "valueSum", "valueMin", "valueMax", "lastTimestamp", "lastValue"))
+
+    def testIngest(self):
+        self.write([(utc(2024, 5, 2, 10, 10), 21), (utc(2024, 5, 2, 10, 40), 25)])
+        self.write([(utc(2024, 5, 2, 11, 5), 19)])
+
+        self.assertEqual(self.getRollups(SensorHourlyRollupModel), [
+            (utc(2024, 5, 2, 10), 2, 46, 21, 25, utc(2024, 5, 2, 10, 40), 25),
+            (utc(2024, 5, 2, 11), 1, 19, 19, 19, utc(2024, 5, 2, 11, 5), 19),
+        ])
+        self.assertEqual(self.getRollups(SensorDailyRollupModel), [
+            (utc(2024, 5, 2), 3, 65, 19, 25, utc(2024, 5, 2, 11, 5), 19),
+        ])
+
+    def testReplay(self):
+        self.write([(utc(2024, 5, 2, 10, 10), 21), (utc(2024, 5, 2, 10, 40), 25)])
+        # the replay changes the maximum of the bucket
+        self.write([(utc(2024, 5, 2, 10, 40), 22)])
+        self.write([(utc(2024, 5, 2, 10, 40), 22)])
+
+        self.assertEqual(self.getRollups(SensorHourlyRollupModel), [
+            (utc(2024, 5, 2, 10), 2, 43, 21, 22, utc(2024, 5, 2, 10, 40), 22),
+        ])
+        self.assertEqual(self.getRollups(SensorDailyRollupModel), [
+            (utc(2024, 5, 2), 2, 43, 21, 22, utc(2024, 5, 2, 10, 40), 22),
+        ])
+
+
+class GreenhouseDeltaTest(GreenhouseTestCase):
+    """
+    app/greenhouse/<uid>?since=<version> returns only the devices changed after the
+    version held by the app
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.user)
+
+    def getGreenhouse(self, since=None):
+        response = self.client.get(
+            f"/app/greenhouse/{self.greenhouse.greenhouseUID}",
+            {} if since is None else {"since": since})
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def testChangedSensorsOnly(self):
+        document = self.getGreenhouse()
+        self.assertNotIn("changeVersion", document["realSensors"]["AirSensor_1"])
+
+        self.putSensorValues({"airTemp": 22}, "2024-05-02 10:00:00")
+        delta = self.getGreenhouse(since=document["version"])
+        self.assertEqual(delta["version"], document["version"] + 1)
+        self.assertFalse(delta["full"])
+        self.assertEqual(list(delta["sensors"].keys()), ["airTemp"])
+        self.assertEqual(delta["sensors"]["airTemp"][0]["value"], 22)
+        self.assertEqual(delta["controllers"], {})
+
+        self.assertEqual(self.getGreenhouse(since=delta["version"])["sensors"], {})
+
+    def testNewDeviceReturnsTheFullDocument(self):
+        document = self.getGreenhouse()
+        realSensor = RealSensorModel.objects.create(
+            greenhouse=self.greenhouse, itemName="SoilSensor", realSensorID="SoilSensor_1", realSensorKey="SoilSensor")
+        SensorModel.objects.create(realSensor=realSensor, itemName="soilTemp", sensorKey="soilTemp")
+
+        delta = self.getGreenhouse(since=document["version"])
+        self.assertTrue(delta["full"])
+        self.assertEqual(sorted(delta["realSensors"].keys()), ["AirSensor_1", "SoilSensor_1"])
+        self.assertEqual(sorted(delta["sensors"].keys()), ["airHumidity", "airTemp", "soilTemp"])
+
+
+class ConditionalGetTest(GreenhouseTestCase):
+    """
+    The app GET requests answer 304 to a matching If-None-Match until the data
+    they return is written
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.user)
+        self.putSensorValues({"airTemp": 21}, "2024-05-02 10:00:00")
+
+    def assertETag(self, path: str, params: dict):
+        response = self.client.get(path, params)
+        self.assertEqual(response.status_code, 200)
+        etag = response["ETag"]
+
+        response = self.client.get(path, params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+
+        self.putSensorValues({"airTemp": 22}, "2024-05-02 10:30:00")
+        response = self.client.get(path, params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def testGreenhouse(self):
+        self.assertETag(f"/app/greenhouse/{self.greenhouse.greenhouseUID}", {})
+
+    def testSensorHistory(self):
+        self.assertETag(
+            f"/app/sensor/{self.greenhouse.greenhouseUID}/AirSensor_1/airTemp",
+            {"startTime": "2024-05-02T08:00:00+00:00", "endTime": "2024-05-02T12:00:00+00:00"})
+
+
+def referenceHistoryDatas(records: list, startTime, endTime, unitScale: int):
+    """
+    The chart algorithm of SensorAPI before `SensorHistoryEngine`: one range query
+    per hour, here a filter of the (timestamp, value) `records`, and a recursion
+    over the leading missing hours
+    """
+    window = datetime.timedelta(minutes=15)
+    records = [(t, v) for t, v in sorted(records) if startTime <= t <= endTime]
+
+    def hourly(startTime):
+        currentTime = startTime
+        while currentTime <= endTime:
+            yield currentTime
+            currentTime += datetime.timedelta(hours=1)
+
+    def findHourlyData(startTime):
+        hourlyData = []
+        lastData = None
+        broken = False
+
+        for t in hourly(startTime):
+            timeInstance = [v for timestamp, v in records if t - window <= timestamp <= t + window]
+
+            if len(timeInstance) > 0:
+                hourlyData.append(timeInstance[0])
+                lastData = hourlyData[-1]
+                continue
+
+            if lastData:
+                hourlyData.append(lastData)
+                lastData = hourlyData[-1]
+                continue
+
+            broken = True
+            break
+
+        if broken:
+            t = t + datetime.timedelta(hours=1)
+            nextDatas = findHourlyData(t)
+            hourlyData += [nextDatas[0]]
+            hourlyData += nextDatas
+
+        return hourlyData
+
+    hourlyData = findHourlyData(startTime)
+    return [fmean(hourlyData[i:i+unitScale]) for i in range(0, len(hourlyData), unitScale)]
+
+
+class SensorHistoryEngineTest(GreenhouseTestCase):
+    """
+    `SensorHistoryEngine` returns the charts of the per-hour algorithm it replaced
+    """
+
+    def testSameChartsAsThePerHourAlgorithm(self):
+        start = utc(2024, 4, 30, 20)
+        # a leading gap, readings off the hour, outside of the sample window and
+        # missing hours, across the April and May partitions
+        records = [
+            (start + datetime.timedelta(hours=3, minutes=10), 21),
+            (start + datetime.timedelta(hours=3, minutes=40), 30),
+            (start + datetime.timedelta(hours=4, minutes=50), 22),
+            (start + datetime.timedelta(hours=5, minutes=20), 40),
+            (start + datetime.timedelta(hours=8), 23.5),
+            (start + datetime.timedelta(hours=8, minutes=14), 50),
+            (start + datetime.timedelta(hours=12, minutes=-5), 24),
+            (start + datetime.timedelta(hours=13), 25),
+        ]
+        bulkCreateSensorValues([
+            {"sensor": self.airTemp, "value": value, "timestamp": timestamp}
+            for timestamp, value in records
+        ])
+
+        engine = SensorHistoryEngine(self.airTemp)
+        for hours in [10, 13, 16]:
+            for unitScale in [1, 2, 3, 4]:
+                endTime = start + datetime.timedelta(hours=hours)
+                self.assertEqual(
+                    engine.getHistoryDatas(start, endTime, unitScale),
+                    referenceHistoryDatas(records, start, endTime, unitScale),
+                    f"{hours} hours by {unitScale}",
+                )
+
+
+@unittest.skipUnless(getHistoryDatabase() == DEFAULT_DB_ALIAS, "the history has its own database")
+class HistoryConstraintTest(GreenhouseTestCase):
+    """
+    On one database the keys of the history keep their constraints, and the history
+    is deleted with its device in the same transaction
+    """
+
+    def getForeignKeys(self, model):
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, model._meta.db_table)
+        return [c["columns"] for c in constraints.values() if c["foreign_key"]]
+
+    def testConstraintsAreKept(self):
+        self.assertIn(["sensor_id"], self.getForeignKeys(SensorHourlyRollupModel))
+        self.assertIn(["controller_id"], self.getForeignKeys(ControllerSettingHistoryModel))
+        self.assertIn(["currentSetting_id"], self.getForeignKeys(ControllerModel))
+
+    def testDeleteDevices(self):
+        bulkCreateSensorValues([{"sensor": self.airTemp, "value": 21, "timestamp": utc(2024, 5, 2, 10)}])
+        controller = ControllerModel.objects.create(
+            greenhouse=self.greenhouse, itemName="fan", controllerID="fan_1", controllerKey="fan")
+        controller.currentSetting = ControllerSettingHistoryModel.objects.create(
+            controller=controller, timestamp=utc(2024, 5, 2, 10), on=True)
+        controller.save()
+
+        self.realSensor.delete()
+        controller.delete()
+
+        # no commit callback is needed
+        self.assertFalse(SensorHourlyRollupModel.objects.filter(sensor=self.airTemp.id).exists())
+        self.assertEqual(self.getHistory(self.airTemp), [])
+        self.assertFalse(ControllerSettingHistoryModel.objects.filter(controller=controller.id).exists())
+        connection.check_constraints()
+
+    def testRawDeleteIsRejected(self):
+        bulkCreateSensorValues([{"sensor": self.airTemp, "value": 21, "timestamp": utc(2024, 5, 2, 10)}])
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"DELETE FROM {connection.ops.quote_name(SensorModel._meta.db_table)} WHERE id = %s", [self.airTemp.id])
+            with self.assertRaises(IntegrityError):
+                connection.check_constraints()
+            transaction.set_rollback(True)
+
+
+class DropForeignKeyConstraintsTest(TransactionTestCase):
+    """
+    `copy_history_database` drops the constraints kept while the install had one
+    database
+    """
+
+    def setUp(self):
+        self.field = SensorHourlyRollupModel._meta.get_field("sensor")
+
+    def getForeignKeys(self):
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(
+                cursor, SensorHourlyRollupModel._meta.db_table)
+        return [c["columns"] for c in constraints.values() if c["foreign_key"]]
+
+    @unittest.skipUnless(getHistoryDatabase() == DEFAULT_DB_ALIAS, "the history has its own database")
+    def testDrop(self):
+        self.assertEqual(self.getForeignKeys(), [["sensor_id"]])
+        self.assertEqual(dropForeignKeyConstraints([self.field], DEFAULT_DB_ALIAS, log=lambda message: None), 1)
+        self.assertEqual(self.getForeignKeys(), [])
+        self.assertEqual(dropForeignKeyConstraints([self.field], DEFAULT_DB_ALIAS, log=lambda message: None), 0)
+
+        # back to the migrated schema
+        constrainedField = copy.copy(self.field)
+        constrainedField.db_constraint = True
+        with connection.schema_editor() as editor:
+            editor.alter_field(SensorHourlyRollupModel, self.field, constrainedField)
+        self.assertEqual(self.getForeignKeys(), [["sensor_id"]])
+
+
+class RollupHistoryEngineTest(GreenhouseTestCase):
+    """
+    `RollupHistoryEngine` returns the charts of `SensorHistoryEngine` when every hour
+    has a single reading, close enough to the sampled time
+    """
+
+    def write(self, readings: list):
+        bulkCreateSensorValues([
+            {"sensor": self.airTemp, "value": value, "timestamp": timestamp}
+            for timestamp, value in readings
+        ])
+
+    def assertSameCharts(self, startTime, endTime, unitScale: int):
+        expected = SensorHistoryEngine(self.airTemp).getHistoryDatas(startTime, endTime, unitScale)
+        charts = RollupHistoryEngine(self.airTemp).getHistoryDatas(startTime, endTime, unitScale)
+        self.assertEqual(len(charts), len(expected), f"{endTime} by {unitScale}")
+        for value, expectedValue in zip(charts, expected):
+            self.assertAlmostEqual(value, expectedValue, msg=f"{endTime} by {unitScale}")
+
+    def testStartOffTheHour(self):
+        start = utc(2024, 5, 2, 10, 30)
+        # a leading gap and a missing hour, each reading is sampled at half past
+        self.write([
+            (utc(2024, 5, 2, hour, 30), hour) for hour in [12, 13, 15, 16, 17, 18, 19]
+        ])
+        for hours in [3, 6, 9]:
+            self.assertSameCharts(start, start + datetime.timedelta(hours=hours), 1)
+
+        # without gaps the bucket means are the means of the hourly samples
+        start = utc(2024, 5, 2, 15, 30)
+        for unitScale in [2, 3, 4]:
+            self.assertSameCharts(start, start + datetime.timedelta(hours=4), unitScale)
+
+    def testDailyBucketsStopAtEndTime(self):
+        start = utc(2024, 5, 1)
+        self.write([
+            (start + datetime.timedelta(hours=hours), hours % 7) for hours in range(48)
+        ])
+        # the readings of the afternoon of the last day are not counted
+        for hours in [23, 24, 36]:
+            self.assertSameCharts(start, start + datetime.timedelta(hours=hours), 24)
+
+        self.assertEqual(
+            RollupHistoryEngine(self.airTemp).getHistoryVersion(start, start + datetime.timedelta(hours=36), 24)[2],
+            37,
+        )
+
+
+class SensorStreamTest(GreenhouseTestCase):
+    """
+    gh/real-sensor/stream accepts the valid lines of the body and reports the
+    others with their line number
+    """
+
+    def putStream(self, lines: list):
+        return self.client.put(
+            f"/gh/real-sensor/{self.greenhouse.greenhouseUID}/stream",
+            "".join(line + "\n" for line in lines),
+            content_type="application/x-ndjson",
+        )
+
+    def line(self, sensors: dict):
+        return json.dumps({"AirSensor_1": {"address": {"lat": 24.1, "lng": 47.3}, "sensors": sensors}})
+
+    def testLinesAreCounted(self):
+        response = self.putStream([
+            self.line({"airTemp": 21, "timestamp": "2024-05-02 10:00:00"}),
+            "not json",
+            self.line({"airTemp": 22}),
+            "",
+            self.line({"airTemp": 23, "airHumidity": 60, "timestamp": "2024-05-02 11:00:00"}),
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data["accepted"], response.data["rejected"]), (2, 2))
+        self.assertEqual(sorted(response.data["errors"].keys()), [2, 3])
+        self.assertEqual([record[1] for record in self.getHistory(self.airTemp)], [21, 23])
+
+    @override_settings(GREENHOUSE_STREAM_CHUNK_SIZE=1)
+    def testFailedChunkRejectsItsLines(self):
+        with mock.patch("greenhouse_data.greenhouse_views.bulkCreateSensorValues",
+                        side_effect=[None, DatabaseError("database is locked")]):
+            response = self.putStream([
+                self.line({"airTemp": 21, "timestamp": "2024-05-02 10:00:00"}),
+                self.line({"airTemp": 22, "timestamp": "2024-05-02 11:00:00"}),
+            ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data["accepted"], response.data["rejected"]), (1, 1))
+        self.assertEqual(response.data["errors"], {
+                         2: ["failed to write sensor history: database is locked"]})
+
+
+class ControllerSettingReportTest(GreenhouseTestCase):
+    """
+    A controller reporting its current setting again only updates `lastSeen`
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.controller = ControllerModel.objects.create(
+            greenhouse=self.greenhouse, itemName="evalve", controllerID="evalve_1", controllerKey="evalve")
+
+    def putSetting(self, timestamp: str, duration: int):
+        response = self.client.put(
+            f"/gh/controller/{self.greenhouse.greenhouseUID}",
+            {"evalve_1": {"setting": {"on": False, "manualControl": False, "timestamp": timestamp, "cutHumidity": 30,
+                                      "schedules": [{"duration": duration, "startTime": "15:00"}]}}},
+            format="json",
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def getSettings(self):
+        return list(ControllerSettingHistoryModel.objects.filter(
+            controller=self.controller).order_by("id").values_list("timestamp", "lastSeen", "isCurrent"))
+
+    def testUnchangedSettingOnlyUpdatesLastSeen(self):
+        self.putSetting("2024-05-02 10:00:00", 15)
+        self.putSetting("2024-05-02 10:05:00", 15)
+        self.assertEqual(self.getSettings(), [
+                         (utc(2024, 5, 2, 10), utc(2024, 5, 2, 10, 5), True)])
+
+        self.putSetting("2024-05-02 10:10:00", 20)
+        settings = self.getSettings()
+        self.assertEqual([(timestamp, isCurrent) for timestamp, _, isCurrent in settings], [
+                         (utc(2024, 5, 2, 10), False), (utc(2024, 5, 2, 10, 10), True)])
+        self.controller.refresh_from_db()
+        self.assertEqual(self.controller.currentSetting.timestamp, utc(2024, 5, 2, 10, 10))
+
+
+@override_settings(GREENHOUSE_LONG_POLL={"TIMEOUT": 30, "MAX_TIMEOUT": 60, "RECHECK_INTERVAL": 30})
+class ControllerPollTest(GreenhouseTestCase):
+    """
+    gh/controller/<uid>/poll answers at once when the controller missed a setting,
+    and otherwise waits for the next one or for its timeout. The recheck interval is
+    longer than the tests, only the broker can wake a waiting poll.
+    """
+
+    def setUp(self):
+        super().setUp()
+        ControllerModel.objects.create(
+            greenhouse=self.greenhouse, itemName="evalve", controllerID="evalve_1", controllerKey="evalve")
+        self.putSetting("2024-05-02 10:00:00", 15)
+        self.version = ControllerSettingHistoryModel.objects.latest("id").id
+
+    def putSetting(self, timestamp: str, duration: int):
+        # the new setting is published once committed
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.put(
+                f"/gh/controller/{self.greenhouse.greenhouseUID}",
+                {"evalve_1": {"setting": {"on": False, "manualControl": False, "timestamp": timestamp, "cutHumidity": 30,
+                                          "schedules": [{"duration": duration, "startTime": "15:00"}]}}},
+                format="json",
+            )
+        self.assertEqual(response.status_code, 200)
+
+    async def poll(self, version: int, timeout: float):
+        return await self.async_client.get(
+            f"/gh/controller/{self.greenhouse.greenhouseUID}/poll", {"version": version, "timeout": timeout})
+
+    async def testMissedSetting(self):
+        response = await self.poll(0, 5)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data["version"], self.version)
+        self.assertEqual(list(data["controllers"].keys()), ["evalve_1"])
+
+    async def testTimeout(self):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        response = await self.poll(self.version, 0.2)
+        self.assertEqual(response.status_code, 204)
+        self.assertLess(loop.time() - start, 5)
+
+    async def testWakeUpOnNewSetting(self):
+        request = asyncio.create_task(self.poll(self.version, 10))
+        await asyncio.sleep(0.2)
+        self.assertFalse(request.done())
+
+        await sync_to_async(self.putSetting)("2024-05-02 10:10:00", 20)
+        response = await asyncio.wait_for(request, 5)
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(response.json()["version"], self.version)
+
+
+class PushTest(GreenhouseTestCase):
+    """
+    The server-sent events and the websockets forward the messages published on the
+    channels of the greenhouse, through `LocalBroker`
+    """
+
+    def assertNoSubscription(self):
+        self.assertEqual(broker.stats()["subscriptions"], 0)
+
+    async def testServerSentEvents(self):
+        path = f"/gh/greenhouse/{self.greenhouse.greenhouseUID}/events"
+        response = await self.async_client.get(path)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+
+        events = aiter(response)
+        self.assertEqual(await anext(events), b": connected\n\n")
+        message = {"type": "sensors", "sensors": [{"realSensorID": "AirSensor_1", "sensorKey": "airTemp", "value": 21}]}
+        broker.publish(sensorChannel(self.greenhouse.greenhouseUID), message)
+        self.assertEqual(
+            await asyncio.wait_for(anext(events), 5), f"event: sensors\ndata: {json.dumps(message)}\n\n".encode())
+
+        # the ASGI handler cancels the stream of a disconnected client
+        nextEvent = asyncio.create_task(anext(events))
+        await asyncio.sleep(0.1)
+        nextEvent.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await nextEvent
+        self.assertNoSubscription()
+
+    async def testServerSentEventsAreChecked(self):
+        response = await self.async_client.get("/gh/greenhouse/00000000-0000-0000-0000-000000000000/events")
+        self.assertEqual(response.status_code, 404)
+
+        await sync_to_async(DeviceKeyModel.objects.create)(greenhouse=self.greenhouse, key=generateDeviceKey())
+        response = await self.async_client.get(f"/gh/greenhouse/{self.greenhouse.greenhouseUID}/events")
+        self.assertEqual(response.status_code, 401)
+        self.assertNoSubscription()
+
+    async def connectWebsocket(self, path: str, queryString: str = ""):
+        """ Open a websocket on `myproject.asgi.application`, return (receive queue, send queue, task) """
+        receive, send = asyncio.Queue(), asyncio.Queue()
+        await receive.put({"type": "websocket.connect"})
+        scope = {"type": "websocket", "path": path, "query_string": queryString.encode(), "headers": []}
+        return receive, send, asyncio.create_task(application(scope, receive.get, send.put))
+
+    async def testWebsocket(self):
+        token = await sync_to_async(Token.objects.create)(user=self.user)
+        receive, send, connection = await self.connectWebsocket(
+            f"/ws/app/greenhouse/{self.greenhouse.greenhouseUID}", f"token={token.key}")
+        self.assertEqual(await asyncio.wait_for(send.get(), 5), {"type": "websocket.accept"})
+
+        message = {"type": "controller", "version": 3, "controllerID": "fan_1"}
+        broker.publish(controllerChannel(self.greenhouse.greenhouseUID), message)
+        self.assertEqual(await asyncio.wait_for(send.get(), 5), {"type": "websocket.send", "text": json.dumps(message)})
+
+        await receive.put({"type": "websocket.disconnect"})
+        await asyncio.wait_for(connection, 5)
+        self.assertNoSubscription()
+
+    async def testWebsocketIsChecked(self):
+        for path, code in [
+            (f"/ws/app/greenhouse/{self.greenhouse.greenhouseUID}", 4403),
+            (f"/ws/greenhouse/{self.greenhouse.greenhouseUID}", 4404),
+        ]:
+            receive, send, connection = await self.connectWebsocket(path)
+            self.assertEqual(await asyncio.wait_for(send.get(), 5), {"type": "websocket.close", "code": code})
+            await asyncio.wait_for(connection, 5)
+        self.assertNoSubscription()
+
+
+class BrokerStatsTest(SimpleTestCase):
+    """
+    Both brokers count the messages published by the process and the messages
+    delivered to its subscriptions
+    """
+
+    async def testLocalBroker(self):
+        localBroker = LocalBroker()
+        subscription = localBroker.subscribe(["greenhouse:1:sensors"])
+        localBroker.publish("greenhouse:1:sensors", {"type": "sensors"})
+        localBroker.publish("greenhouse:2:sensors", {"type": "sensors"})
+        self.assertEqual(await subscription.get(1), {"type": "sensors"})
+        subscription.close()
+
+        stats = localBroker.stats()
+        self.assertEqual((stats["published"], stats["delivered"], stats["subscriptions"]), (2, 1, 0))
+
+    @unittest.skipUnless(importlib.util.find_spec("redis"), "redis is not installed")
+    async def testRedisBroker(self):
+        with mock.patch("redis.Redis.from_url") as fromURL, mock.patch("greenhouse_data.pubsub.threading.Thread"):
+            redisBroker = RedisBroker()
+        subscription = redisBroker.subscribe(["greenhouse:1:sensors"])
+        redisBroker.publish("greenhouse:1:sensors", {"type": "sensors"})
+        redisBroker.publish("greenhouse:2:sensors", {"type": "sensors"})
+        self.assertEqual(fromURL.return_value.publish.call_count, 2)
+
+        # the listener delivers the message of this process back
+        redisBroker.fanOut("greenhouse:1:sensors", {"type": "sensors"})
+        self.assertEqual(await subscription.get(1), {"type": "sensors"})
+        subscription.close()
+
+        stats = redisBroker.stats()
+        self.assertEqual((stats["published"], stats["delivered"]), (2, 1))
+
+
+class DeviceSignatureTest(GreenhouseTestCase):
+    """
+    A greenhouse accepts unsigned requests until it has a device key, then only the
+    requests signed with it, and nothing once the key is revoked
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.appClient = APIClient()
+        self.appClient.force_authenticate(self.user)
+        self.path = f"/gh/real-sensor/{self.greenhouse.greenhouseUID}"
+        self.body = json.dumps({"AirSensor_1": {"address": {"lat": 24.1, "lng": 47.3},
+                                               "sensors": {"airTemp": 21, "timestamp": "2024-05-02 10:00:00"}}})
+
+    def createKey(self):
+        response = self.appClient.post(
+            f"/app/greenhouse/{self.greenhouse.greenhouseUID}/device-key")
+        self.assertEqual(response.status_code, 201)
+        return response.data["deviceKey"]
+
+    def revokeKey(self):
+        response = self.appClient.delete(
+            f"/app/greenhouse/{self.greenhouse.greenhouseUID}/device-key")
+        self.assertEqual(response.status_code, 200)
+
+    def signedHeaders(self, key: str, nonce: str = None):
+        timestamp = int(time.time())
+        headers = {
+            TIMESTAMP_HEADER: str(timestamp),
+            SIGNATURE_HEADER: signRequest(key, timestamp, "PUT", self.path, bodyDigest(self.body.encode()), nonce),
+        }
+        if nonce is not None:
+            headers[NONCE_HEADER] = nonce
+        return headers
+
+    def put(self, headers: dict = None):
+        return self.client.put(self.path, self.body, content_type="application/json",
+                               headers=headers or {}).status_code
+
+    def testUnsignedWithoutKey(self):
+        self.assertEqual(self.put(), 200)
+
+    @override_settings(GREENHOUSE_DEVICE_AUTH={**settings.GREENHOUSE_DEVICE_AUTH, "ENFORCE": True})
+    def testEnforcedWithoutKey(self):
+        self.assertEqual(self.put(), 401)
+
+    def testKeyRequiresSignature(self):
+        key = self.createKey()
+        self.assertEqual(self.put(), 401)
+        self.assertEqual(self.put(self.signedHeaders(key)), 200)
+        self.assertEqual(self.put(self.signedHeaders(generateDeviceKey(), "1")), 401)
+
+    def testReplay(self):
+        key = self.createKey()
+        headers = self.signedHeaders(key, "1")
+        self.assertEqual(self.put(headers), 200)
+        self.assertEqual(self.put(headers), 401)
+        self.assertEqual(self.put(self.signedHeaders(key, "2")), 200)
+
+    def testRotatedKey(self):
+        previousKey = self.createKey()
+        key = self.createKey()
+        self.assertEqual(self.put(self.signedHeaders(previousKey, "1")), 200)
+        self.assertEqual(self.put(self.signedHeaders(key, "2")), 200)
+
+        # once the grace period is over only the new key is accepted
+        DeviceKeyModel.objects.filter(greenhouse=self.greenhouse).update(
+            rotatedAt=timezone.now() - datetime.timedelta(days=1))
+        deviceKeyCache.clear()
+        self.assertEqual(self.put(self.signedHeaders(previousKey, "3")), 401)
+        self.assertEqual(self.put(self.signedHeaders(key, "4")), 200)
+
+    def testKeyRotatedByAnotherProcess(self):
+        previousKey = self.createKey()
+        self.assertEqual(self.put(self.signedHeaders(previousKey, "1")), 200)
+
+        # no signal reaches the cache of this process
+        key = generateDeviceKey()
+        DeviceKeyModel.objects.filter(greenhouse=self.greenhouse).update(
+            key=key, previousKey=previousKey, rotatedAt=timezone.now())
+        self.assertEqual(self.put(self.signedHeaders(key, "2")), 200)
+
+        # the keys are not reloaded again on every mismatch
+        with self.assertNumQueries(0):
+            self.assertEqual(self.put(self.signedHeaders(generateDeviceKey(), "3")), 401)
+
+    def testRevokedKey(self):
+        key = self.createKey()
+        self.revokeKey()
+        self.assertEqual(self.put(), 401)
+        self.assertEqual(self.put(self.signedHeaders(key, "1")), 401)
+
+        response = self.appClient.get(
+            f"/app/greenhouse/{self.greenhouse.greenhouseUID}/device-key")
+        self.assertEqual((response.data["provisioned"], response.data["revoked"]), (False, True))
+
+        key = self.createKey()
+        self.assertEqual(self.put(self.signedHeaders(key, "2")), 200)
+
+
+@override_settings(GREENHOUSE_READ_REPLICAS={
+    "DATABASES": {"default": ["default"]}, "PIN_SECONDS": 10, "PIN_CACHE": "default"})
+class ReadReplicaTest(GreenhouseTestCase):
+    """
+    The app GET requests read from the replicas, except right after a write of the
+    same user. The default database stands for its own replica.
+    """
+
+    def setUp(self):
+        super().setUp()
+        caches["default"].delete(getPinKey(self.user))
+        self.client.force_authenticate(self.user)
+        self.path = f"/app/greenhouse/{self.greenhouse.greenhouseUID}"
+
+    def readsReplica(self):
+        """ Whether a GET of the greenhouse picked a replica """
+        with mock.patch("greenhouse_data.routers.random.choice", side_effect=lambda replicas: replicas[0]) as choice:
+            self.assertEqual(self.client.get(self.path).status_code, 200)
+        return choice.called
+
+    def testReadAfterWrite(self):
+        self.assertTrue(self.readsReplica())
+
+        response = self.client.patch(self.path, {"name": "renamed"}, format="json")
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(isPinnedToPrimary(self.user))
+        self.assertFalse(self.readsReplica())
+        self.assertFalse(replicaReads.get())
+
+        # back to the replicas once the pin expires
+        caches["default"].delete(getPinKey(self.user))
+        self.assertTrue(self.readsReplica())
+
+    def testFailedWriteIsNotPinned(self):
+        response = self.client.patch(self.path, {"beginDate": "not a date"}, format="json")
+        self.assertEqual(response.status_code, 400)
+        self.assertTrue(self.readsReplica())
+
+
+class CurrentValueMigrationTest(TransactionTestCase):
+    """
+    Migration 0002 copies the current history records to the new current columns
+    """
+    migrateFrom = [("greenhouse_data", "0001_initial")]
+    migrateTo = [("greenhouse_data", "0002_current_value")]
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(executor.loader.graph.leaf_nodes())
+        # migration 0011 moved the rows to the month tables
+        dropMonthTables()
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    @unittest.skipUnless(getHistoryDatabase() == DEFAULT_DB_ALIAS, "the migration runs on one database")
+    def testBackfill(self):
+        apps = self.migrate(self.migrateFrom)
+        Greenhouse = apps.get_model("greenhouse_data", "GreenhouseModel")
+        RealSensor = apps.get_model("greenhouse_data", "RealSensorModel")
+        Sensor = apps.get_model("greenhouse_data", "SensorModel")
+        SensorHistory = apps.get_model("greenhouse_data", "SensorValueHistoryModel")
+        Controller = apps.get_model("greenhouse_data", "ControllerModel")
+        ControllerHistory = apps.get_model("greenhouse_data", "ControllerSettingHistoryModel")
+
+        greenhouse = Greenhouse.objects.create(
+            name="greenhouse", address="address", beginDate=datetime.date(2024, 5, 1))
+        realSensor = RealSensor.objects.create(
+            greenhouse=greenhouse, itemName="AirSensor", realSensorID="AirSensor_1", realSensorKey="AirSensor")
+        sensor = Sensor.objects.create(realSensor=realSensor, itemName="airTemp", sensorKey="airTemp")
+        emptySensor = Sensor.objects.create(realSensor=realSensor, itemName="airHumidity", sensorKey="airHumidity")
+        SensorHistory.objects.create(sensor=sensor, timestamp=utc(2024, 5, 2, 10), value=21, isCurrent=False)
+        SensorHistory.objects.create(sensor=sensor, timestamp=utc(2024, 5, 2, 11), value=22, isCurrent=True)
+        controller = Controller.objects.create(
+            greenhouse=greenhouse, itemName="fan", controllerID="fan_1", controllerKey="fan")
+        ControllerHistory.objects.create(controller=controller, timestamp=utc(2024, 5, 2, 10), on=False, isCurrent=False)
+        setting = ControllerHistory.objects.create(controller=controller, timestamp=utc(2024, 5, 2, 11), on=True, isCurrent=True)
+
+        apps = self.migrate(self.migrateTo)
+        Sensor = apps.get_model("greenhouse_data", "SensorModel")
+        Controller = apps.get_model("greenhouse_data", "ControllerModel")
+
+        sensor = Sensor.objects.get(id=sensor.id)
+        self.assertEqual((sensor.currentValue, sensor.currentTimestamp), (22, utc(2024, 5, 2, 11)))
+        emptySensor = Sensor.objects.get(id=emptySensor.id)
+        self.assertEqual((emptySensor.currentValue, emptySensor.currentTimestamp), (None, None))
+        self.assertEqual(Controller.objects.get(id=controller.id).currentSetting_id, setting.id)
+
+
+def dropMonthTables():
+    """ Drop the month tables of the sensor history, TransactionTestCase only flushes the models """
+    partitions = getHistoryPartitions()
+    connection = partitions.connection
+    with connection.cursor() as cursor:
+        for name in connection.introspection.table_names(cursor):
+            if name.startswith(f"{partitions.table}_") and name[len(partitions.table) + 1:][:6].isdigit():
+                cursor.execute(f"DROP TABLE {connection.ops.quote_name(name)}")
+    partitions.clear()
+
+
+@unittest.skipIf(connections[getHistoryDatabase()].vendor == "postgresql", "the native partitions are not tested")
+class HistoryPartitionsTest(TransactionTestCase):
+    """
+    The month tables of the sensor history are created ahead and on ingest, read
+    across a month boundary and detached or dropped by `history_partitions`
+    """
+    databases = {"default", getHistoryDatabase()}
+
+    def setUp(self):
+        for cache in [topologyCache, snapshotCache, deviceKeyCache]:
+            cache.clear()
+        self.partitions = getHistoryPartitions()
+        self.partitions.clear()
+        self.addCleanup(dropMonthTables)
+
+        greenhouse = GreenhouseModel.objects.create(
+            name="greenhouse", address="address", beginDate=datetime.date(2024, 4, 1))
+        realSensor = RealSensorModel.objects.create(
+            greenhouse=greenhouse, itemName="AirSensor", realSensorID="AirSensor_1", realSensorKey="AirSensor")
+        self.sensor = SensorModel.objects.create(
+            realSensor=realSensor, itemName="airTemp", sensorKey="airTemp")
+
+    def write(self, readings: list):
+        bulkCreateSensorValues([
+            {"sensor": self.sensor, "value": value, "timestamp": timestamp}
+            for timestamp, value in readings
+        ])
+
+    def runCommand(self, *args):
+        stdout = io.StringIO()
+        call_command("history_partitions", *args, stdout=stdout)
+        return stdout.getvalue().splitlines()
+
+    def testCreateAhead(self):
+        currentMonth = monthStart(timezone.now())
+        months = [currentMonth, addMonths(currentMonth, 1)]
+        self.assertEqual(self.runCommand("--months-ahead", "1"), [
+            f"{self.partitions.partitionName(month)}: attached" for month in months
+        ])
+
+        # the list is cached, a second run creates nothing
+        with self.assertNumQueries(0):
+            self.assertEqual(self.partitions.listMonths(), months)
+        self.runCommand("--months-ahead", "1")
+        self.assertEqual(self.partitions.listMonths(), months)
+
+    def testIngestAcrossMonths(self):
+        self.assertEqual(self.partitions.listMonths(), [])
+        self.write([(utc(2024, 4, 30, 23), 21), (utc(2024, 5, 1, 0), 22), (utc(2024, 5, 1, 1), 23)])
+
+        # the months created by the ingest are listed once it committed
+        self.assertEqual(self.partitions.listMonths(), [utc(2024, 4, 1), utc(2024, 5, 1)])
+        self.assertEqual(getMonthModel(utc(2024, 4, 1)).objects.count(), 1)
+        self.assertEqual(getMonthModel(utc(2024, 5, 1)).objects.count(), 2)
+        self.assertEqual(
+            SensorHistoryEngine(self.sensor).getHistoryDatas(utc(2024, 4, 30, 22), utc(2024, 5, 1, 1), 1),
+            [21, 21, 22, 23],
+        )
+        self.assertEqual(
+            SensorHistoryEngine(self.sensor).getHistoryDatas(utc(2024, 5, 1, 0), utc(2024, 5, 1, 1), 1),
+            [22, 23],
+        )
+
+    def testDetach(self):
+        self.write([(utc(2024, 4, 30, 23), 21), (utc(2024, 5, 1, 0), 22)])
+        # the current month is at least two years after May 2024
+        self.assertEqual(self.runCommand("--months-ahead", "0", "--retain-months", "24")[:2], [
+            f"{self.partitions.table}_202404: detached",
+            f"{self.partitions.table}_202405: detached",
+        ])
+        self.assertEqual(self.partitions.listMonths(), [monthStart(timezone.now())])
+        self.assertEqual(
+            SensorHistoryEngine(self.sensor).getHistoryDatas(utc(2024, 4, 30, 22), utc(2024, 5, 1, 1), 1), [])
+
+        connection = self.partitions.connection
+        with connection.cursor() as cursor:
+            tables = connection.introspection.table_names(cursor)
+        self.assertIn(f"{self.partitions.table}_202404_detached", tables)
+
+        # the late readings of a detached month are stored again
+        self.write([(utc(2024, 5, 1, 1), 23)])
+        self.assertEqual(
+            SensorHistoryEngine(self.sensor).getHistoryDatas(utc(2024, 5, 1, 0), utc(2024, 5, 1, 1), 1), [23, 23])
+
+    def testDrop(self):
+        self.write([(utc(2024, 5, 1, 0), 22)])
+        self.assertEqual(self.runCommand("--months-ahead", "0", "--retain-months", "24", "--drop")[0],
+                         f"{self.partitions.table}_202405: dropped")
+
+        connection = self.partitions.connection
+        with connection.cursor() as cursor:
+            tables = connection.introspection.table_names(cursor)
+        self.assertNotIn(f"{self.partitions.table}_202405", tables)
+        self.assertNotIn(f"{self.partitions.table}_202405_detached", tables)
+
+
+@unittest.skipUnless(getHistoryDatabase() == DEFAULT_DB_ALIAS and connection.vendor == "sqlite",
+                     "the migration moves the rows of one SQLite database")
+class HistoryPartitionsMigrationTest(TransactionTestCase):
+    """
+    Migration 0011 moves the rows of sensorHistoryTable into the month tables
+    """
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(executor.loader.graph.leaf_nodes())
+        dropMonthTables()
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def testAbsorbBaseTable(self):
+        apps = self.migrate([("greenhouse_data", "0010_history_database")])
+        Greenhouse = apps.get_model("greenhouse_data", "GreenhouseModel")
+        RealSensor = apps.get_model("greenhouse_data", "RealSensorModel")
+        Sensor = apps.get_model("greenhouse_data", "SensorModel")
+        SensorHistory = apps.get_model("greenhouse_data", "SensorValueHistoryModel")
+
+        greenhouse = Greenhouse.objects.create(
+            name="greenhouse", address="address", beginDate=datetime.date(2024, 4, 1))
+        realSensor = RealSensor.objects.create(
+            greenhouse=greenhouse, itemName="AirSensor", realSensorID="AirSensor_1", realSensorKey="AirSensor")
+        sensor = Sensor.objects.create(realSensor=realSensor, itemName="airTemp", sensorKey="airTemp")
+        SensorHistory.objects.bulk_create([
+            SensorHistory(sensor=sensor, timestamp=utc(2024, 4, 30, 23), value=21, isCurrent=False),
+            SensorHistory(sensor=sensor, timestamp=utc(2024, 5, 1, 0), value=22, isCurrent=False),
+            SensorHistory(sensor=sensor, timestamp=utc(2024, 5, 1, 1), value=23, isCurrent=True),
+        ])
+
+        apps = self.migrate([("greenhouse_data", "0011_history_partitions")])
+        self.assertEqual(apps.get_model("greenhouse_data", "SensorValueHistoryModel").objects.count(), 0)
+        self.assertEqual(
+            list(getMonthModel(utc(2024, 4, 1)).objects.values_list("sensor_id", "timestamp", "value", "isCurrent")),
+            [(sensor.id, utc(2024, 4, 30, 23), 21, False)],
+        )
+        self.assertEqual(
+            list(getMonthModel(utc(2024, 5, 1)).objects.order_by("timestamp").values_list("value", "isCurrent")),
+            [(22, False), (23, True)],
+        )
+
+
+@unittest.skipUnless(connections[getHistoryDatabase()].vendor == "sqlite", "EXPLAIN QUERY PLAN is sqlite only")
+class HistoryQueryPlanTest(TestCase):
+    """
+    Check the query plans of the hot history queries. Each query must search the
+    given index, a full scan of the table fails the test.
+    """
+    databases = {"default", getHistoryDatabase()}
+
+    @classmethod
+    def setUpTestData(cls):
+        greenhouse = GreenhouseModel.objects.create(
+            name="greenhouse", address="address", beginDate=datetime.date(2024, 5, 1))
+        realSensor = RealSensorModel.objects.create(
+            greenhouse=greenhouse, itemName="AirSensor", realSensorID="AirSensor_1", realSensorKey="AirSensor")
+        cls.sensor = SensorModel.objects.create(
+            realSensor=realSensor, itemName="airTemp", sensorKey="airTemp")
+        cls.controller = ControllerModel.objects.create(
+            greenhouse=greenhouse, itemName="fan", controllerID="fan_1", controllerKey="fan")
+
+        # the month table of May 2024, see partitions.py
+        startTime = datetime.datetime(2024, 5, 1, tzinfo=datetime.timezone.utc)
+        partitions = getHistoryPartitions()
+        partitions.ensureMonths([startTime])
+        cls.historyModel = partitions.models(startTime, startTime)[0]
+        cls.historyModel.objects.bulk_create([
+            cls.historyModel(
+                sensor_id=cls.sensor.id, timestamp=startTime + datetime.timedelta(minutes=20 * i), value=i, isCurrent=False)
+            for i in range(200)
+        ])
+        ControllerSettingHistoryModel.objects.bulk_create([
+            ControllerSettingHistoryModel(
+                controller=cls.controller, timestamp=startTime + datetime.timedelta(hours=i), on=False, isCurrent=False)
+            for i in range(50)
+        ])
+
+        with connections[getHistoryDatabase()].cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+    def assertSearches(self, queryset, table: str, index: str):
+        plan = queryset.explain()
+        for line in plan.splitlines():
+            self.assertNotRegex(
+                line, rf"\bSCAN {table}\b", f"full scan of {table}:\n{plan}")
+        self.assertIn(f"SEARCH {table} USING", plan)
+        self.assertIn(index, plan)
+
+    def testSensorHistoryRange(self):
+        self.assertSearches(
+            self.historyModel.objects.filter(
+                sensor_id=self.sensor.id,
+                timestamp__range=[
+                    datetime.datetime(2024, 5, 1, tzinfo=datetime.timezone.utc),
+                    datetime.datetime(2024, 5, 2, tzinfo=datetime.timezone.utc),
+                ],
+            ).order_by("timestamp").values_list("timestamp", "value"),
+            "sensorHistoryTable_202405",
+            "sqlite_autoindex_sensorHistoryTable_202405",
+        )
+
+    def testSensorCurrent(self):
+        self.assertSearches(
+            self.historyModel.objects.filter(
+                sensor_id__in=[self.sensor.id], isCurrent=True).order_by(),
+            "sensorHistoryTable_202405",
+            "sensor_history_current_202405",
+        )
+
+    def testControllerCurrent(self):
+        self.assertSearches(
+            ControllerSettingHistoryModel.objects.filter(
+                controller=self.controller, isCurrent=True).order_by(),
+            "controllerHistoryTable",
+            "controller_history_current",
+        )
+
+    def testControllerHistory(self):
+        self.assertSearches(
+            ControllerSettingHistoryModel.objects.filter(
+                controller=self.controller).order_by("-timestamp")[:1],
+            "controllerHistoryTable",
+            "controller_history_timestamp",
+        )
+
+    def testHourlyRollupRange(self):
+        self.assertSearches(
+            SensorHourlyRollupModel.objects.filter(
+                sensor=self.sensor,
+                bucket__range=[
+                    datetime.datetime(2024, 5, 1, tzinfo=datetime.timezone.utc),
+                    datetime.datetime(2024, 5, 2, tzinfo=datetime.timezone.utc),
+                ],
+            ).values_list("bucket", "count", "valueSum"),
+            "sensorHourlyRollupTable",
+            "sqlite_autoindex_sensorHourlyRollupTable",
+        )
+
+
+# the test mirrors of the replicas do not see the data of the test transactions
+@override_settings(GREENHOUSE_READ_REPLICAS={"DATABASES": {}, "PIN_SECONDS": 0, "PIN_CACHE": "default"})
+class GreenhouseListQueryCountTest(TestCase):
+    """
+    GET /app/greenhouse must run the same number of queries whatever the number of
+    greenhouses and devices of the user: one for the versions, and six to build
+    the greenhouses without a cached snapshot, two of them on the history database
+    """
+    databases = {"default", getHistoryDatabase()}
+
+    def assertNumQueriesWithHistory(self, metadataCount: int, historyCount: int):
+        history = getHistoryDatabase()
+        if history == DEFAULT_DB_ALIAS:
+            return self.assertNumQueries(metadataCount + historyCount)
+
+        stack = ExitStack()
+        stack.enter_context(self.assertNumQueries(metadataCount))
+        stack.enter_context(self.assertNumQueries(historyCount, using=history))
+        return stack
+
+    def setUp(self):
+        self.user = User.objects.create_user("owner", password="password")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def createGreenhouse(self, deviceCount: int):
+        timestamp = datetime.datetime(2024, 5, 1, tzinfo=datetime.timezone.utc)
+        greenhouse = GreenhouseModel.objects.create(
+            owner=self.user, name="greenhouse", address="address", beginDate=datetime.date(2024, 5, 1))
+
+        for i in range(deviceCount):
+            realSensor = RealSensorModel.objects.create(
+                greenhouse=greenhouse, itemName="AirSensor", realSensorID=f"AirSensor_{i}", realSensorKey="AirSensor")
+            for sensorKey in ["airTemp", "airHumidity"]:
+                SensorModel.objects.create(
+                    realSensor=realSensor, itemName=sensorKey, sensorKey=sensorKey, currentValue=20, currentTimestamp=timestamp)
+
+            controller = ControllerModel.objects.create(
+                greenhouse=greenhouse, itemName="evalve", controllerID=f"evalve_{i}", controllerKey="evalve")
+            setting = ControllerSettingHistoryModel.objects.create(
+                controller=controller, timestamp=timestamp, on=False, cutHumidity=30)
+            ScheduleModel.objects.create(
+                controllerSetting=setting, duration=datetime.timedelta(seconds=15))
+            controller.currentSetting = setting
+            controller.save(update_fields=["currentSetting"])
+
+    def testQueryCountDoesNotGrow(self):
+        self.createGreenhouse(deviceCount=1)
+        with self.assertNumQueriesWithHistory(5, 2):
+            response = self.client.get("/app/greenhouse")
+        self.assertEqual(response.status_code, 200)
+
+        for _ in range(4):
+            self.createGreenhouse(deviceCount=10)
+        with self.assertNumQueriesWithHistory(5, 2):
+            response = self.client.get("/app/greenhouse")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            sorted(len(g["sensors"]["airTemp"]) for g in response.data), [1, 10, 10, 10, 10])
+        self.assertEqual(
+            response.data[0]["controllers"]["evalve"][0]["setting"]["duration"], [15.0])
+
+    def testSnapshotIsServedUntilNextWrite(self):
+        self.createGreenhouse(deviceCount=2)
+        self.client.get("/app/greenhouse")
+        with self.assertNumQueries(1):
+            response = self.client.get("/app/greenhouse")
+        self.assertEqual(response.data[0]["sensors"]["airTemp"][0]["value"], 20)
+
+        sensor = SensorModel.objects.filter(sensorKey="airTemp").first()
+        bulkCreateSensorValues([{
+            "sensor": sensor,
+            "value": 31,
+            "timestamp": datetime.datetime(2024, 5, 2, tzinfo=datetime.timezone.utc),
+        }])
+        with self.assertNumQueriesWithHistory(5, 2):
+            response = self.client.get("/app/greenhouse")
+        self.assertIn(31, [s["value"]
+                      for s in response.data[0]["sensors"]["airTemp"]])
+
+
+class SensorWriteBufferTest(SimpleTestCase):
+    """
+    A batch the flusher fails to write is retried, and only dropped once its
+    retries are exhausted
+    """
+
+    def flush(self, results: list):
+        """ Flush one batch, return the number of writes, the stats and the log records """
+        buffer = SensorWriteBuffer(
+            flushSize=2, flushInterval=10, maxQueue=10, maxRetries=2, retryDelay=1)
+        # the flusher thread is stopped even when the test fails
+        self.addCleanup(buffer.stop)
+        with mock.patch("greenhouse_data.buffer.bulkCreateSensorValues", side_effect=results) as write, \
+                self.assertLogs("greenhouse_data.buffer", "WARNING") as logs:
+            self.assertTrue(buffer.append([{"value": 1}, {"value": 2}]))
+            buffer.stop()
+        self.assertFalse(buffer._thread.is_alive())
+        return write.call_count, buffer.stats(), [(record.levelname, record.getMessage()) for record in logs.records]
+
+    def testFailedBatchIsRetried(self):
+        callCount, stats, logs = self.flush([Exception("database is locked"), None])
+        self.assertEqual(callCount, 2)
+        self.assertEqual(
+            (stats["flushed"], stats["failed"], stats["retried"], stats["dropped"]), (2, 1, 2, 0))
+        self.assertEqual(logs, [("WARNING", "failed to flush 2 sensor readings: database is locked")])
+
+    def testBatchIsDroppedAfterTheRetries(self):
+        callCount, stats, logs = self.flush([Exception("database is locked")] * 3)
+        self.assertEqual(callCount, 3)
+        self.assertEqual(
+            (stats["flushed"], stats["failed"], stats["dropped"]), (0, 3, 2))
+        self.assertEqual(stats["lastError"], "database is locked")
+        self.assertEqual(logs[-1], ("ERROR", "dropped 2 sensor readings after 2 retries: database is locked"))
+
+
+@unittest.skipUnless(connection.vendor == "sqlite", "SQLite only")
+class SQLiteWALTest(SimpleTestCase):
+    """
+    The new SQLite connections are moved to WAL, `sqlite_wal` reports the log and
+    checkpoints it. The test database lives in memory, which has no WAL, so the test
+    opens a database file of its own.
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.database = os.path.join(directory.name, "db.sqlite3")
+
+        self.connection = connections[DEFAULT_DB_ALIAS].__class__(
+            {**connections[DEFAULT_DB_ALIAS].settings_dict, "NAME": self.database}, alias="wal")
+        self.addCleanup(self.connection.close)
+
+        with self.connection.cursor() as cursor:
+            cursor.execute("CREATE TABLE reading (value REAL)")
+            cursor.executemany("INSERT INTO reading VALUES (%s)", [(value,) for value in range(100)])
+        self.connection.commit()
+
+    def testPragmas(self):
+        status = getWALStatus(self.connection)
+        self.assertEqual(status["database"], self.database)
+        self.assertEqual(status["journalMode"], "wal")
+        self.assertGreater(status["walSize"], 0)
+        self.assertEqual(status["pragmas"]["busy_timeout"], 5000)
+        self.assertEqual(status["pragmas"]["synchronous"], 1)
+
+    def testCheckpoint(self):
+        busy, walPages, checkpointedPages = checkpointWAL(self.connection, "TRUNCATE")
+        self.assertEqual((busy, walPages, checkpointedPages), (0, 0, 0))
+        self.assertEqual(getWALStatus(self.connection)["walSize"], 0)
+
+        with self.assertRaises(ValueError):
+            checkpointWAL(self.connection, "NOW")
+
+    def testCommand(self):
+        stdout = io.StringIO()
+        with mock.patch("greenhouse_data.management.commands.sqlite_wal.connections", {"wal": self.connection}):
+            call_command("sqlite_wal", database="wal", checkpoint="TRUNCATE", stdout=stdout)
+
+        lines = stdout.getvalue().splitlines()
+        self.assertIn("journal mode: wal", lines)
+        self.assertIn("busy_timeout: 5000", lines)
+        self.assertTrue(any(line.startswith("checkpoint TRUNCATE: ") for line in lines))
+        # reported again after the checkpoint
+        self.assertEqual([line for line in lines if line.startswith("wal size: ")][-1], "wal size: 0 bytes")
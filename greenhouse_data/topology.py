@@ -0,0 +1,71 @@
+"""
+In-process cache for the greenhouse topology used by the ingest endpoints. It maps
+(greenhouseUID, realSensorID) to the real sensor id and (greenhouseUID, realSensorID,
+sensorKey) to the sensor id, so steady-state ingest resolves ids without queries.
+Entries are invalidated per greenhouse by the model signals in `signals.py`.
+"""
+from django.conf import settings
+
+from .models import *
+from .utils import LRUCache
+
+
+class SensorTopologyCache:
+    """
+    Resolve real sensor and sensor ids through a bounded LRU cache. Missing items
+    are never cached, so a sensor created later is resolved on its first report.
+    """
+
+    REAL_SENSOR = "realSensor"
+    SENSOR = "sensor"
+
+    def __init__(self, maxSize: int):
+        self.cache = LRUCache(maxSize=maxSize)
+
+    def getRealSensorID(self, greenhouseUID, realSensorID: str):
+        key = (self.REAL_SENSOR, str(greenhouseUID), realSensorID)
+        realSensor = self.cache.get(key)
+        if realSensor is not None:
+            return realSensor
+
+        realSensor = RealSensorModel.objects.filter(
+            greenhouse=greenhouseUID, realSensorID=realSensorID).values_list("id", flat=True).first()
+        if realSensor is not None:
+            self.cache.set(key, realSensor)
+
+        return realSensor
+
+    def getSensorID(self, greenhouseUID, realSensorID: str, sensorKey: str):
+        key = (self.SENSOR, str(greenhouseUID), realSensorID, sensorKey)
+        sensor = self.cache.get(key)
+        if sensor is not None:
+            return sensor
+
+        # load every sensor of the real sensor at once, the other keys are
+        # usually reported in the same request
+        sensors = SensorModel.objects.filter(
+            realSensor__greenhouse=greenhouseUID,
+            realSensor__realSensorID=realSensorID,
+        ).values_list("sensorKey", "id")
+
+        for loadedKey, loadedID in sensors:
+            self.cache.set(
+                (self.SENSOR, str(greenhouseUID), realSensorID, loadedKey), loadedID)
+            if loadedKey == sensorKey:
+                sensor = loadedID
+
+        return sensor
+
+    def invalidateGreenhouse(self, greenhouseUID):
+        greenhouseUID = str(greenhouseUID)
+        return self.cache.popWhere(lambda key: key[1] == greenhouseUID)
+
+    def clear(self):
+        self.cache.clear()
+
+    def stats(self):
+        return self.cache.stats()
+
+
+topologyCache = SensorTopologyCache(
+    maxSize=getattr(settings, "GREENHOUSE_TOPOLOGY_CACHE_SIZE", 4096))
@@ -1,11 +1,15 @@
 from django.urls import path
-from . import greenhouse_views, app_views
+from . import greenhouse_views, app_views, push
 
 urlpatterns = [
     # backend system
     path("app/greenhouse", app_views.Greenhouse.as_view()),
     path("app/greenhouse/<greenhouseUID>",
          app_views.GreenhouseDetail.as_view()),
+    path("app/greenhouse/<greenhouseUID>/events",
+         push.AppGreenhouseEventsAPI.as_view()),
+    path("app/greenhouse/<greenhouseUID>/device-key",
+         app_views.DeviceKey.as_view()),
     path("app/controller/<greenhouseUID>/<controllerID>",
          app_views.ControllerDetail.as_view()),
     path("app/controller/<greenhouseUID>", app_views.Controller.as_view()),
@@ -13,12 +17,19 @@ urlpatterns = [
          app_views.RealSensorAPI.as_view()),
     path("app/sensor/<greenhouseUID>/<realSensorID>/<sensorKey>",
          app_views.SensorAPI.as_view()),
+    path("app/metrics", app_views.Metrics.as_view()),
 
     # greenhouse
     path('gh/controller/<greenhouseUID>',
          greenhouse_views.ControllerAPI.as_view()),
+    path('gh/controller/<greenhouseUID>/poll',
+         greenhouse_views.ControllerPollAPI.as_view()),
     path('gh/real-sensor/<greenhouseUID>',
          greenhouse_views.RealSensorAPI.as_view()),
+    path('gh/real-sensor/<greenhouseUID>/stream',
+         greenhouse_views.RealSensorStreamAPI.as_view()),
     path('gh/greenhouse/<greenhouseUID>',
-         greenhouse_views.GreenhouseAPI.as_view())
+         greenhouse_views.GreenhouseAPI.as_view()),
+    path('gh/greenhouse/<greenhouseUID>/events',
+         push.GreenhouseEventsAPI.as_view()),
 ]
@@ -1,2 +1,111 @@
+import threading
+import time
+from collections import OrderedDict
+
+
 def validate_field(payload: dict, field: str):
-    pass
\ No newline at end of file
+    pass
+
+
+class LRUCache:
+    """
+    Thread safe map bounded to `maxSize` entries. The least recently used entry is
+    evicted when the map is full. Hits, misses and evictions are counted so the
+    cache can be monitored through `stats()`.
+    """
+
+    def __init__(self, maxSize: int = 1024):
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxSize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def popWhere(self, predicate):
+        """ Remove every entry whose key satisfies `predicate(key)` """
+        with self._lock:
+            keys = [key for key in self._data if predicate(key)]
+            for key in keys:
+                del self._data[key]
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "maxSize": self.maxSize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class TTLCache(LRUCache):
+    """
+    LRUCache whose entries also expire `ttl` seconds after they were set. Expired
+    entries are removed when they are read and counted as misses.
+    """
+
+    def __init__(self, maxSize: int = 1024, ttl: float = 300):
+        super().__init__(maxSize=maxSize)
+        self.ttl = ttl
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            expiresAt, value = entry
+            if expiresAt <= time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                self.expirations += 1
+                return default
+
+            self.hits += 1
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        super().set(key, (time.monotonic() + self.ttl, value))
+
+    def pop(self, key, default=None):
+        entry = super().pop(key, None)
+        return default if entry is None else entry[1]
+
+    def stats(self):
+        stats = super().stats()
+        with self._lock:
+            stats["ttl"] = self.ttl
+            stats["expirations"] = self.expirations
+        return stats
@@ -0,0 +1,41 @@
+"""
+Model signal receivers keeping the authentication caches consistent with the
+database
+"""
+from django.contrib.auth.models import User
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from greenhouse_data.models import GreenhouseModel
+from .authentication import ownerCache, tokenCache
+
+
+@receiver(post_delete, sender=Token)
+def invalidateToken(sender, instance, **kwargs):
+    tokenCache.pop(instance.key)
+
+
+@receiver(post_save, sender=User)
+def invalidateUserTokens(sender, instance, created, **kwargs):
+    # the cached user is outdated, e.g. new password or deactivated
+    if created:
+        return
+
+    for key in Token.objects.filter(user=instance).values_list("key", flat=True):
+        tokenCache.pop(key)
+
+
+@receiver(post_save, sender=GreenhouseModel)
+def invalidateGreenhouseOwners(sender, instance, created, **kwargs):
+    if created:
+        ownerCache.pop(instance.owner_id)
+        return
+
+    # the previous owner is unknown when the owner changed
+    ownerCache.clear()
+
+
+@receiver(post_delete, sender=GreenhouseModel)
+def invalidateDeletedGreenhouseOwner(sender, instance, **kwargs):
+    ownerCache.pop(instance.owner_id)
@@ -1,3 +1,66 @@
+import datetime
+
+from django.contrib.auth.models import User
 from django.test import TestCase
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from greenhouse_data.models import GreenhouseModel
+from greenhouse_data.routers import getHistoryDatabase
+
+from .authentication import ownerCache, tokenCache
+
+
+class CachedTokenAuthenticationTest(TestCase):
+    """
+    A cached token stops authenticating as soon as it is deleted or its user can
+    no longer log in
+    """
+    databases = {"default", getHistoryDatabase()}
+
+    def setUp(self):
+        # the ids of the rows rolled back by the previous test are given again
+        tokenCache.clear()
+        ownerCache.clear()
+
+        self.user = User.objects.create_user("owner", password="password")
+        self.token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {self.token.key}")
+
+    def getGreenhouses(self):
+        return self.client.get("/app/greenhouse").status_code
+
+    def testTokenIsCached(self):
+        self.assertEqual(self.getGreenhouses(), 200)
+        self.assertIsNotNone(tokenCache.get(self.token.key))
+
+    def testLogout(self):
+        self.assertEqual(self.getGreenhouses(), 200)
+        self.assertEqual(self.client.post("/auth/logout").status_code, 204)
+        self.assertEqual(self.getGreenhouses(), 401)
+
+    def testDeletedUser(self):
+        self.assertEqual(self.getGreenhouses(), 200)
+        self.user.delete()
+        self.assertEqual(self.getGreenhouses(), 401)
+
+    def testDeactivatedUser(self):
+        self.assertEqual(self.getGreenhouses(), 200)
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.getGreenhouses(), 401)
+
+    def testOwnedGreenhouses(self):
+        other = User.objects.create_user("other", password="password")
+        greenhouse = GreenhouseModel.objects.create(
+            owner=other, name="greenhouse", address="address", beginDate=datetime.date(2024, 5, 1))
+        path = f"/app/sensor/{greenhouse.greenhouseUID}/AirSensor_1/airTemp"
+        params = {"startTime": "2024-05-02T08:00:00", "endTime": "2024-05-02T12:00:00"}
+
+        self.assertEqual(self.client.get(path, params).status_code, 403)
 
-# Create your tests here.
+        # the cached greenhouses of the user are invalidated by the owner change
+        greenhouse.owner = self.user
+        greenhouse.save()
+        self.assertEqual(self.client.get(path, params).status_code, 404)
@@ -21,8 +21,8 @@ class LogoutAPIView(APIView):
     permission_classes = [IsAuthenticated]
 
     def post(self, request):
-        # Delete the token to log out
-        request.user.auth_token.delete()
+        # Delete the token to log out, which also removes it from the token cache
+        request.auth.delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
@@ -2,6 +2,8 @@
 ASGI config for myproject project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Websocket connections are routed to the greenhouse push channel, everything else
+to Django.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.0/howto/deployment/asgi/
@@ -13,4 +15,15 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'myproject.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# imported after the setup of django, the push channel uses the models
+from greenhouse_data.push import websocketApplication  # noqa: E402
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "websocket":
+        await websocketApplication(scope, receive, send)
+        return
+
+    await django_application(scope, receive, send)
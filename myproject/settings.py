@@ -10,8 +10,12 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
+import copy
+import os
 from pathlib import Path
 
+from django.core.exceptions import ImproperlyConfigured
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -46,7 +50,7 @@ INSTALLED_APPS = [
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'myapp.authentication.CachedTokenAuthentication',
     ],
 }
 
@@ -84,11 +88,206 @@ WSGI_APPLICATION = 'myproject.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# "sqlite" (development) or "postgres" (production, concurrent writers). The
+# postgres profile is configured by the POSTGRES_* environment variables
+DATABASE_PROFILE = os.environ.get("DJANGO_DATABASE_PROFILE", "sqlite")
+
+# replica aliases of each primary alias, see GREENHOUSE_READ_REPLICAS
+DATABASE_REPLICAS = {}
+
+if DATABASE_PROFILE == "postgres":
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get("POSTGRES_DB", "greenhouse"),
+            'USER': os.environ.get("POSTGRES_USER", "greenhouse"),
+            'PASSWORD': os.environ.get("POSTGRES_PASSWORD", ""),
+            'HOST': os.environ.get("POSTGRES_HOST", "127.0.0.1"),
+            'PORT': os.environ.get("POSTGRES_PORT", "5432"),
+            # check a reused connection before the request uses it, e.g. after a
+            # database restart
+            'CONN_HEALTH_CHECKS': True,
+        }
+    }
+
+    if os.environ.get("POSTGRES_POOL", "1") == "1":
+        # psycopg connection pool shared by the threads of the process, the
+        # connection goes back to the pool at the end of each request. Django
+        # requires CONN_MAX_AGE = 0 with a pool, and CONN_HEALTH_CHECKS makes the
+        # pool check a connection before lending it
+        DATABASES['default']['CONN_MAX_AGE'] = 0
+        DATABASES['default']['OPTIONS'] = {
+            "pool": {
+                "min_size": int(os.environ.get("POSTGRES_POOL_MIN_SIZE", 2)),
+                "max_size": int(os.environ.get("POSTGRES_POOL_MAX_SIZE", 20)),
+                "timeout": int(os.environ.get("POSTGRES_POOL_TIMEOUT", 10)),
+            },
+        }
+    else:
+        # one persistent connection per thread, reused for CONN_MAX_AGE seconds
+        DATABASES['default']['CONN_MAX_AGE'] = int(
+            os.environ.get("POSTGRES_CONN_MAX_AGE", 60))
+
+    # the history models get their own database when POSTGRES_HISTORY_DB is set, see
+    # greenhouse_data/routers.py
+    if os.environ.get("POSTGRES_HISTORY_DB", ""):
+        DATABASES['history'] = copy.deepcopy(DATABASES['default'])
+        DATABASES['history'].update({
+            'NAME': os.environ["POSTGRES_HISTORY_DB"],
+            'HOST': os.environ.get("POSTGRES_HISTORY_HOST", DATABASES['default']['HOST']),
+            'PORT': os.environ.get("POSTGRES_HISTORY_PORT", DATABASES['default']['PORT']),
+        })
+
+    # read replicas of the app GET requests, e.g. POSTGRES_REPLICA_HOSTS=10.0.0.2,10.0.0.3
+    for primary, hostsVariable in [("default", "POSTGRES_REPLICA_HOSTS"), ("history", "POSTGRES_HISTORY_REPLICA_HOSTS")]:
+        if primary not in DATABASES:
+            continue
+        hosts = [h for h in os.environ.get(hostsVariable, "").split(",") if h]
+        for i, host in enumerate(hosts, start=1):
+            alias = f"{primary}_replica_{i}"
+            DATABASES[alias] = copy.deepcopy(DATABASES[primary])
+            DATABASES[alias]['HOST'] = host
+            # the tests read the test database of the primary
+            DATABASES[alias]['TEST'] = {'MIRROR': primary}
+            DATABASE_REPLICAS.setdefault(primary, []).append(alias)
+
+elif DATABASE_PROFILE == "sqlite":
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+            'OPTIONS': {
+                # take the write lock when the transaction begins, a deferred
+                # transaction upgrading its read lock fails at once when another
+                # connection is writing, without waiting for the busy timeout
+                'transaction_mode': 'IMMEDIATE',
+            },
+        },
+        # the history stays in this database: a transaction can not span two
+        # SQLite files, see greenhouse_data/routers.py
     }
+
+else:
+    raise ImproperlyConfigured(
+        f"unknown DJANGO_DATABASE_PROFILE {DATABASE_PROFILE}")
+
+DATABASE_ROUTERS = [
+    "greenhouse_data.routers.ReplicaRouter",
+    "greenhouse_data.routers.HistoryRouter",
+]
+
+
+# Greenhouse data ingest
+
+# Database alias of the sensor and controller history, the schedules and the rollups.
+# They stay on the default database when the alias is not in DATABASES, which is the
+# case unless POSTGRES_HISTORY_DB is set
+GREENHOUSE_HISTORY_DATABASE = "history"
+
+# Read replicas of the app GET requests, see greenhouse_data/routers.py. A user reads
+# from the primaries for PIN_SECONDS after each of their writes. The pins are kept in
+# the PIN_CACHE entry of CACHES, which must be shared when several processes serve the app
+GREENHOUSE_READ_REPLICAS = {
+    "DATABASES": DATABASE_REPLICAS,  # {"default": ["default_replica_1"], ...}
+    "PIN_SECONDS": 10,
+    "PIN_CACHE": "default",
+}
+
+# Size of the in-process cache resolving sensor keys to sensor ids
+GREENHOUSE_TOPOLOGY_CACHE_SIZE = 4096
+
+# "direct" writes the readings of gh/real-sensor PUT in the request, "buffered"
+# queues them in the write buffer and returns 202
+GREENHOUSE_INGEST_MODE = "direct"
+
+GREENHOUSE_WRITE_BUFFER = {
+    "FLUSH_SIZE": 500,  # readings per batch
+    "FLUSH_INTERVAL_MS": 1000,
+    "MAX_QUEUE": 10000,  # readings kept in memory before writing directly
+    # a failed batch is written again MAX_RETRIES times before its readings are dropped
+    "MAX_RETRIES": 3,
+    "RETRY_DELAY_MS": 1000,
+}
+
+# Readings written per transaction by gh/real-sensor/<greenhouseUID>/stream
+GREENHOUSE_STREAM_CHUNK_SIZE = 1000
+
+# Broker of the pushed greenhouse updates. Use "greenhouse_data.pubsub.RedisBroker"
+# with {"url": "redis://..."} when several ASGI workers serve the push channels
+GREENHOUSE_PUBSUB = {
+    "BACKEND": "greenhouse_data.pubsub.LocalBroker",
+    "OPTIONS": {"maxQueue": 100},  # messages kept per slow subscriber
+}
+
+# Seconds without message before a keep-alive is sent on the push channels
+GREENHOUSE_PUSH_KEEPALIVE = 15
+
+# gh/controller/<greenhouseUID>/poll, in seconds. Waiting requests are woken by
+# writes of the same process and recheck the database every RECHECK_INTERVAL for
+# writes of the other processes
+GREENHOUSE_LONG_POLL = {
+    "TIMEOUT": 30,
+    "MAX_TIMEOUT": 60,
+    "RECHECK_INTERVAL": 5,
+}
+
+# "raw" samples the raw sensor history once per hour and averages the samples.
+# "rollup" computes the history charts from the hourly and daily rollups, each value
+# is then the mean of every reading of its bucket, which differs from the raw charts
+# as soon as a sensor reports more than once per hour
+GREENHOUSE_HISTORY_SOURCE = "raw"
+
+# Monthly partitions of the sensor history, see greenhouse_data/partitions.py.
+# `manage.py history_partitions` creates MONTHS_AHEAD months ahead and detaches the
+# months older than RETAIN_MONTHS full months (None keeps every month)
+GREENHOUSE_HISTORY_PARTITIONS = {
+    "MONTHS_AHEAD": 2,
+    "RETAIN_MONTHS": None,
+    "CACHE_TTL": 300,  # seconds a process remembers that a partition exists
+}
+
+# Cache of the app greenhouse documents. Use
+# "greenhouse_data.snapshot.DjangoCacheSnapshotBackend" with a shared CACHES entry
+# when several server processes serve the app
+GREENHOUSE_SNAPSHOT_BACKEND = {
+    "BACKEND": "greenhouse_data.snapshot.LocalSnapshotBackend",
+    "OPTIONS": {"maxSize": 1024},
+}
+
+# Signed requests of the devices on the gh/ endpoints, see greenhouse_data/device_auth.py.
+# The greenhouses with a device key only accept signed requests. ENFORCE also rejects
+# the unsigned requests of the greenhouses without a key
+GREENHOUSE_DEVICE_AUTH = {
+    "ENFORCE": False,
+    "MAX_SKEW": 300,  # seconds between the signature timestamp and the server clock
+    "ROTATION_GRACE": 3600,  # seconds the previous key is accepted after a rotation
+    "CACHE_SIZE": 4096,
+    "CACHE_TTL": 300,
+    "RELOAD_INTERVAL": 10,  # seconds between two reloads of the keys after a mismatch
+    # CACHES entry remembering the signatures of the writes against replays, it
+    # must be shared when several processes serve the devices
+    "NONCE_CACHE": "default",
+}
+
+# In-process cache of the authentication tokens and of the greenhouses owned by each
+# user, see myapp/authentication.py. A token deleted by another process is accepted
+# by this one for at most TTL seconds
+GREENHOUSE_TOKEN_CACHE = {
+    "MAX_SIZE": 4096,
+    "TTL": 300,
+}
+
+
+# Pragmas set on every new SQLite connection, in order, see greenhouse_data/sqlite.py.
+# WAL lets the app reads run during the ingest writes
+GREENHOUSE_SQLITE_PRAGMAS = {
+    "busy_timeout": 5000,  # ms a writer waits for the lock before "database is locked"
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",  # fsync at checkpoints only, safe with WAL
+    "cache_size": -65536,  # KiB of page cache per connection (64 MiB)
+    "mmap_size": 268435456,  # bytes of the database read through mmap (256 MiB)
+    "temp_store": "MEMORY",
+    "wal_autocheckpoint": 1000,  # pages
 }
 
 
@@ -2,12 +2,33 @@ import requests
 import json
 import datetime
 import random
+import hashlib
+import hmac
+import secrets
+import time
 
 sample_greenhouse_uid = "c8557574-3fd2-4650-90e8-e24a86851222"
 host = "127.0.0.1:8000"
 testing_controller_id = "evalve_3"
 testing_realSensor_id = "AirSensor_4"
 # host = "123.193.99.66:9000"
+# the key returned by POST app/greenhouse/<uid>/device-key, signs the gh/ requests
+device_key = None
+
+
+def device_headers(method: str, path: str, body: bytes = b"") -> dict:
+    if device_key is None:
+        return {}
+
+    timestamp = int(time.time())
+    # the server rejects a repeated signature as a replay
+    nonce = secrets.token_hex(8)
+    message = f"{timestamp}\n{method}\n{path}\n{hashlib.sha256(body).hexdigest()}\n{nonce}"
+    return {
+        "X-Greenhouse-Timestamp": str(timestamp),
+        "X-Greenhouse-Nonce": nonce,
+        "X-Greenhouse-Signature": hmac.new(device_key.encode(), message.encode(), hashlib.sha256).hexdigest(),
+    }
 
 
 def api_test(func):
@@ -309,6 +330,20 @@ def get_controller_to_gre() -> requests.Response:
     return res
 
 
+@api_test
+def poll_controller_to_gre(version: int = 0) -> requests.Response:
+    res = requests.get(
+        url=f"http://{host}/gh/controller/{sample_greenhouse_uid}/poll",
+        params={"version": version, "timeout": 30},
+        headers={
+            "Content-Type": "application/json",
+            "Authorization": f"Token {token}",
+        },
+    )
+
+    return res
+
+
 @api_test
 def get_controller_to_app() -> requests.Response:
 
@@ -517,6 +552,7 @@ def update_sensor_data():
         headers={
             "Content-Type": "application/json",
             "Authorization": f"Token {token}",
+            **device_headers("PUT", f"/gh/real-sensor/{sample_greenhouse_uid}", payload.encode()),
         },
         data=payload,
     )
@@ -565,6 +601,45 @@ def update_this_month_sensor_data():
         _iter += datetime.timedelta(hours=1)
 
 
+@api_test
+def stream_this_month_sensor_data() -> requests.Response:
+    now = datetime.datetime.now()
+    startOfMonth = datetime.datetime(now.year, now.month, 1)
+
+    def lines():
+        _iter = startOfMonth
+        while _iter < now:
+            yield (json.dumps(
+                {
+                    "AirSensor_4": {
+                        "address":
+                        {
+                            "lat": 24.112,
+                            "lng": 47.330
+                        },
+                        "sensors":
+                        {
+                            "airTemp": random.random() * 4 + 26,
+                            "airHumidity": random.random() * 5 + 25,
+                            "timestamp": _iter.isoformat(),
+                        }
+                    },
+                }
+            ) + "\n").encode()
+            _iter += datetime.timedelta(hours=1)
+
+    res = requests.put(
+        url=f"http://{host}/gh/real-sensor/{sample_greenhouse_uid}/stream",
+        headers={
+            "Content-Type": "application/x-ndjson",
+            "Authorization": f"Token {token}",
+        },
+        data=b"".join(lines()),
+    )
+
+    return res
+
+
 @api_test
 def update_on_off():
     payload = json.dumps(
@@ -612,6 +687,7 @@ if __name__ == '__main__':
     # get_one_greenhouse()
     # get_controller_to_app()
     # get_controller_to_gre()
+    # poll_controller_to_gre()
     # get_sensor_history()
 
     # update_controller_info()
@@ -621,6 +697,7 @@ if __name__ == '__main__':
     # update_greenhouse()
     # update_on_off()
     # update_this_month_sensor_data()
+    # stream_this_month_sensor_data()
 
     # delete_controller()
     pass